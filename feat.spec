@@ -163,6 +163,7 @@ fi
 %{_bindir}/feat-couchpy
 %{_bindir}/feat-dbload
 %{_bindir}/feat-locate
+%{_bindir}/feat-journal-migrate
 
 %{_sbindir}/feat-update-nagios
 
@@ -70,6 +70,7 @@ setup(name = NAME,
                  'bin/feat-service',
                  'bin/feat-couchpy',
                  'bin/feat-dbload',
-                 'bin/feat-locate'],
+                 'bin/feat-locate',
+                 'bin/feat-journal-migrate'],
       keywords = KEYWORDS,
       classifiers = CLASSIFIERS)
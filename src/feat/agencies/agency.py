@@ -406,6 +406,10 @@ class AgencyAgent(log.LogProxy, log.Logger, manhole.Manhole,
     def save_document(self, document):
         return self._database.save_document(document)
 
+    @serialization.freeze_tag('AgencyAgency.save_documents')
+    def save_documents(self, documents):
+        return self._database.save_documents(documents)
+
     @serialization.freeze_tag('AgencyAgency.get_document')
     def get_document(self, document_id):
         return self._database.get_document(document_id)
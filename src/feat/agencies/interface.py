@@ -312,6 +312,24 @@ class IJournalReader(Interface):
         @rtype: Deferred(list)
         '''
 
+    def get_entries_page(history, after=None, start_date=0, limit=1000):
+        '''
+        Fetches the single page of the journal entries for the given
+        history. The pages are retrieved with keyset pagination: the
+        cursor returned with the page should be passed as the after
+        parameter to get the following one. This allows walking through
+        the journals too big to be loaded into memory at once.
+
+        The format of the entries is the same as for get_entries().
+
+        @param after: Opaque cursor returned with the previous page or None
+                      to start from the beginning.
+        @param limit: Maximum number of entries in the page.
+        @rtype: Deferred
+        @callback: tuple (list of entries, cursor), the cursor is None
+                   if there are no more entries.
+        '''
+
     def get_bare_journal_entries(limit):
         '''
         Returns journal entries "from the top of the table". This is used
@@ -360,6 +378,14 @@ class IJournalReader(Interface):
         @rtype: Deferred
         '''
 
+    def get_log_entries_page(start_date, end_date, filters, after, limit):
+        '''
+        Fetches the single page of the log entries. The parameters and the
+        format of the entries are the same as for get_log_entries().
+        See get_entries_page() for the meaning of after parameter and the
+        callback value.
+        '''
+
     def get_log_hostnames(start_date, end_date):
         '''
         Fetches the hostnames for which we have log entries in the journal.
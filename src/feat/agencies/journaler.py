@@ -21,14 +21,21 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import bisect
+import collections
+import os
+import re
 import socket
 import sqlite3
+import struct
 import operator
 import types
 import sys
+import zlib
 
 from zope.interface import implements
 from twisted.enterprise import adbapi
+from twisted.internet import threads
 from twisted.spread import pb
 from twisted.python import log as twisted_log, failure
 
@@ -57,36 +64,46 @@ class State(enum.Enum):
 class EntriesCache(object):
     '''
     Helper class storing the data and giving the back in transactional way.
+    It keeps track of the approximate amount of bytes it holds.
     '''
 
     def __init__(self):
         self._cache = list()
         self._fetched = None
+        self._size = 0
 
     def append(self, entry):
         self._cache.append(entry)
+        self._size += entry_size(entry)
 
-    def fetch(self):
+    def fetch(self, limit=None):
         '''
         Gives all the data it has stored, and remembers what it has given.
         Later we need to call commit() to actually remove the data from the
-        cache.
+        cache. If the limit is given at most this number of entries is
+        returned.
         '''
         if self._fetched is not None:
             raise RuntimeError('fetch() was called but the previous one has '
                                'not yet been applied. Not supported')
         if self._cache:
             self._fetched = len(self._cache)
+            if limit is not None:
+                self._fetched = min(self._fetched, limit)
         return self._cache[0:self._fetched]
 
     def commit(self):
         '''
         Actually remove data returned by fetch() from the cache.
+        Returns the number of entries removed.
         '''
         if self._fetched is None:
             raise RuntimeError('commit() was called but nothing was fetched')
-        self._cache = self._cache[self._fetched:]
+        fetched = self._fetched
+        self._size -= sum(map(entry_size, self._cache[0:fetched]))
+        self._cache = self._cache[fetched:]
         self._fetched = None
+        return fetched
 
     def rollback(self):
         if self._fetched is None:
@@ -99,10 +116,67 @@ class EntriesCache(object):
         '''
         return self._fetched is not None
 
+    @property
+    def size(self):
+        '''
+        Approximate number of bytes of the data stored.
+        '''
+        return self._size
+
     def __len__(self):
         return len(self._cache)
 
 
+def entry_size(entry):
+    '''
+    Approximates the memory taken by the entry counting the length
+    of its string values.
+    '''
+    return sum(len(x) for x in entry.itervalues()
+               if isinstance(x, basestring))
+
+
+class FlushStatistics(object):
+    '''
+    Collects the statistics of the flushes done by the journaler:
+    the histogram of batch sizes and the flush latencies.
+    '''
+
+    # upper bounds of the batch size histogram buckets
+    batch_buckets = (1, 10, 100, 1000, 10000)
+
+    def __init__(self):
+        self.flushes = 0
+        self.entries = 0
+        self.last_latency = None
+        self.max_latency = None
+        self.total_latency = 0
+        self._batch_sizes = [0] * (len(self.batch_buckets) + 1)
+
+    def record(self, batch_size, latency):
+        self.flushes += 1
+        self.entries += batch_size
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+        self._batch_sizes[bisect.bisect_left(self.batch_buckets,
+                                             batch_size)] += 1
+
+    @property
+    def average_latency(self):
+        if self.flushes:
+            return self.total_latency / self.flushes
+
+    @property
+    def batch_sizes(self):
+        '''
+        @returns: list of tuples (upper_bound, count), the last bucket
+                  has upper bound None.
+        '''
+        bounds = list(self.batch_buckets) + [None]
+        return zip(bounds, self._batch_sizes)
+
+
 @decorator.parametrized_function
 def in_state(func, *states):
 
@@ -124,8 +198,19 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
 
     log_category = 'journaler'
 
+    # Group commit policy. The flush is postponed up to max_latency seconds
+    # to gather more entries, unless max_batch_size entries are waiting.
+    # A single flush never passes more than max_batch_size entries to the
+    # writer. When the queue grows over max_queued_bytes the producers get
+    # backpressure: the Deferreds they receive fire only after the queue
+    # is drained below the half of the limit.
+    max_batch_size = 1000
+    max_latency = 0.05
+    max_queued_bytes = 32 * 1024 * 1024
+
     def __init__(self, on_rotate_cb=None, on_switch_writer_cb=None,
-                 hostname=None):
+                 hostname=None, max_batch_size=None, max_latency=None,
+                 max_queued_bytes=None):
         log.Logger.__init__(self, log.get_default() or self)
 
         common.StateMachineMixin.__init__(self, State.disconnected)
@@ -134,6 +219,22 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
         self._cache = EntriesCache()
         self._notifier = defer.Notifier()
 
+        if max_batch_size is not None:
+            self.max_batch_size = max_batch_size
+        if max_latency is not None:
+            self.max_latency = max_latency
+        if max_queued_bytes is not None:
+            self.max_queued_bytes = max_queued_bytes
+
+        # total number of entries enqueued and flushed so far
+        self._enqueued = 0
+        self._flushed = 0
+        # deque of (entry number, Deferred) waiting for the entry to flush
+        self._flush_waiters = collections.deque()
+        self._saturated = False
+        self._flush_started = None
+        self.statistics = FlushStatistics()
+
         self._on_rotate_cb = on_rotate_cb
         self._on_switch_writer_cb = on_switch_writer_cb
         # [(klass, params)]
@@ -258,7 +359,14 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
             # in this case we are not registered as the observer anymore
             pass
 
-        d = self._close_writer(flush_writer)
+        d = defer.succeed(None)
+        if self._flush_task is not None and self._flush_task.active():
+            # don't leave the delayed flush behind, flush it right away
+            self._flush_task.cancel()
+            self._flush_task = None
+            if flush_writer and self._cmp_state(State.connected):
+                d.addCallback(defer.drop_param, self._flush)
+        d.addCallback(defer.drop_param, self._close_writer, flush_writer)
         d.addErrback(errback)
         d.addBoth(defer.drop_param, set_disconnected)
         return d
@@ -275,14 +383,14 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
 
     def insert_entry(self, **data):
         self._cache.append(data)
-        self._schedule_flush()
-        return self._notifier.wait('flush')
+        self._enqueued += 1
+        return self._entries_queued()
 
     def insert_entries(self, entries):
         for entry in entries:
             self._cache.append(entry)
-        self._schedule_flush()
-        return self._notifier.wait('flush')
+            self._enqueued += 1
+        return self._entries_queued()
 
     # used by remote ProxyBrokerWriter
 
@@ -299,6 +407,33 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
             return writer_idle
         return True
 
+    ### statistics, used by the model ###
+
+    @manhole.expose()
+    def get_queue_depth(self):
+        return len(self._cache)
+
+    @manhole.expose()
+    def get_queued_bytes(self):
+        return self._cache.size
+
+    @manhole.expose()
+    def is_saturated(self):
+        return self._saturated
+
+    @manhole.expose()
+    def get_statistics(self):
+        stats = self.statistics
+        return dict(queue_depth=len(self._cache),
+                    queued_bytes=self._cache.size,
+                    saturated=self._saturated,
+                    flushes=stats.flushes,
+                    flushed_entries=stats.entries,
+                    batch_sizes=stats.batch_sizes,
+                    last_flush_latency=stats.last_latency,
+                    average_flush_latency=stats.average_latency,
+                    max_flush_latency=stats.max_latency)
+
     ### methods called by journaler writers ###
 
     def on_rotate(self):
@@ -351,11 +486,37 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
 
     ### private ###
 
+    def _entries_queued(self):
+        d = defer.Deferred()
+        self._flush_waiters.append((self._enqueued, d))
+        if not self._saturated and self._cache.size > self.max_queued_bytes:
+            self.warning("Journaler queue is over the limit of %d bytes, "
+                         "%d entries are waiting for the writer. Applying "
+                         "backpressure.", self.max_queued_bytes,
+                         len(self._cache))
+            self._saturated = True
+        if self._saturated:
+            d.addCallback(self._wait_drained)
+        self._schedule_flush()
+        return d
+
+    def _wait_drained(self, _):
+        if self._saturated:
+            return self._notifier.wait('drained')
+
     def _schedule_flush(self):
         if not self._cmp_state(State.connected):
             return
+        urgent = (self._saturated or not self.max_latency or
+                  len(self._cache) >= self.max_batch_size)
         if self._flush_task is None:
-            self._flush_task = time.call_next(self._flush)
+            if urgent:
+                self._flush_task = time.call_next(self._flush)
+            else:
+                self._flush_task = time.call_later(self.max_latency,
+                                                   self._flush)
+        elif urgent and self._flush_task.active():
+            self._flush_task.reset(0)
 
     def _flush(self):
         d = defer.succeed(None)
@@ -367,8 +528,9 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
         return d
 
     def _flush_body(self):
-        entries = self._cache.fetch()
+        entries = self._cache.fetch(self.max_batch_size)
         if entries:
+            self._flush_started = time.time()
             d = self._writer.insert_entries(entries)
             d.addCallbacks(defer.drop_param, self._flush_error,
                            callbackArgs=(self._flush_complete, ))
@@ -378,14 +540,27 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
 
     def _flush_complete(self):
         if self._cache.is_locked():
-            self._cache.commit()
+            flushed = self._cache.commit()
+            self._flushed += flushed
+            self.statistics.record(flushed,
+                                   time.time() - self._flush_started)
         self._flush_task = None
-        self._notifier.callback('flush', None)
+        self._flush_started = None
+        while (self._flush_waiters and
+               self._flush_waiters[0][0] <= self._flushed):
+            _, d = self._flush_waiters.popleft()
+            d.callback(None)
+        if self._saturated and self._cache.size <= self.max_queued_bytes / 2:
+            self.info("Journaler queue drained to %d bytes, releasing "
+                      "the backpressure.", self._cache.size)
+            self._saturated = False
+            self._notifier.callback('drained', None)
         if len(self._cache) > 0:
             self._schedule_flush()
 
     def _flush_error(self, fail):
         self._cache.rollback()
+        self._flush_started = None
         error.handle_failure(self, fail,
                            'Flushing entries to the writer failed')
         if self._writer:
@@ -491,6 +666,49 @@ class BrokerProxyWriter(log.Logger, common.StateMachineMixin):
         self._set_journaler(None)
 
 
+_SQLITE_INSERT_ENTRY = \
+    "INSERT INTO entries VALUES (null, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+_SQLITE_INSERT_LOG = "INSERT INTO logs VALUES (null, ?, ?, ?, ?, ?, ?, ?)"
+
+# The id column is selected last so that the cursor of the page can be
+# taken from it, the decoding ignores it.
+_SQLITE_SELECT_ENTRIES = text_helper.format_block("""
+SELECT histories.agent_id,
+       histories.instance_id,
+       entries.journal_id,
+       entries.function_id,
+       entries.fiber_id,
+       entries.fiber_depth,
+       entries.args,
+       entries.kwargs,
+       entries.side_effects,
+       entries.result,
+       entries.timestamp,
+       entries.id
+  FROM entries
+  LEFT JOIN histories ON histories.id = entries.history_id
+""")
+_SQLITE_SELECT_LOGS = text_helper.format_block("""
+SELECT "localhost",
+       logs.message,
+       logs.level,
+       logs.category,
+       logs.log_name,
+       logs.file_path,
+       logs.line_num,
+       logs.timestamp,
+       logs.id
+  FROM logs
+ WHERE 1
+""")
+
+_JOURNAL_FIELDS = ('agent_id', 'instance_id', 'journal_id', 'function_id',
+                   'fiber_id', 'fiber_depth', 'args', 'kwargs',
+                   'side_effects', 'result', 'timestamp')
+_LOG_FIELDS = ('hostname', 'message', 'level', 'category',
+               'log_name', 'file_path', 'line_num', 'timestamp')
+
+
 class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
 
 
@@ -564,22 +782,8 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
 
     @in_state(State.connected)
     def get_bare_journal_entries(self, limit=1000):
-        command = text_helper.format_block("""
-        SELECT histories.agent_id,
-               histories.instance_id,
-               entries.journal_id,
-               entries.function_id,
-               entries.fiber_id,
-               entries.fiber_depth,
-               entries.args,
-               entries.kwargs,
-               entries.side_effects,
-               entries.result,
-               entries.timestamp
-          FROM entries
-          LEFT JOIN histories ON histories.id = entries.history_id
-          ORDER BY entries.timestamp ASC
-          LIMIT ?""")
+        command = _SQLITE_SELECT_ENTRIES + \
+                  " ORDER BY entries.timestamp ASC LIMIT ?"
         d = self._db.runQuery(command, (limit, ))
         d.addCallback(self._decode, entry_type='journal')
         return d
@@ -597,73 +801,40 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
 
     @in_state(State.connected)
     def get_entries(self, history, start_date=0, limit=None):
-        if not isinstance(history, History):
-            raise AttributeError(
-                'First paremeter is expected to be History instance, got %r'
-                % history)
-
-        command = text_helper.format_block("""
-        SELECT histories.agent_id,
-               histories.instance_id,
-               entries.journal_id,
-               entries.function_id,
-               entries.fiber_id,
-               entries.fiber_depth,
-               entries.args,
-               entries.kwargs,
-               entries.side_effects,
-               entries.result,
-               entries.timestamp
-          FROM entries
-          LEFT JOIN histories ON histories.id = entries.history_id
-          WHERE entries.history_id = ?""")
-        if start_date:
-            command += " AND entries.timestamp >= %s" % (start_date, )
-        command += " ORDER BY entries.rowid ASC"
+        command, params = self._entries_query(history, start_date)
+        command += " ORDER BY entries.id ASC"
         if limit:
             command += " LIMIT %s" % (limit, )
-        d = self._db.runQuery(command, (history.history_id, ))
+        d = self._db.runQuery(command, params)
         d.addCallback(self._decode, entry_type='journal')
         return d
 
+    @in_state(State.connected)
+    def get_entries_page(self, history, after=None, start_date=0,
+                         limit=1000):
+        '''
+        See feat.agencies.interface.IJournalReader.get_entries_page.
+        The cursor is the id of the last entry of the page.
+        '''
+        command, params = self._entries_query(history, start_date)
+        if after is not None:
+            command += " AND entries.id > ?"
+            params += (after, )
+        command += " ORDER BY entries.id ASC LIMIT ?"
+        params += (limit + 1, )
+        d = self._db.runQuery(command, params)
+        d.addCallback(self._decode_page, limit, 'journal',
+                      operator.itemgetter(-1))
+        return d
+
     @in_state(State.connected)
     def get_log_entries(self, start_date=None, end_date=None, filters=list(),
                         limit=None):
         '''
         See feat.agencies.interface.IJournalReader.get_log_entres
         '''
-        query = text_helper.format_block('''
-        SELECT "localhost",
-               logs.message,
-               logs.level,
-               logs.category,
-               logs.log_name,
-               logs.file_path,
-               logs.line_num,
-               logs.timestamp
-        FROM logs
-        WHERE 1
-        ''')
-        query = self._add_timestamp_condition_sql(query, start_date, end_date)
-
-        def transform_filter(filter):
-            level = filter.get('level', None)
-            category = filter.get('category', None)
-            name = filter.get('name', None)
-            if level is None:
-                raise AttributeError("level is mandatory parameter.")
-            resp = "(logs.level <= %d" % (int(level), )
-            if category is not None:
-                resp += " AND logs.category == '%s'" % (category, )
-            if name is not None:
-                resp += " AND logs.log_name == '%s'" % (name, )
-            resp += ')'
-            return resp
-
-        filter_strings = map(transform_filter, filters)
-        if filter_strings:
-            query += " AND (%s)\n" % (' OR '.join(filter_strings), )
-        query += " ORDER BY logs.timestamp, rowid"
+        query = self._log_entries_query(start_date, end_date, filters)
+        query += " ORDER BY logs.timestamp, logs.id"
         if limit:
             query += " LIMIT %s" % (limit, )
 
@@ -671,6 +842,28 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
         d.addCallback(self._decode, entry_type='log')
         return d
 
+    @in_state(State.connected)
+    def get_log_entries_page(self, start_date=None, end_date=None,
+                             filters=list(), after=None, limit=1000):
+        '''
+        See feat.agencies.interface.IJournalReader.get_log_entries_page.
+        The cursor is the tuple (timestamp, id) of the last entry of the page.
+        '''
+        query = self._log_entries_query(start_date, end_date, filters)
+        params = ()
+        if after is not None:
+            timestamp, row_id = after
+            query += ("  AND (logs.timestamp > ? OR "
+                      "(logs.timestamp = ? AND logs.id > ?))\n")
+            params = (timestamp, timestamp, row_id)
+        query += " ORDER BY logs.timestamp, logs.id LIMIT ?"
+        params += (limit + 1, )
+
+        d = self._db.runQuery(query, params)
+        d.addCallback(self._decode_page, limit, 'log',
+                      operator.itemgetter(-2, -1))
+        return d
+
     @in_state(State.connected)
     def delete_top_log_entries(self, num):
         command = text_helper.format_block("""
@@ -763,6 +956,40 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
             query += "  AND logs.timestamp <= %d\n" % (int(end_date), )
         return query
 
+    def _entries_query(self, history, start_date):
+        if not isinstance(history, History):
+            raise AttributeError(
+                'First paremeter is expected to be History instance, got %r'
+                % history)
+
+        command = _SQLITE_SELECT_ENTRIES + " WHERE entries.history_id = ?"
+        if start_date:
+            command += " AND entries.timestamp >= %s" % (start_date, )
+        return command, (history.history_id, )
+
+    def _log_entries_query(self, start_date, end_date, filters):
+        query = self._add_timestamp_condition_sql(
+            _SQLITE_SELECT_LOGS, start_date, end_date)
+
+        def transform_filter(filter):
+            level = filter.get('level', None)
+            category = filter.get('category', None)
+            name = filter.get('name', None)
+            if level is None:
+                raise AttributeError("level is mandatory parameter.")
+            resp = "(logs.level <= %d" % (int(level), )
+            if category is not None:
+                resp += " AND logs.category == '%s'" % (category, )
+            if name is not None:
+                resp += " AND logs.log_name == '%s'" % (name, )
+            resp += ')'
+            return resp
+
+        filter_strings = map(transform_filter, filters)
+        if filter_strings:
+            query += " AND (%s)\n" % (' OR '.join(filter_strings), )
+        return query
+
     def _reset_history_id_cache(self):
         # (agent_id, instance_id, ) -> history_id
         self._history_id_cache = dict()
@@ -800,36 +1027,34 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
         Returns rows in readable format. Transforms tuples into dictionaries,
         and appends information about entry type to the rows.
         '''
-
-        def decode_blobs(row):
-            row = list(row)
-            for index, value in zip(range(len(row)), row):
-                if isinstance(value, types.BufferType):
-                    value = str(value)
-                    if self._encoding:
-                        value = value.decode(self._encoding)
-                    row[index] = value
-            return row
-
-        decoded = map(decode_blobs, entries)
         if entry_type == 'log':
-            mapping = ['hostname', 'message', 'level', 'category',
-                       'log_name', 'file_path', 'line_num', 'timestamp']
+            mapping = _LOG_FIELDS
         elif entry_type == 'journal':
-            mapping = ['agent_id', 'instance_id', 'journal_id', 'function_id',
-                       'fiber_id', 'fiber_depth', 'args', 'kwargs',
-                       'side_effects', 'result', 'timestamp']
+            mapping = _JOURNAL_FIELDS
         else:
             raise ValueError('Unknown entry_type %r' % (entry_type, ))
 
-        def parse(row, mapping, entry_type):
-            resp = dict(zip(mapping, row))
-            resp['entry_type'] = entry_type
-            return resp
-
-        parsed = [parse(row, mapping, entry_type) for row in decoded]
+        encoding = self._encoding
+        buffer_type = types.BufferType
+        parsed = []
+        for row in entries:
+            resp = {'entry_type': entry_type}
+            for name, value in zip(mapping, row):
+                if isinstance(value, buffer_type):
+                    value = str(value)
+                    if encoding:
+                        value = value.decode(encoding)
+                resp[name] = value
+            parsed.append(resp)
         return parsed
 
+    def _decode_page(self, rows, limit, entry_type, get_cursor):
+        cursor = None
+        if len(rows) > limit:
+            del rows[limit:]
+            cursor = get_cursor(rows[-1])
+        return self._decode(rows, entry_type), cursor
+
     def _encode(self, data):
         result = dict()
 
@@ -987,42 +1212,38 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
         return self._flush_next()
 
     def _perform_inserts(self, cache):
-
-        def do_insert_entry(connection, history_id, data):
-            command = text_helper.format_block("""
-            INSERT INTO entries VALUES (null, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """)
-            connection.execute(
-                command, (history_id,
-                          data['journal_id'], data['function_id'],
-                          data['fiber_id'], data['fiber_depth'],
-                          data['args'], data['kwargs'],
-                          data['side_effects'], data['result'],
-                          int(data['timestamp'])))
-
-        def do_insert_log(connection, data):
-            command = text_helper.format_block("""
-            INSERT INTO logs VALUES (null, ?, ?, ?, ?, ?, ?, ?)
-            """)
-            connection.execute(
-                command, (data['message'], int(data['level']),
-                          data['category'], data['log_name'],
-                          data['file_path'], data['line_num'],
-                          int(data['timestamp'])))
+        '''
+        Writes the whole fetched batch in a single transaction. The entries
+        are grouped by type, the history ids are resolved upfront and each
+        group is written with one executemany() call. The statements are
+        constant strings, so sqlite can reuse the prepared statements.
+        '''
 
         def transaction(connection, cache):
             entries = cache.fetch()
             if not entries:
                 return
             try:
-                entries = map(self._encode, entries)
-                for data in entries:
-                    if data['entry_type'] == 'journal':
-                        history_id = self._get_history_id(
-                            connection, data['agent_id'], data['instance_id'])
-                        do_insert_entry(connection, history_id, data)
-                    elif data['entry_type'] == 'log':
-                        do_insert_log(connection, data)
+                journal, logs = self._group_entries(entries)
+                if journal:
+                    history_ids = self._get_history_ids(
+                        connection, [(x['agent_id'], x['instance_id'])
+                                     for x in journal])
+                    connection.executemany(
+                        _SQLITE_INSERT_ENTRY,
+                        [(history_ids[(x['agent_id'], x['instance_id'])],
+                          x['journal_id'], x['function_id'],
+                          x['fiber_id'], x['fiber_depth'],
+                          x['args'], x['kwargs'],
+                          x['side_effects'], x['result'],
+                          int(x['timestamp'])) for x in journal])
+                if logs:
+                    connection.executemany(
+                        _SQLITE_INSERT_LOG,
+                        [(x['message'], int(x['level']),
+                          x['category'], x['log_name'],
+                          x['file_path'], x['line_num'],
+                          int(x['timestamp'])) for x in logs])
                 cache.commit()
             except Exception:
                 cache.rollback()
@@ -1030,6 +1251,36 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
 
         return self._db.runWithConnection(transaction, cache)
 
+    def _group_entries(self, entries):
+        '''
+        Encodes the entries and splits them into journal and log entries
+        preserving the order inside each group.
+        '''
+        journal = list()
+        logs = list()
+        for data in entries:
+            data = self._encode(data)
+            if data['entry_type'] == 'journal':
+                journal.append(data)
+            elif data['entry_type'] == 'log':
+                logs.append(data)
+        return journal, logs
+
+    def _get_history_ids(self, connection, keys):
+        '''
+        Resolves the history_id for all the (agent_id, instance_id) pairs.
+        Returns the dictionary keyed by the pair.
+
+        BEWARE: This method runs in a thread.
+        '''
+        result = dict()
+        for agent_id, instance_id in keys:
+            key = (agent_id, instance_id)
+            if key not in result:
+                result[key] = self._get_history_id(
+                    connection, agent_id, instance_id)
+        return result
+
     def _get_history_id(self, connection, agent_id, instance_id):
         '''
         Checks own cache for history_id for agent_id and instance_id.
@@ -1070,97 +1321,915 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
             return d
 
 
-class Record(object):
-    implements(IRecord)
+# Every record in the segment file starts with the header holding
+# the length of the payload, its crc32 checksum and the flags.
+_RECORD_HEADER = struct.Struct('!IIB')
+_RECORD_COMPRESSED = 0x01
+# Payloads smaller than this are never compressed.
+_COMPRESS_THRESHOLD = 128
 
-    def __init__(self, journaler):
-        self._journaler = journaler
+# Every record of the index file is the structure below followed by the
+# utf-8 encoded agent_id. Fields: entry type, offset and length of the
+# record in the segment file, timestamp, instance_id, length of agent_id.
+_INDEX_RECORD = struct.Struct('!BQIdiH')
+(_JOURNAL_ENTRY, _LOG_ENTRY) = range(2)
 
-    def commit(self, **data):
-        data['entry_type'] = 'journal'
-        self._journaler.insert_entry(**data)
+_ENTRY_FIELDS = {
+    _JOURNAL_ENTRY: ('agent_id', 'instance_id', 'journal_id', 'function_id',
+                     'fiber_id', 'fiber_depth', 'args', 'kwargs',
+                     'side_effects', 'result', 'timestamp'),
+    _LOG_ENTRY: ('message', 'level', 'category', 'log_name', 'file_path',
+                 'line_num', 'timestamp')}
 
+_ENTRY_TYPES = {'journal': _JOURNAL_ENTRY, 'log': _LOG_ENTRY}
 
-class JournalerConnection(log.Logger, log.LogProxy):
-    implements(IJournalerConnection)
 
-    def __init__(self, journaler, externalizer):
-        log.LogProxy.__init__(self, journaler)
-        log.Logger.__init__(self, self)
+class IndexEntry(object):
+    '''
+    Location and the lookup keys of a single record of the file journal.
+    '''
 
-        self.serializer = banana.Serializer(externalizer=externalizer)
-        self.snapshot_serializer = banana.Serializer()
-        self.journaler = IJournaler(journaler)
+    __slots__ = ('type', 'segment', 'offset', 'length',
+                 'timestamp', 'agent_id', 'instance_id')
 
-    ### IJournalerConnection ###
+    def __init__(self, type, segment, offset, length,
+                 timestamp, agent_id, instance_id):
+        self.type = type
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+        self.timestamp = timestamp
+        self.agent_id = agent_id
+        self.instance_id = instance_id
 
-    def new_entry(self, agent_id, instance_id, journal_id, function_id,
-                  *args, **kwargs):
-        record = self.journaler.prepare_record()
-        entry = AgencyJournalEntry(
-            self.serializer, record, agent_id, instance_id,
-            journal_id, function_id, *args, **kwargs)
-        return entry
+    @property
+    def position(self):
+        return (self.segment, self.offset)
 
-    def snapshot(self, agent_id, instance_id, snapshot):
-        record = self.journaler.prepare_record()
-        entry = AgencyJournalEntry(
-            self.snapshot_serializer, record, agent_id, instance_id,
-            'agency', 'snapshot', snapshot)
-        entry.set_result(None)
-        entry.commit()
-        f = entry.get_result()
-        if f:
-            self.error('Error snapshoting the agent: %r. It will produce '
-                       'manlformed snapshot.', f.trigger_param)
+    @property
+    def end(self):
+        return (self.segment, self.offset + self.length)
 
+    @property
+    def key(self):
+        return (self.agent_id, self.instance_id)
 
-class AgencyJournalSideEffect(object):
+    def pack(self):
+        agent_id = self.agent_id.encode('utf-8')
+        return _INDEX_RECORD.pack(self.type, self.offset, self.length,
+                                  self.timestamp, self.instance_id,
+                                  len(agent_id)) + agent_id
 
-    implements(IJournalSideEffect)
+    @classmethod
+    def unpack_from(cls, segment, data, pos):
+        '''
+        @returns: tuple (IndexEntry, position after the entry) or None
+                  if the data is truncated.
+        '''
+        start = pos + _INDEX_RECORD.size
+        if start > len(data):
+            return None
+        type, offset, length, timestamp, instance_id, size = \
+              _INDEX_RECORD.unpack_from(data, pos)
+        if start + size > len(data):
+            return None
+        agent_id = data[start:start + size].decode('utf-8')
+        entry = cls(type, segment, offset, length, timestamp,
+                    agent_id, instance_id)
+        return entry, start + size
+
+
+class FileWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
+    '''
+    Journal writer appending the entries to the binary segment files.
+    Each record is prefixed with its length and crc32 checksum and its
+    payload is optionally compressed with zlib. The segment is rotated
+    when it grows bigger than max_segment_size and on SIGHUP.
+
+    Next to each segment there is an index file with the location of the
+    records keyed by (agent_id, instance_id, timestamp). The indexes are
+    loaded to memory on startup, the records missing from the index
+    (after a crash) are recovered by scanning the tail of the segment.
+
+    The entries removed with delete_top_*_entries() are only marked
+    in the checkpoint file, the segments are removed once they don't
+    hold any entries anymore.
+    '''
 
-    ### IJournalSideEffect ###
+    implements(IJournalWriter, IJournalReader)
 
-    def __init__(self, serializer, record, function_id, *args, **kwargs):
-        self._serializer = serializer
-        self._record = record
-        self._fun_id = function_id
-        self._args = serializer.freeze(args or tuple())
-        self._kwargs = serializer.freeze(kwargs or dict())
-        self._effects = []
-        self._result = None
+    max_segment_size = 64 * 1024 * 1024
 
-    ### IJournalSideEffect Methods ###
+    def __init__(self, logger, filename, compress=True,
+                 max_segment_size=None, hostname=None):
+        '''
+        @param filename: Base name of the journal files. Segments are
+                         stored as filename.NNNNNNNN
+        @param compress: Should the payloads be compressed
+        @param max_segment_size: Size in bytes of the segment file
+                                 triggering the rotation.
+        @param logger: ILogger to use
+        '''
+        log.Logger.__init__(self, logger)
+        log.LogProxy.__init__(self, logger)
+        common.StateMachineMixin.__init__(self, State.disconnected)
 
-    def add_effect(self, effect_id, *args, **kwargs):
-        assert self._record is not None
-        data = (effect_id,
-                self._serializer.convert(args),
-                self._serializer.convert(kwargs))
-        self._effects.append(data)
+        self._filename = filename
+        self._compress = compress
+        if max_segment_size is not None:
+            self.max_segment_size = max_segment_size
+        if hostname is None:
+            hostname = socket.gethostname()
+            self.warning("File writer was initialized without passing "
+                         "the hostname. Falling back to: %s", hostname)
+        self._hostname = hostname
+        self._cache = EntriesCache()
+        # the semaphore is used to always have at most one thread
+        # touching the files
+        self._semaphore = defer.DeferredSemaphore(1)
 
-    def set_result(self, result):
-        assert self._record is not None
-        self._result = self._serializer.convert(result)
-        return self
+        self._sighup_installed = False
+        self._journaler = None
+        self._reset_index()
 
-    def commit(self):
-        assert self._record is not None
-        data = (self._fun_id, self._args, self._kwargs,
-                self._effects, self._result)
-        self._record.extend(data)
-        self._record = None
-        return self
+    def initiate(self):
+        self.debug("Initiating file journal writer for %r.", self._filename)
+        d = self._semaphore.run(threads.deferToThread, self._load)
+        d.addCallback(self._loaded)
+        return d
 
+    def close(self, flush=True):
+        d = defer.succeed(None)
+        if self._cmp_state(State.disconnected):
+            self.debug("Writer is already disconnected.")
+            return d
+        if flush:
+            self.debug("Flushing file writer before closing")
+            d.addCallback(defer.drop_param, self._flush_next)
+        d.addCallback(defer.drop_param, self._uninstall_sighup)
+        d.addCallback(defer.drop_param, self._set_state,
+                      State.disconnected)
+        d.addCallback(defer.drop_param,
+                      self._notifier.cancel, State.connected)
+        return d
 
-class History(formatable.Formatable, pb.Copyable):
-    '''
-    Mapping for objects in history database.
-    '''
+    ### IJournalReader ###
 
-    formatable.field('history_id', None)
-    formatable.field('agent_id', None)
-    formatable.field('instance_id', None)
+    @in_state(State.connected)
+    def get_histories(self):
+        return [History(history_id=index + 1, agent_id=key[0],
+                        instance_id=key[1], hostname=self._hostname)
+                for index, key in enumerate(self._history_keys)
+                if self._history_index.get(key)]
+
+    @in_state(State.connected)
+    def get_bare_journal_entries(self, limit=1000):
+        return self._read(self._journal_index[:limit])
+
+    @in_state(State.connected)
+    def delete_top_journal_entries(self, num):
+        deleted = self._journal_index[:num]
+        if not deleted:
+            return
+        self._journal_index = self._journal_index[num:]
+        self._marks[_JOURNAL_ENTRY] = deleted[-1].end
+        for key in set(x.key for x in deleted):
+            mark = self._marks[_JOURNAL_ENTRY]
+            self._history_index[key] = [x for x in self._history_index[key]
+                                        if x.position >= mark]
+        return self._save_checkpoint()
+
+    @in_state(State.connected)
+    def get_entries(self, history, start_date=0, limit=None):
+        index = self._select_entries(history, start_date)
+        if limit:
+            index = index[:limit]
+        return self._read(index)
+
+    @in_state(State.connected)
+    def get_entries_page(self, history, after=None, start_date=0,
+                         limit=1000):
+        '''
+        See feat.agencies.interface.IJournalReader.get_entries_page.
+        The cursor is the position (segment, offset) of the last entry
+        of the page.
+        '''
+        index = self._select_entries(history, start_date)
+        if after is not None:
+            index = index[_bisect_index(index, tuple(after)):]
+        cursor = None
+        if len(index) > limit:
+            index = index[:limit]
+            cursor = index[-1].position
+        d = self._read(index)
+        d.addCallback(lambda entries: (entries, cursor))
+        return d
+
+    @in_state(State.connected)
+    def get_log_entries(self, start_date=None, end_date=None, filters=list(),
+                        limit=None):
+        '''
+        See feat.agencies.interface.IJournalReader.get_log_entres
+        '''
+        matches = _log_filter(filters)
+
+        def select(entries):
+            entries = filter(matches, entries)
+            entries.sort(key=operator.itemgetter('timestamp'))
+            if limit:
+                entries = entries[:limit]
+            return entries
+
+        d = self._read(self._select_logs(start_date, end_date))
+        d.addCallback(select)
+        return d
+
+    @in_state(State.connected)
+    def get_log_entries_page(self, start_date=None, end_date=None,
+                             filters=list(), after=None, limit=1000):
+        '''
+        See feat.agencies.interface.IJournalReader.get_log_entries_page.
+        The cursor is the tuple (timestamp, position) of the last entry
+        of the page.
+        '''
+        matches = _log_filter(filters)
+        index = self._select_logs(start_date, end_date)
+        index.sort(key=lambda x: (x.timestamp, x.position))
+        if after is not None:
+            timestamp, position = after
+            after = (timestamp, tuple(position))
+            index = [x for x in index if (x.timestamp, x.position) > after]
+        return self._semaphore.run(threads.deferToThread,
+                                   self._read_log_page, index, matches, limit)
+
+    @in_state(State.connected)
+    def delete_top_log_entries(self, num):
+        deleted = self._log_index[:num]
+        if not deleted:
+            return
+        self._log_index = self._log_index[num:]
+        self._marks[_LOG_ENTRY] = deleted[-1].end
+        return self._save_checkpoint()
+
+    @in_state(State.connected)
+    def get_log_hostnames(self, start_date=None, end_date=None):
+        return [self._hostname]
+
+    @in_state(State.connected)
+    def get_log_categories(self, start_date=None, end_date=None,
+                           hostname=None):
+
+        def unpack(entries):
+            return list(set(x['category'] for x in entries))
+
+        d = self._read(self._select_logs(start_date, end_date))
+        d.addCallback(unpack)
+        return d
+
+    @in_state(State.connected)
+    def get_log_names(self, category, hostname=None,
+                      start_date=None, end_date=None):
+
+        def unpack(entries):
+            return list(set(x['log_name'] for x in entries
+                            if x['category'] == category))
+
+        d = self._read(self._select_logs(start_date, end_date))
+        d.addCallback(unpack)
+        return d
+
+    @in_state(State.connected)
+    def get_log_time_boundaries(self):
+        '''
+        @returns: a tuple of log entry timestaps (first, last) or None
+        '''
+        if self._log_index:
+            timestamps = [x.timestamp for x in self._log_index]
+            return min(timestamps), max(timestamps)
+
+    ### IJournalWriter ###
+
+    def configure_with(self, journaler):
+        self.log("configure_with() called. journaler=%r", journaler)
+        if self._journaler:
+            self.warning("We already have a journaler reference, substituing")
+        self._journaler = journaler
+
+    def insert_entries(self, entries):
+        for data in entries:
+            self._cache.append(data)
+        return self._flush_next()
+
+    def is_idle(self):
+        if len(self._cache) > 0:
+            return False
+        return True
+
+    ### Private ###
+
+    def _reset_index(self):
+        # [IndexEntry] in the order of writing
+        self._journal_index = list()
+        self._log_index = list()
+        # (agent_id, instance_id) -> [IndexEntry]
+        self._history_index = dict()
+        # [(agent_id, instance_id)] in order of appearance
+        self._history_keys = list()
+        # entry type -> (segment, offset) of the first entry not deleted
+        self._marks = {_JOURNAL_ENTRY: (0, 0), _LOG_ENTRY: (0, 0)}
+        # [segment number]
+        self._segments = list()
+        self._segment = 1
+        self._segment_size = 0
+
+    def _add_to_index(self, entry):
+        if entry.position < self._marks[entry.type]:
+            return
+        if entry.type == _LOG_ENTRY:
+            self._log_index.append(entry)
+            return
+        self._journal_index.append(entry)
+        key = entry.key
+        if key not in self._history_index:
+            self._history_index[key] = list()
+            self._history_keys.append(key)
+        self._history_index[key].append(entry)
+
+    def _select_entries(self, history, start_date):
+        if not isinstance(history, History):
+            raise AttributeError(
+                'First paremeter is expected to be History instance, got %r'
+                % history)
+
+        index = self._history_index.get(
+            (history.agent_id, history.instance_id), list())
+        if start_date:
+            index = [x for x in index if x.timestamp >= start_date]
+        return index
+
+    def _select_logs(self, start_date, end_date):
+        index = list(self._log_index)
+        if start_date is not None:
+            index = [x for x in index if x.timestamp >= int(start_date)]
+        if end_date is not None:
+            index = [x for x in index if x.timestamp <= int(end_date)]
+        return index
+
+    def _read(self, index):
+        return self._semaphore.run(threads.deferToThread,
+                                   self._read_entries, index)
+
+    def _segment_path(self, segment):
+        return "%s.%08d" % (self._filename, segment)
+
+    def _index_path(self, segment):
+        return self._segment_path(segment) + '.idx'
+
+    def _checkpoint_path(self):
+        return self._filename + '.checkpoint'
+
+    def _sighup_handler(self, signum, frame):
+        self.debug("Received SIGHUP, starting the new segment.")
+        if self._journaler:
+            time.call_next(self._journaler.on_rotate)
+        self._semaphore.run(self._rotate)
+
+    def _install_sighup(self):
+        if self._sighup_installed:
+            return
+        self.debug('Installing SIGHUP handler.')
+        signal.signal(signal.SIGHUP, self._sighup_handler)
+        self._sighup_installed = True
+
+    def _uninstall_sighup(self):
+        if not self._sighup_installed:
+            return
+
+        try:
+            signal.unregister(signal.SIGHUP, self._sighup_handler)
+            self.debug("Uninstalled SIGHUP handler.")
+        except ValueError:
+            self.warning("Unregistering of sighup failed. Straaange!")
+        self._sighup_installed = False
+
+    def _rotate(self):
+        if self._segment_size > 0:
+            self._segment += 1
+            self._segment_size = 0
+
+    def _loaded(self, result):
+        segments, entries, marks = result
+        self._reset_index()
+        self._marks.update(marks)
+        self._segments = segments
+        for entry in entries:
+            self._add_to_index(entry)
+        if segments:
+            self._segment = segments[-1]
+            self._segment_size = os.path.getsize(
+                self._segment_path(self._segment))
+        self._install_sighup()
+        self.debug('File journal writer initiated correctly for the '
+                   'filename %r, %d segments loaded.', self._filename,
+                   len(segments))
+        self._set_state(State.connected)
+        return self._flush_next()
+
+    @in_state(State.connected)
+    def _flush_next(self):
+        if len(self._cache) == 0:
+            return defer.succeed(None)
+        else:
+            d = self._semaphore.run(self._perform_inserts)
+            d.addCallback(defer.drop_param, self._flush_next)
+            return d
+
+    def _perform_inserts(self):
+        entries = self._cache.fetch()
+        if not entries:
+            return
+        d = threads.deferToThread(self._write_entries, entries)
+        d.addCallbacks(self._entries_written, self._writing_failed)
+        return d
+
+    def _entries_written(self, result):
+        self._cache.commit()
+        written, self._segment, self._segment_size = result
+        for entry in written:
+            if entry.segment not in self._segments:
+                self._segments.append(entry.segment)
+            self._add_to_index(entry)
+
+    def _writing_failed(self, fail):
+        self._cache.rollback()
+        return fail
+
+    def _save_checkpoint(self):
+        live = set(x.segment for x in self._journal_index)
+        live.update(x.segment for x in self._log_index)
+        live.add(self._segment)
+        dead = [x for x in self._segments if x not in live]
+        self._segments = [x for x in self._segments if x in live]
+        return self._semaphore.run(threads.deferToThread,
+                                   self._write_checkpoint,
+                                   dict(self._marks), dead)
+
+    ### methods run in the thread ###
+
+    def _load(self):
+        '''
+        Reads the checkpoint and the indexes of all the segments.
+        Returns a tuple of ([segment], [IndexEntry], marks).
+
+        BEWARE: This method runs in a thread.
+        '''
+        directory, basename = os.path.split(os.path.abspath(self._filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        pattern = re.compile(re.escape(basename) + r'\.(\d{8})$')
+        matches = filter(None, map(pattern.match, os.listdir(directory)))
+        segments = sorted(int(x.group(1)) for x in matches)
+
+        marks = dict()
+        try:
+            with open(self._checkpoint_path(), 'r') as f:
+                values = map(int, f.read().split())
+            marks[_JOURNAL_ENTRY] = tuple(values[0:2])
+            marks[_LOG_ENTRY] = tuple(values[2:4])
+        except (IOError, ValueError):
+            pass
+
+        entries = list()
+        for segment in segments:
+            entries.extend(self._load_segment(segment))
+        return segments, entries, marks
+
+    def _load_segment(self, segment):
+        '''
+        Loads the index of the segment. The records which are not in the
+        index are recovered from the segment file, the truncated data
+        at the end of the files is removed.
+
+        BEWARE: This method runs in a thread.
+        '''
+        entries = list()
+        pos = 0
+        index_path = self._index_path(segment)
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                data = f.read()
+            size = os.path.getsize(self._segment_path(segment))
+            while True:
+                unpacked = IndexEntry.unpack_from(segment, data, pos)
+                if unpacked is None:
+                    break
+                entry, end = unpacked
+                if entry.offset + entry.length > size:
+                    # the index got ahead of the segment data, the new
+                    # records would be written where this entry points
+                    self.warning("The index %s points past the end of "
+                                 "the segment at %d.", index_path, pos)
+                    break
+                entries.append(entry)
+                pos = end
+            if pos < len(data):
+                self.warning("Truncating the broken index file %s at %d.",
+                             index_path, pos)
+                with open(index_path, 'r+b') as f:
+                    f.truncate(pos)
+
+        start = entries[-1].offset + entries[-1].length if entries else 0
+        recovered = self._scan_segment(segment, start)
+        if recovered:
+            self.info("Recovered %d entries missing in the index %s.",
+                      len(recovered), index_path)
+            with open(index_path, 'ab') as f:
+                f.write(''.join(x.pack() for x in recovered))
+        return entries + recovered
+
+    def _scan_segment(self, segment, offset):
+        '''
+        Reads the records of the segment starting from the offset.
+
+        BEWARE: This method runs in a thread.
+        '''
+        path = self._segment_path(segment)
+        entries = list()
+        with open(path, 'r+b') as f:
+            while True:
+                f.seek(offset)
+                try:
+                    type, values, length = self._read_record(f)
+                except EOFError:
+                    break
+                except ValueError as e:
+                    self.warning("Truncating the segment %s at %d: %s.",
+                                 path, offset, e)
+                    f.truncate(offset)
+                    break
+                data = dict(zip(_ENTRY_FIELDS[type], values))
+                entries.append(self._index_entry(
+                    type, segment, offset, length, data))
+                offset += length
+        return entries
+
+    def _write_entries(self, entries):
+        '''
+        Appends the records to the segment and the index files, rotates
+        the segment if it gets too big.
+        Returns a tuple ([IndexEntry], segment, segment size).
+
+        BEWARE: This method runs in a thread.
+        '''
+        written = list()
+        segment = self._segment
+        size = self._segment_size
+        pending = list()
+        data_file = open(self._segment_path(segment), 'ab')
+        try:
+            for data in entries:
+                if size >= self.max_segment_size:
+                    self._write_index(data_file, segment, pending)
+                    data_file.close()
+                    segment += 1
+                    size = 0
+                    pending = list()
+                    data_file = open(self._segment_path(segment), 'ab')
+                type = _ENTRY_TYPES[data['entry_type']]
+                record = self._pack_record(type, data)
+                data_file.write(record)
+                entry = self._index_entry(type, segment, size,
+                                          len(record), data)
+                size += len(record)
+                pending.append(entry)
+                written.append(entry)
+            self._write_index(data_file, segment, pending)
+        finally:
+            data_file.close()
+        return written, segment, size
+
+    def _write_index(self, data_file, segment, entries):
+        '''
+        Appends the entries to the index of the segment once the records
+        they point to are on the disk, so the index is never ahead of
+        the segment data.
+
+        BEWARE: This method runs in a thread.
+        '''
+        data_file.flush()
+        os.fsync(data_file.fileno())
+        if not entries:
+            return
+        with open(self._index_path(segment), 'ab') as f:
+            f.write(''.join(x.pack() for x in entries))
+
+    def _read_entries(self, index):
+        '''
+        Reads and decodes the records pointed by the index entries.
+
+        BEWARE: This method runs in a thread.
+        '''
+        return [data for _, data in self._iter_records(index)]
+
+    def _read_log_page(self, index, matches, limit):
+        '''
+        Reads the records pointed by the index entries until the limit
+        of the ones accepted by the filter is reached.
+
+        BEWARE: This method runs in a thread.
+        '''
+        result = list()
+        cursor = None
+        for entry, data in self._iter_records(index):
+            if not matches(data):
+                continue
+            if len(result) == limit:
+                break
+            result.append(data)
+            cursor = (entry.timestamp, entry.position)
+        else:
+            cursor = None
+        return result, cursor
+
+    def _iter_records(self, index):
+        '''
+        Generates the tuples (index entry, decoded record).
+
+        BEWARE: This method runs in a thread.
+        '''
+        files = dict()
+        try:
+            for entry in index:
+                if entry.segment not in files:
+                    files[entry.segment] = open(
+                        self._segment_path(entry.segment), 'rb')
+                f = files[entry.segment]
+                f.seek(entry.offset)
+                type, values, _ = self._read_record(f)
+                data = dict(zip(_ENTRY_FIELDS[type], values))
+                if type == _JOURNAL_ENTRY:
+                    data['entry_type'] = 'journal'
+                else:
+                    data['entry_type'] = 'log'
+                    data['hostname'] = self._hostname
+                yield entry, data
+        finally:
+            for f in files.itervalues():
+                f.close()
+
+    def _write_checkpoint(self, marks, dead):
+        '''
+        BEWARE: This method runs in a thread.
+        '''
+        path = self._checkpoint_path()
+        with open(path + '.tmp', 'w') as f:
+            f.write("%d %d %d %d\n" % (marks[_JOURNAL_ENTRY] +
+                                       marks[_LOG_ENTRY]))
+        os.rename(path + '.tmp', path)
+        for segment in dead:
+            self.debug("Removing segment %d, all entries have been deleted",
+                       segment)
+            for path in (self._segment_path(segment),
+                         self._index_path(segment)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _index_entry(self, type, segment, offset, length, data):
+        if type == _JOURNAL_ENTRY:
+            agent_id = data['agent_id']
+            if isinstance(agent_id, str):
+                agent_id = agent_id.decode('utf-8')
+            instance_id = data['instance_id']
+        else:
+            agent_id, instance_id = u'', 0
+        return IndexEntry(type, segment, offset, length,
+                          float(data['timestamp']), agent_id, instance_id)
+
+    def _pack_record(self, type, data):
+        payload = _pack_fields([data.get(x) for x in _ENTRY_FIELDS[type]])
+        payload = chr(type) + payload
+        flags = 0
+        if self._compress and len(payload) > _COMPRESS_THRESHOLD:
+            compressed = zlib.compress(payload)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= _RECORD_COMPRESSED
+        checksum = zlib.crc32(payload) & 0xffffffff
+        return _RECORD_HEADER.pack(len(payload), checksum, flags) + payload
+
+    def _read_record(self, f):
+        '''
+        Reads the record from the current position of the file.
+        Returns tuple (entry type, [values], length of the record).
+        Raises EOFError if there is no more data and ValueError if the
+        record is truncated or corrupted.
+        '''
+        header = f.read(_RECORD_HEADER.size)
+        if not header:
+            raise EOFError()
+        if len(header) < _RECORD_HEADER.size:
+            raise ValueError("truncated header")
+        length, checksum, flags = _RECORD_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            raise ValueError("truncated record")
+        if zlib.crc32(payload) & 0xffffffff != checksum:
+            raise ValueError("checksum mismatch")
+        if flags & _RECORD_COMPRESSED:
+            payload = zlib.decompress(payload)
+        type = ord(payload[0])
+        if type not in _ENTRY_FIELDS:
+            raise ValueError("unknown entry type %r" % (type, ))
+        return type, _unpack_fields(payload[1:]), _RECORD_HEADER.size + length
+
+
+def _bisect_index(index, position):
+    '''
+    Returns the offset of the first entry of the index (sorted in the order
+    of writing) placed after the given position.
+    '''
+    lo, hi = 0, len(index)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if index[mid].position <= position:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _log_filter(filters):
+    '''
+    Returns the callable telling if the log entry passes any of the filters
+    in the format used by IJournalReader.get_log_entries().
+    '''
+
+    def matches(entry):
+        if not filters:
+            return True
+        for condition in filters:
+            level = condition.get('level', None)
+            if level is None:
+                raise AttributeError("level is mandatory parameter.")
+            if entry['level'] > int(level):
+                continue
+            category = condition.get('category', None)
+            if category is not None and entry['category'] != category:
+                continue
+            name = condition.get('name', None)
+            if name is not None and entry['log_name'] != name:
+                continue
+            return True
+        return False
+
+    return matches
+
+
+def _pack_fields(values):
+    '''
+    Packs the list of basic values (None, int, float, str and unicode)
+    into the string. Every value is prefixed by its type code.
+    '''
+    parts = list()
+    for value in values:
+        if value is None:
+            parts.append('N')
+        elif isinstance(value, (int, long)):
+            parts.append('q' + struct.pack('!q', value))
+        elif isinstance(value, float):
+            parts.append('d' + struct.pack('!d', value))
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+            parts.append('u' + struct.pack('!I', len(value)) + value)
+        elif isinstance(value, str):
+            parts.append('s' + struct.pack('!I', len(value)) + value)
+        else:
+            raise TypeError("Cannot pack value %r to the journal record"
+                            % (value, ))
+    return ''.join(parts)
+
+
+def _unpack_fields(data):
+    values = list()
+    pos = 0
+    while pos < len(data):
+        code = data[pos]
+        pos += 1
+        if code == 'N':
+            values.append(None)
+        elif code == 'q':
+            values.append(struct.unpack_from('!q', data, pos)[0])
+            pos += 8
+        elif code == 'd':
+            values.append(struct.unpack_from('!d', data, pos)[0])
+            pos += 8
+        elif code in ('s', 'u'):
+            size = struct.unpack_from('!I', data, pos)[0]
+            pos += 4
+            value = data[pos:pos + size]
+            if code == 'u':
+                value = value.decode('utf-8')
+            values.append(value)
+            pos += size
+        else:
+            raise ValueError("Unknown type code %r in journal record"
+                             % (code, ))
+    return values
+
+
+class Record(object):
+    implements(IRecord)
+
+    def __init__(self, journaler):
+        self._journaler = journaler
+
+    def commit(self, **data):
+        data['entry_type'] = 'journal'
+        self._journaler.insert_entry(**data)
+
+
+class JournalerConnection(log.Logger, log.LogProxy):
+    implements(IJournalerConnection)
+
+    def __init__(self, journaler, externalizer):
+        log.LogProxy.__init__(self, journaler)
+        log.Logger.__init__(self, self)
+
+        # Entries are trees, agent snapshots are not
+        self.serializer = banana.Serializer(externalizer=externalizer,
+                                            track_references=False)
+        self.snapshot_serializer = banana.Serializer()
+        self.journaler = IJournaler(journaler)
+
+    ### IJournalerConnection ###
+
+    def new_entry(self, agent_id, instance_id, journal_id, function_id,
+                  *args, **kwargs):
+        record = self.journaler.prepare_record()
+        entry = AgencyJournalEntry(
+            self.serializer, record, agent_id, instance_id,
+            journal_id, function_id, *args, **kwargs)
+        return entry
+
+    def snapshot(self, agent_id, instance_id, snapshot):
+        record = self.journaler.prepare_record()
+        entry = AgencyJournalEntry(
+            self.snapshot_serializer, record, agent_id, instance_id,
+            'agency', 'snapshot', snapshot)
+        entry.set_result(None)
+        entry.commit()
+        f = entry.get_result()
+        if f:
+            self.error('Error snapshoting the agent: %r. It will produce '
+                       'manlformed snapshot.', f.trigger_param)
+
+
+class AgencyJournalSideEffect(object):
+
+    implements(IJournalSideEffect)
+
+    ### IJournalSideEffect ###
+
+    def __init__(self, serializer, record, function_id, *args, **kwargs):
+        self._serializer = serializer
+        self._record = record
+        self._fun_id = function_id
+        self._args = serializer.freeze(args or tuple())
+        self._kwargs = serializer.freeze(kwargs or dict())
+        self._effects = []
+        self._result = None
+
+    ### IJournalSideEffect Methods ###
+
+    def add_effect(self, effect_id, *args, **kwargs):
+        assert self._record is not None
+        data = (effect_id,
+                self._serializer.convert(args),
+                self._serializer.convert(kwargs))
+        self._effects.append(data)
+
+    def set_result(self, result):
+        assert self._record is not None
+        self._result = self._serializer.convert(result)
+        return self
+
+    def commit(self):
+        assert self._record is not None
+        data = (self._fun_id, self._args, self._kwargs,
+                self._effects, self._result)
+        self._record.extend(data)
+        self._record = None
+        return self
+
+
+class History(formatable.Formatable, pb.Copyable):
+    '''
+    Mapping for objects in history database.
+    '''
+
+    formatable.field('history_id', None)
+    formatable.field('agent_id', None)
+    formatable.field('instance_id', None)
     formatable.field('hostname', None)
 
 
@@ -1548,22 +2617,7 @@ class PostgresReader(log.Logger, log.LogProxy, common.StateMachineMixin,
         if not self._ensure_state(State.connected):
             return
 
-        if not isinstance(history, History):
-            raise AttributeError(
-                'First paremeter is expected to be History instance, got %r'
-                % history)
-
-        command = text_helper.format_block("""
-        SELECT agent_id, instance_id, journal_id, function_id, fiber_id,
-               fiber_depth, args, kwargs, side_effects, result,
-               date_part('epoch', timestamp)
-          FROM feat.entries
-          WHERE agent_id = %s AND instance_id = %s""")
-        params = (history.agent_id, history.instance_id)
-        if start_date:
-            command += " AND date_part('epoch', timestamp) >= %s"
-            params += (start_date, )
-
+        command, params = self._entries_query(history, start_date)
         command += " ORDER BY timestamp, entries.id"
         if limit:
             command += " LIMIT %s"
@@ -1572,6 +2626,25 @@ class PostgresReader(log.Logger, log.LogProxy, common.StateMachineMixin,
         d.addCallback(self._decode, entry_type='journal')
         return d
 
+    def get_entries_page(self, history, after=None, start_date=0,
+                         limit=1000):
+        '''
+        See feat.agencies.interface.IJournalReader.get_entries_page.
+        The cursor is the tuple (timestamp, id) of the last entry of the page.
+        '''
+        if not self._ensure_state(State.connected):
+            return
+
+        command, params = self._entries_query(history, start_date)
+        if after is not None:
+            command += " AND (timestamp, entries.id) > (%s, %s)"
+            params += tuple(after)
+        command += " ORDER BY timestamp, entries.id LIMIT %s"
+        params += (limit + 1, )
+        d = self._db.runQuery(command, params)
+        d.addCallback(self._decode_page, limit, 'journal')
+        return d
+
     def get_log_hostnames(self, start_date=None, end_date=None):
         query = "SELECT hostname FROM feat.hosts WHERE true"
         query, params = self._add_timestamp_condition_sql(
@@ -1589,54 +2662,34 @@ class PostgresReader(log.Logger, log.LogProxy, common.StateMachineMixin,
         if not self._ensure_state(State.connected):
             return
 
-
-        query = text_helper.format_block("""
-        SELECT hosts.hostname, message, level, category, log_name,
-               file_path, line_num, date_part('epoch', timestamp)
-          FROM feat.logs
-          LEFT JOIN feat.hosts ON logs.host_id = hosts.id
-          WHERE true
-        """)
-        query, params = self._add_timestamp_condition_sql(
-            query, tuple(), start_date, end_date)
-
-        def transform_filter(filter):
-            params = tuple()
-
-            level = filter.get('level', None)
-            category = filter.get('category', None)
-            name = filter.get('name', None)
-            hostname = filter.get('hostname', None)
-            if level is None:
-                raise AttributeError("level is mandatory parameter.")
-            resp = "(level <= %s"
-            params += (level, )
-            if hostname is not None:
-                resp += " AND hosts.hostname = %s"
-                params += (hostname, )
-            if category is not None:
-                resp += " AND category = %s"
-                params += (category, )
-            if name is not None:
-                resp += " AND log_name = %s"
-                params += (name, )
-            resp += ')'
-            return resp, params
-
-        parsed_filters = map(transform_filter, filters)
-        if parsed_filters:
-            filter_strings = [x[0] for x in parsed_filters]
-            query += " AND (" + ' OR '.join(filter_strings) + ')'
-            filter_params = [x[1] for x in parsed_filters]
-            params += reduce(lambda x, y: x + y, filter_params)
+        query, params = self._log_entries_query(start_date, end_date, filters)
+        query += " ORDER BY timestamp, logs.id"
         if limit:
             query += " LIMIT %s"
             params += (limit, )
-        query += " ORDER BY timestamp, logs.id"
         d = self._db.runQuery(query, params)
         d.addCallback(self._decode, entry_type='log')
         return d
 
+    def get_log_entries_page(self, start_date=None, end_date=None,
+                             filters=list(), after=None, limit=1000):
+        '''
+        See feat.agencies.interface.IJournalReader.get_log_entries_page.
+        The cursor is the tuple (timestamp, id) of the last entry of the page.
+        '''
+        if not self._ensure_state(State.connected):
+            return
+
+        query, params = self._log_entries_query(start_date, end_date, filters)
+        if after is not None:
+            query += " AND (timestamp, logs.id) > (%s, %s)"
+            params += tuple(after)
+        query += " ORDER BY timestamp, logs.id LIMIT %s"
+        params += (limit + 1, )
+        d = self._db.runQuery(query, params)
+        d.addCallback(self._decode_page, limit, 'log')
+        return d
+
     def delete_top_log_entries(self, num):
         if not self._ensure_state(State.connected):
             return
@@ -1707,40 +2760,100 @@ class PostgresReader(log.Logger, log.LogProxy, common.StateMachineMixin,
 
     ### private helper used by querying functions ###
 
+    def _entries_query(self, history, start_date):
+        if not isinstance(history, History):
+            raise AttributeError(
+                'First paremeter is expected to be History instance, got %r'
+                % history)
+
+        # The raw timestamp and the id are selected last to be used
+        # as the cursor of the page, the decoding ignores them.
+        command = text_helper.format_block("""
+        SELECT agent_id, instance_id, journal_id, function_id, fiber_id,
+               fiber_depth, args, kwargs, side_effects, result,
+               date_part('epoch', timestamp), timestamp, entries.id
+          FROM feat.entries
+          WHERE agent_id = %s AND instance_id = %s""")
+        params = (history.agent_id, history.instance_id)
+        if start_date:
+            command += " AND date_part('epoch', timestamp) >= %s"
+            params += (start_date, )
+        return command, params
+
+    def _log_entries_query(self, start_date, end_date, filters):
+        query = text_helper.format_block("""
+        SELECT hosts.hostname, message, level, category, log_name,
+               file_path, line_num, date_part('epoch', timestamp),
+               timestamp, logs.id
+          FROM feat.logs
+          LEFT JOIN feat.hosts ON logs.host_id = hosts.id
+          WHERE true
+        """)
+        query, params = self._add_timestamp_condition_sql(
+            query, tuple(), start_date, end_date)
+
+        def transform_filter(filter):
+            params = tuple()
+
+            level = filter.get('level', None)
+            category = filter.get('category', None)
+            name = filter.get('name', None)
+            hostname = filter.get('hostname', None)
+            if level is None:
+                raise AttributeError("level is mandatory parameter.")
+            resp = "(level <= %s"
+            params += (level, )
+            if hostname is not None:
+                resp += " AND hosts.hostname = %s"
+                params += (hostname, )
+            if category is not None:
+                resp += " AND category = %s"
+                params += (category, )
+            if name is not None:
+                resp += " AND log_name = %s"
+                params += (name, )
+            resp += ')'
+            return resp, params
+
+        parsed_filters = map(transform_filter, filters)
+        if parsed_filters:
+            filter_strings = [x[0] for x in parsed_filters]
+            query += " AND (" + ' OR '.join(filter_strings) + ')'
+            filter_params = [x[1] for x in parsed_filters]
+            params += reduce(lambda x, y: x + y, filter_params)
+        return query, params
+
     def _decode(self, entries, entry_type):
         '''
         Takes the list of rows returned by postgres.
         Returns rows in readable format. Transforms tuples into dictionaries,
         and appends information about entry type to the rows.
         '''
-
-        def decode_blobs(row):
-            row = list(row)
-            for index, value in zip(range(len(row)), row):
-                if isinstance(value, types.BufferType):
-                    value = str(value)
-                    row[index] = value
-            return row
-
-        decoded = map(decode_blobs, entries)
         if entry_type == 'log':
-            mapping = ['hostname', 'message', 'level', 'category',
-                       'log_name', 'file_path', 'line_num', 'timestamp']
+            mapping = _LOG_FIELDS
         elif entry_type == 'journal':
-            mapping = ['agent_id', 'instance_id', 'journal_id', 'function_id',
-                       'fiber_id', 'fiber_depth', 'args', 'kwargs',
-                       'side_effects', 'result', 'timestamp']
+            mapping = _JOURNAL_FIELDS
         else:
             raise ValueError('Unknown entry_type %r' % (entry_type, ))
 
-        def parse(row, mapping, entry_type):
-            resp = dict(zip(mapping, row))
-            resp['entry_type'] = entry_type
-            return resp
-
-        parsed = [parse(row, mapping, entry_type) for row in decoded]
+        buffer_type = types.BufferType
+        parsed = []
+        for row in entries:
+            resp = {'entry_type': entry_type}
+            for name, value in zip(mapping, row):
+                if isinstance(value, buffer_type):
+                    value = str(value)
+                resp[name] = value
+            parsed.append(resp)
         return parsed
 
+    def _decode_page(self, rows, limit, entry_type):
+        cursor = None
+        if len(rows) > limit:
+            del rows[limit:]
+            cursor = tuple(rows[-1][-2:])
+        return self._decode(rows, entry_type), cursor
+
     def _add_timestamp_condition_sql(self, query, params,
                                      start_date, end_date):
         if start_date is not None:
@@ -1769,6 +2882,9 @@ def parse_connstr(conn):
         if resp['protocol'] == 'sqlite':
             klass = SqliteWriter
             params = dict(filename=resp['host'], encoding='zip')
+        elif resp['protocol'] == 'file':
+            klass = FileWriter
+            params = dict(filename=resp['host'])
         elif resp['protocol'] == 'postgres':
             klass = PostgresWriter
             host, dbname = resp['host'].split('/')
@@ -53,11 +53,29 @@ class BaseMessage(formatable.Formatable):
     formatable.field('expiration_time', None)
     formatable.field('payload', dict())
 
+    # Message classes whose payload is never modified once the message
+    # has been posted can set this to True; their clones then share
+    # the payload instead of deep-copying it.
+    shared_payload = False
+
     def clone(self):
         """Returns an exact copy of the message.
         KNOW WAT YOU ARE DOING, some special fields
         SHOULD NOT be the same in different messages."""
-        return copy.deepcopy(self)
+        if not self.shared_payload:
+            return copy.deepcopy(self)
+
+        # Structural clone, only copy the mutable fields of the envelope
+        cls = type(self)
+        msg = cls.__new__(cls)
+        msg.__dict__.update(self.__dict__)
+        for field in self._fields:
+            if field.name == 'payload':
+                continue
+            value = getattr(self, field.name)
+            if not isinstance(value, _immutable_types):
+                setattr(msg, field.name, copy.deepcopy(value))
+        return msg
 
     def duplicate(self):
         """Returns a duplicate of the message safe to modify
@@ -228,3 +246,9 @@ class FinalReport(ContractMessage):
 class Notification(BaseMessage, FirstMessageMixin):
 
     formatable.field('protocol_type', 'Notification')
+
+
+### private ###
+
+_immutable_types = (str, unicode, int, long, float, bool, type(None),
+                    serialization.ImmutableSerializable)
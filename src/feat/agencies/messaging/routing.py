@@ -1,4 +1,3 @@
-import operator
 
 from zope.interface import implements
 
@@ -33,8 +32,7 @@ class Route(object):
     def match(self, message):
         if not isinstance(message, BaseMessage):
             raise AttributeError("Expected BaseMessage got %r" % (message, ))
-        msg_key = (message.recipient.key, message.recipient.route)
-        return msg_key == self.key
+        return get_message_key(message) == self.key
 
     def __repr__(self):
         return ("<Route: key=%s, priority=%d, final=%r, sink=%s>" %
@@ -62,7 +60,9 @@ class Table(log.Logger):
     def __init__(self, logger, time_provider=None):
         log.Logger.__init__(self, logger)
 
-        self._routes = list()
+        # Routes are indexed by key, each bucket sorted by priority
+        self._routes = {} # {(KEY, SHARD): [Route]}
+        self._sinks = {} # {SINK: [Route]}
         self._outgoing_sink = None
 
         self._time_provider = time_provider and ITimeProvider(time_provider)
@@ -97,19 +97,34 @@ class Table(log.Logger):
         for message in to_deliver:
                 self._send_to_route(message, route)
 
-        self._routes.append(route)
-        self._fix_order()
+        bucket = self._routes.setdefault(route.key, [])
+        # Keep the insertion order of routes with the same priority
+        index = len(bucket)
+        while index > 0 and bucket[index - 1].priority > route.priority:
+            index -= 1
+        bucket.insert(index, route)
+        self._sinks.setdefault(route.owner, []).append(route)
 
     def remove_route(self, route):
         try:
-            self._routes.remove(route)
+            bucket = self._routes.get(route.key, [])
+            bucket.remove(route)
         except ValueError:
             self.warning("Trying to remove nonexisting route: %r", route)
+            return
+
+        if not bucket:
+            del self._routes[route.key]
+
+        routes = self._sinks.get(route.owner)
+        if routes is not None:
+            routes.remove(route)
+            if not routes:
+                del self._sinks[route.owner]
 
     def remove_sink(self, sink):
-        for route in self._routes:
-            if route.owner == sink:
-                self.remove_route(route)
+        for route in list(self._sinks.get(sink, [])):
+            self.remove_route(route)
 
         if self._outgoing_sink == sink:
             self.info("Outgoing sink removed, setting to None.")
@@ -117,10 +132,11 @@ class Table(log.Logger):
 
     def dispatch(self, message, outgoing=True):
 
-        for route in self._routes:
-            self.log("Analizing route %r, matching=%r", route,
-                     route.match(message))
-            if route.match(message):
+        routes = self._routes.get(get_message_key(message))
+        if routes:
+            # Sinks may change the routes while handling the message
+            for route in list(routes):
+                self.log("Matching route %r", route)
                 self._send_to_route(message, route)
                 if route.final:
                     return
@@ -134,10 +150,6 @@ class Table(log.Logger):
 
     ### private ###
 
-    def _fix_order(self):
-        self._routes = sorted(self._routes,
-                              key=operator.attrgetter('priority'))
-
     def _send_to_route(self, message, route):
         message = message.clone()
         route.owner.on_message(message)
@@ -151,6 +163,9 @@ class MessageStore(object):
 
     def __init__(self, time_provider):
         self._store = container.ExpDict(time_provider)
+        # Message identifiers by key, may reference expired messages
+        self._keys = {} # {(KEY, SHARD): set([MESSAGE_ID])}
+        self._indexed = 0
 
     def insert(self, message):
         if not isinstance(message, BaseMessage):
@@ -160,6 +175,15 @@ class MessageStore(object):
         if message.expiration_time is not None:
             self._store.set(message.message_id, message,
                             message.expiration_time)
+            if message.message_id not in self._store:
+                # Already expired
+                return
+            ids = self._keys.setdefault(get_message_key(message), set())
+            if message.message_id not in ids:
+                ids.add(message.message_id)
+                self._indexed += 1
+                if self._indexed > 2 * self._store.size() + 100:
+                    self._reindex()
 
     def remove(self, message):
         if not isinstance(message, BaseMessage):
@@ -171,7 +195,36 @@ class MessageStore(object):
         if not isinstance(route, Route):
             raise TypeError('Expected Route got %r' % (route, ))
 
-        matching = [x for x in self._store.itervalues() if route.match(x)]
+        ids = self._keys.pop(route.key, None)
+        if not ids:
+            return []
+
+        self._indexed -= len(ids)
+        matching = []
+        for message_id in ids:
+            message = self._store.get(message_id)
+            # The message could have expired or been replaced
+            if message is not None and route.match(message):
+                matching.append(message)
+
         if route.final:
             [self.remove(x) for x in matching]
+        else:
+            self._keys[route.key] = set(x.message_id for x in matching)
+            self._indexed += len(matching)
         return matching
+
+    ### private ###
+
+    def _reindex(self):
+        self._keys.clear()
+        self._indexed = 0
+        for message_id, message in self._store.iteritems():
+            key = get_message_key(message)
+            self._keys.setdefault(key, set()).add(message_id)
+            self._indexed += 1
+
+
+def get_message_key(message):
+    recp = message.recipient
+    return recp.key, recp.route
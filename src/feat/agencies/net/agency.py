@@ -72,7 +72,12 @@ class Startup(agency.Startup):
         assert isinstance(dbc, config.DbConfig), str(type(dbc))
         self._db = driver.Database(dbc.host, int(dbc.port), dbc.name,
                                    dbc.username, dbc.password,
-                                   https=dbc.https)
+                                   https=dbc.https,
+                                   multiplex_changes=dbc.multiplex_changes,
+                                   follow_changes=dbc.follow_changes,
+                                   cache_size=dbc.cache_size,
+                                   cache_policy=dbc.cache_policy,
+                                   stale_until_warm=dbc.stale_until_warm)
         self._journaler = journaler.Journaler(
             on_rotate_cb=self.friend._force_snapshot_agents,
             on_switch_writer_cb=self.friend._on_journal_writer_switch,
@@ -526,8 +531,9 @@ class Agency(agency.Agency):
     @manhole.expose()
     def show_connections(self):
         t = text_helper.Table(
-            fields=("Connection", "Connected", "Host", "Port", "Reconnect in"),
-            lengths=(20, 15, 30, 10, 15))
+            fields=("Connection", "Connected", "Host", "Port", "Reconnect in",
+                    "Cache"),
+            lengths=(20, 15, 30, 10, 15, 20))
         connections = [self._database, self._messaging]
         iterator = (x.show_connection_status() for x in connections)
         return t.render(iterator)
@@ -45,6 +45,11 @@ class DbConfig(formatable.Formatable):
     formatable.field('username', None)
     formatable.field('password', None)
     formatable.field('https', False)
+    formatable.field('multiplex_changes', False)
+    formatable.field('follow_changes', False)
+    formatable.field('cache_size', None)
+    formatable.field('cache_policy', None)
+    formatable.field('stale_until_warm', False)
 
 
 @register
@@ -30,6 +30,7 @@ from feat.configure import configure
 from feat.agencies.net.broker import DEFAULT_SOCKET_PATH
 from feat.database.driver import DEFAULT_DB_HOST, DEFAULT_DB_PORT
 from feat.database.driver import DEFAULT_DB_NAME
+from feat.database.driver import DEFAULT_DB_CACHE_SIZE, DEFAULT_DB_CACHE_POLICY
 
 DEFAULT_MSG_HOST = "localhost"
 DEFAULT_MSG_PORT = 5672
@@ -217,6 +218,27 @@ def add_db_options(parser):
     group.add_option('--dbhttps', dest="db_https",
                      help="Use SSL connection",
                      default=False, action="store_true")
+    group.add_option('--dbmultiplex', dest="db_multiplex_changes",
+                     help=("Use a single changes feed for all the "
+                           "notification filters"),
+                     default=False, action="store_true")
+    group.add_option('--dbfollow', dest="db_follow_changes",
+                     help=("Follow the changes feed to avoid revalidating "
+                           "the cached responses"),
+                     default=False, action="store_true")
+    group.add_option('--dbcachesize', dest="db_cache_size",
+                     help=("desired size of the response cache in bytes "
+                           "(default: %s)" % DEFAULT_DB_CACHE_SIZE),
+                     metavar="BYTES", type="int")
+    group.add_option('--dbcachepolicy', dest="db_cache_policy",
+                     help=("policy used to evict the cached responses, "
+                           "lru or slru (default: %s)"
+                           % DEFAULT_DB_CACHE_POLICY),
+                     metavar="POLICY", choices=("lru", "slru"))
+    group.add_option('--dbstaleuntilwarm', dest="db_stale_until_warm",
+                     help=("Query the views with stale=update_after until "
+                           "their indexes are up to date"),
+                     default=False, action="store_true")
     parser.add_option_group(group)
 
 
@@ -25,7 +25,8 @@ import sys
 
 from zope.interface import implements, classProvides
 
-from feat.common import serialization, log, text_helper, deep_compare, error
+from feat.common import (serialization, log, text_helper, deep_compare,
+                         error, defer, )
 from feat.agents.base import replay
 from feat.common.serialization import banana
 
@@ -97,6 +98,26 @@ def side_effect_as_string(*args):
     return text + ": " + repr(result)
 
 
+@defer.inlineCallbacks
+def replay_history(reader, history, page_size=1000):
+    '''
+    Replays the history of the single agent reading its journal entries
+    from the IJournalReader page by page, so that only a single page
+    is kept in memory at a time. Returns the Replay instance.
+    '''
+    result = Replay(iter([]), history.agent_id)
+    cursor = None
+    while True:
+        entries, cursor = yield reader.get_entries_page(
+            history, after=cursor, limit=page_size)
+        result.journal = iter(entries)
+        for entry in result:
+            entry.apply()
+        if cursor is None:
+            break
+    defer.returnValue(result)
+
+
 class JournalReplayEntry(object):
 
     implements(IJournalReplayEntry)
@@ -305,15 +326,13 @@ class JournalReplayEntry(object):
             raise ReplayError("Side-effect %s called instead of %s"
                               % (unexpected_desc, expected_desc))
 
-        frozen_args = self._replay.serializer.freeze(args)
-        if exp_args != frozen_args:
+        if not self._frozen_equal(exp_args, args):
             unexpected_desc = current_effect_as_string()
             expected_desc = expected_effect_as_string(raw_side_effect)
             raise ReplayError("Bad side-effect arguments in %s, expecting %s."
                               % (unexpected_desc, expected_desc))
 
-        kwargs = self._replay.serializer.freeze(kwargs)
-        if exp_kwargs != kwargs:
+        if not self._frozen_equal(exp_kwargs, kwargs):
             unexpected_desc = current_effect_as_string()
             expected_desc = expected_effect_as_string(raw_side_effect)
             raise ReplayError("Bad side-effect keywords in %s, "
@@ -326,6 +345,15 @@ class JournalReplayEntry(object):
 
         return self._replay.unserializer.convert(result)
 
+    ### private ###
+
+    def _frozen_equal(self, expected, value):
+        if expected == self._replay.serializer.freeze(value):
+            return True
+        # journals written before the entries stopped tracking references
+        # freeze the values referenced more than once differently
+        return expected == self._replay.tracking_serializer.freeze(value)
+
 
 class Replay(log.LogProxy, log.Logger):
     '''
@@ -343,7 +371,10 @@ class Replay(log.LogProxy, log.Logger):
 
         self.journal = journal
         self.unserializer = banana.Unserializer(externalizer=self)
-        self.serializer = banana.Serializer(externalizer=self)
+        # Must freeze the same way than the journaler entries
+        self.serializer = banana.Serializer(externalizer=self,
+                                            track_references=False)
+        self.tracking_serializer = banana.Serializer(externalizer=self)
         self.inject_dummy_externals = inject_dummy_externals
 
         self.agent_type = None
@@ -712,6 +743,10 @@ class Connection(BaseReplayDummy):
     def save_document(self, doc):
         raise RuntimeError('save_document() should never be called!')
 
+    @serialization.freeze_tag('IDatabaseClient.save_documents')
+    def save_documents(self, docs):
+        raise RuntimeError('save_documents() should never be called!')
+
     @serialization.freeze_tag('IDatabaseClient.get_attachment_body')
     def get_attachment_body(self, attachment):
         raise RuntimeError('get_attachment_body() should never be called!')
@@ -749,6 +784,10 @@ class Connection(BaseReplayDummy):
     def query_view(self, factory, **options):
         raise RuntimeError('This should never be called!')
 
+    @serialization.freeze_tag('IDatabaseClient.is_view_warm')
+    def is_view_warm(self, factory):
+        raise RuntimeError('is_view_warm() should never be called!')
+
     @serialization.freeze_tag('IDatabaseClient.disconnect')
     @replay.named_side_effect('IDatabaseClient.disconnect')
     def disconnect(self):
@@ -887,6 +926,10 @@ class AgencyAgent(BaseReplayDummy):
     def save_document(self, document):
         raise RuntimeError('This should never be called!')
 
+    @serialization.freeze_tag('AgencyAgency.save_documents')
+    def save_documents(self, documents):
+        raise RuntimeError('This should never be called!')
+
     @serialization.freeze_tag('AgencyAgency.reload_document')
     def reload_document(self, document):
         raise RuntimeError('This should never be called!')
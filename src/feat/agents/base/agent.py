@@ -479,6 +479,10 @@ class BaseAgent(mro.FiberMroMixin, log.Logger, log.LogProxy, replay.Replayable,
     def save_document(self, state, doc):
         return fiber.wrap_defer(state.medium.save_document, doc)
 
+    @replay.immutable
+    def save_documents(self, state, docs):
+        return fiber.wrap_defer(state.medium.save_documents, docs)
+
     @replay.immutable
     def update_document(self, state, doc_or_id, *args, **kwargs):
         db = state.medium.get_database()
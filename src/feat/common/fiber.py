@@ -21,6 +21,7 @@
 # Headers in this file shall remain intact.
 import os
 import sys
+import threading
 import uuid
 import warnings
 import traceback
@@ -210,12 +211,68 @@ def woven(fun):
     def wrapper(*args, **kwargs):
         section = WovenSection()
         section.enter()
-        result = fun(*args, **kwargs)
+        try:
+            result = fun(*args, **kwargs)
+        except:
+            section.abort()
+            raise
         return section.exit(result)
 
     return wrapper
 
 
+### Explicit context stack ###
+
+# The state of the woven sections is propagated through the stack of
+# context dictionaries pushed and popped by WovenSection.enter/exit
+# and by push_context/pop_context. A context is the explicit equivalent
+# of the locals of the frame used by get_stack_var(): the lookup stops
+# at the first context defining SECTION_BOUNDARY_TAG.
+# The contexts MUST be popped in reverse order, inside the same
+# synchronous call they were pushed in.
+
+
+class _ContextStack(threading.local):
+
+    def __init__(self):
+        self.contexts = []
+
+
+_context_stack = _ContextStack()
+
+
+def push_context(**values):
+    '''Pushes a new context with the given values, returns its index
+    to be passed to pop_context().'''
+    contexts = _context_stack.contexts
+    contexts.append(values)
+    return len(contexts) - 1
+
+
+def pop_context(index):
+    '''Removes the context with specified index
+    and all the contexts pushed after it.'''
+    del _context_stack.contexts[index:]
+
+
+def push_boundary(**values):
+    '''Pushes a context hiding all the contexts pushed before.'''
+    values[SECTION_BOUNDARY_TAG] = True
+    return push_context(**values)
+
+
+def get_context_var(name):
+    '''Returns the value of the variable from the topmost context
+    defining it or None if not defined before a boundary.'''
+    for context in reversed(_context_stack.contexts):
+        value = context.get(name)
+        if value is not None:
+            return value
+        if SECTION_BOUNDARY_TAG in context:
+            return None
+    return None
+
+
 def get_stack_var(name, depth=0):
     '''This function may fiddle with the locals of the calling function,
     to make it the root function of the fiber. If called from a short-lived
@@ -255,6 +312,11 @@ def set_stack_var(name, value, depth=0):
 
 
 def get_state(depth=0):
+    '''Returns the state of the current woven section. If outside
+    the woven sections the state set by set_state() is looked up.'''
+    contexts = _context_stack.contexts
+    if contexts:
+        return get_context_var(SECTION_STATE_TAG)
     return get_stack_var(SECTION_STATE_TAG, depth=depth+1)
 
 
@@ -299,6 +361,7 @@ class WovenSection(object):
         self.state = None
         self._is_root = True
         self._inside = False
+        self._index = None
 
     def enter(self):
         if self._inside:
@@ -306,9 +369,7 @@ class WovenSection(object):
         self._inside = True
 
         if self.descriptor is None:
-            # Use a depth of 1 because we want the state to be
-            # in the calling function not in the method.
-            state = get_state(depth=1)
+            state = get_context_var(SECTION_STATE_TAG)
             if state is not None:
                 # We are in a sub-section, just update the state
                 self.state = state
@@ -320,7 +381,7 @@ class WovenSection(object):
             self.descriptor = RootFiberDescriptor()
 
         state = {"descriptor": self.descriptor}
-        set_state(state, depth=1)
+        self._index = push_context(**{SECTION_STATE_TAG: state})
         self.state = state
 
     def abort(self, result=None):
@@ -355,7 +416,8 @@ class WovenSection(object):
         self._inside = False
         self.state = None
         if self._is_root:
-            del_state(depth=1)
+            pop_context(self._index)
+            self._index = None
 
 
 class RootFiberDescriptor(object):
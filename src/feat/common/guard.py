@@ -26,6 +26,7 @@ from pprint import pformat
 from feat.common import decorator, serialization
 
 STATE_TAG = "_GUARDED_STATE_"
+VIEW_TAG = "_GUARDED_VIEW_"
 
 
 def freeze(value):
@@ -47,11 +48,11 @@ def mutable(function):
 
 @decorator.simple_function
 def immutable(function):
-    '''Add the instance internal state as the second parameter
-    of the decorated function.'''
+    '''Add the read-only view of the instance internal state
+    as the second parameter of the decorated function.'''
 
     def wrapper(self, *args, **kwargs):
-        state = freeze(self._get_state())
+        state = self._get_view()
         return function(self, state, *args, **kwargs)
 
     return wrapper
@@ -84,6 +85,32 @@ class MutableState(serialization.Serializable):
         return True
 
 
+class ReadOnlyState(MutableState):
+    '''Zero-copy read-only view of a MutableState.
+
+    The view shares the attribute dictionary of the state, so it always
+    reflects the current values without copying anything. Setting
+    or deleting attributes through it raises AttributeError. The nested
+    values are not wrapped, they are the same instances as in the state.'''
+
+    # Serialized as the state it is viewing
+    type_name = MutableState.type_name
+
+    def __init__(self, state):
+        object.__setattr__(self, "__dict__", state.__dict__)
+
+    def __repr__(self):
+        return "<ReadOnlyState: %s>" % pformat(self.__dict__)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Cannot set attribute %r of read-only state, "
+                             "use a mutable method" % (name, ))
+
+    def __delattr__(self, name):
+        raise AttributeError("Cannot delete attribute %r of read-only state, "
+                             "use a mutable method" % (name, ))
+
+
 class Guarded(serialization.Serializable):
 
     ignored_state_keys = []
@@ -112,6 +139,20 @@ class Guarded(serialization.Serializable):
     def _get_state(self):
         return getattr(self, STATE_TAG, None)
 
+    def _get_view(self):
+        attrs = self.__dict__
+        state = attrs.get(STATE_TAG)
+        if state is None:
+            return None
+        # The view is created once per state instance; the check of the
+        # shared dictionary catches states replaced by recover() or copied
+        # together with the instance.
+        view = attrs.get(VIEW_TAG)
+        if view is None or view.__dict__ is not state.__dict__:
+            view = ReadOnlyState(state)
+            attrs[VIEW_TAG] = view
+        return view
+
     def __eq__(self, other):
         if type(other) != type(self):
             return NotImplemented
@@ -83,11 +83,12 @@ def replay(journal_entry, function, *args, **kwargs):
         section.state[RECMODE_TAG] = JournalMode.replay
         section.state[JOURNAL_ENTRY_TAG] = IJournalReplayEntry(journal_entry)
 
-    result = function(*args, **kwargs)
-
-    # We don't want anything asynchronous to be called,
-    # so we abort the fiber section
-    section.abort(result)
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        # We don't want anything asynchronous to be called,
+        # so we abort the fiber section
+        section.abort()
     # side effects are returned in sake of making sure that
     # all the side effects expected have been consumed (called)
     return result
@@ -168,9 +169,8 @@ def _side_effect_wrapper(callable, args, kwargs, name):
             # Keep it in the replayable section state
             section_state[SIDE_EFFECT_TAG] = effect
             # Break the fiber to allow new replayable sections
-            fiber.break_fiber()
-            # Keep the side-effect entry to detect we are in one
-            fiber.set_stack_var(SIDE_EFFECT_TAG, effect)
+            # and keep the side-effect entry to detect we are in one
+            boundary = fiber.push_boundary(**{SIDE_EFFECT_TAG: effect})
             try:
                 result = callable(*args, **kwargs)
                 result = _check_side_effet_result(result, name)
@@ -183,6 +183,8 @@ def _side_effect_wrapper(callable, args, kwargs, name):
                                        "Exception raised by side-effect %s",
                                        reflect.canonical_name(callable))
                 raise
+            finally:
+                fiber.pop_context(boundary)
 
     # Not in a replayable section, maybe in another side-effect
     return _check_side_effet_result(callable(*args, **kwargs), name)
@@ -190,7 +192,7 @@ def _side_effect_wrapper(callable, args, kwargs, name):
 
 def add_effect(effect_id, *args, **kwargs):
     '''If inside a side-effect, adds an effect to it.'''
-    effect = fiber.get_stack_var(SIDE_EFFECT_TAG)
+    effect = fiber.get_context_var(SIDE_EFFECT_TAG)
     if effect is None:
         return False
     effect.add_effect(effect_id, *args, **kwargs)
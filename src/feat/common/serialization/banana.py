@@ -65,12 +65,14 @@ FUNCTION_ATOM = '.banana_function'
 
 class Serializer(sexp.Serializer, BananaCodec):
 
-    def __init__(self, externalizer=None, source_ver=None, target_ver=None):
+    def __init__(self, externalizer=None, source_ver=None, target_ver=None,
+                 track_references=True):
         sexp.Serializer.__init__(
             self, externalizer=externalizer,
             converter_caps=base.DEFAULT_CONVERTER_CAPS | BANANA_CONVERTER_CAPS,
             freezer_caps=base.DEFAULT_FREEZER_CAPS | BANANA_CONVERTER_CAPS,
-                                 source_ver=source_ver, target_ver=target_ver)
+                                 source_ver=source_ver, target_ver=target_ver,
+                                 track_references=track_references)
         BananaCodec.__init__(self)
 
     def pack_method(self, data):
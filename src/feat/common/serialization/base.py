@@ -22,6 +22,7 @@
 
 import operator
 import copy
+import os
 import sys
 import types
 
@@ -35,6 +36,9 @@ from feat.interface.serialization import IRegistry, IExternalizer, IRestorator
 from feat.interface.serialization import IVersionAdapter
 
 
+debug_references = os.environ.get("FEAT_DEBUG_REFERENCES", "NO").upper() \
+                   in ("YES", "1", "TRUE")
+
 DEFAULT_CONVERTER_CAPS = set([Capabilities.int_values,
                               Capabilities.enum_values,
                               Capabilities.long_values,
@@ -358,6 +362,23 @@ class Serializer(object):
 
     Sub classes can override the packing functions used for each types.
 
+    If the data to serialize is known to be a tree, reference tracking can
+    be disabled by creating the serializer with track_references=False.
+    Values referenced multiple times are then serialized multiple times.
+    Only the containers being flattened are remembered to detect cycles;
+    if one is found the value is flattened again with reference tracking,
+    or a ValueError is raised if the environment variable
+    FEAT_DEBUG_REFERENCES is set, to help finding the offending caller.
+
+    To avoid dispatching through the generic flatten_* methods for every
+    value, a flattening plan is compiled the first time a serializer is used
+    with a given set of capabilities. It maps each value type to a
+    flattener with the capability checks already resolved; scalar values
+    without packer are not wrapped at all, and a per-class plan is added
+    for every L{ISerializable} or L{ISnapshotable} class met. The output
+    is the same as the generic path; set the class attribute
+    compile_plans to False to disable it.
+
     NOTE: because the flatten methods lookup table is done at class
     declaration time, overriding most of flatten_* method will not work.
     Only flatten_value, flatten_key, flatten_item, flatten_unknown,
@@ -398,9 +419,11 @@ class Serializer(object):
     pack_frozen_method = None
     pack_frozen_external = None
 
+    compile_plans = True
+
     def __init__(self, converter_caps=None, freezer_caps=None,
                  post_converter=None, externalizer=None, registry=None,
-                 source_ver=None, target_ver=None):
+                 source_ver=None, target_ver=None, track_references=True):
         global _global_registry
         assert ((source_ver is None) and (target_ver is None)) \
                or ((source_ver is not None) and (target_ver is not None))
@@ -411,6 +434,8 @@ class Serializer(object):
         self._registry = IRegistry(registry) if registry else _global_registry
         self._source_ver = source_ver
         self._target_ver = target_ver
+        self._track_references = track_references
+        self._plans = {} # {FREEZING: (CAPS, FLATTEN, FLATTENERS, UNPLANNED)}
         self.reset()
 
     ### IFreezer ###
@@ -433,17 +458,24 @@ class Serializer(object):
                                 cap.name, value))
 
     def pack_value(self, data):
-        if not isinstance(data, (list, tuple)):
+        if not isinstance(data, _flattened_types):
             return data
         packer, value = data
         if isinstance(value, list):
-            value = [self.pack_value(d) for d in value]
+            # Leaves are checked inline to save a call per scalar value
+            pack = self.pack_value
+            value = [pack(d) if isinstance(d, _flattened_types) else d
+                     for d in value]
         if packer is not None:
             return packer(value)
         return value
 
     def flatten_value(self, value, caps, freezing):
         vtype = type(value)
+        if caps is self._plan_caps:
+            flattener = self._flatteners.get(vtype)
+            if flattener is not None:
+                return flattener(value)
         default = Serializer.flatten_unknown_value
         flattener = self._value_lookup.get(vtype, default)
         return flattener(self, value, caps, freezing)
@@ -466,8 +498,19 @@ class Serializer(object):
         self._references = {} # {OBJ_ID: REFERENCE_CONTAINER}
         self._memory = []
         self._refid = 0
+        self._tracking = self._track_references
+        self._flattening = set() # {OBJ_ID} when not tracking references
+        self._plan_caps = None # Capabilities of the active plan if any
+        self._plan_flatten = None # Flattening function of the active plan
+        self._flatteners = None # {TYPE: FLATTENER} of the active plan
+        self._unplanned = None # Types the active plan cannot handle
 
     def flatten_unknown_value(self, value, caps, freezing):
+        if caps is self._plan_caps:
+            flattener = self._plan_instance(type(value), caps, freezing)
+            if flattener is not None:
+                return flattener(value)
+
         # Flatten enums
         if isinstance(value, enum.Enum):
             return self.flatten_enum_value(value, caps, freezing)
@@ -624,7 +667,7 @@ class Serializer(object):
                                 caps, freezing)
         items = value.items()
         if freezing:
-            items = sorted(items, key=operator.itemgetter(0))
+            _sort_items(items)
         return self.pack_dict, [self.flatten_item(i, caps, freezing)
                                 for i in items]
 
@@ -752,8 +795,10 @@ class Serializer(object):
 
     def _convert(self, data, caps, freezing):
         try:
+            if self.compile_plans:
+                self._activate_plan(caps, freezing)
             # Flatten the value to the list-only format with packer function
-            flattened = self.flatten_value(data, caps, freezing)
+            flattened = self._flatten(data, caps, freezing)
             # Pack all the value with there own packer functions
             packed = self.pack_value(flattened)
             # Post-convert the data if a convert was specified
@@ -762,11 +807,212 @@ class Serializer(object):
             # Reset the state to cleanup all references
             self.reset()
 
+    def _flatten(self, data, caps, freezing):
+        try:
+            return self.flatten_value(data, caps, freezing)
+        except ReferenceCycle, e:
+            if debug_references:
+                raise ValueError("%s found a reference cycle in a value "
+                                 "of type %s with reference tracking "
+                                 "disabled" % (reflect.canonical_name(self),
+                                               type(e.value).__name__))
+            # Not a tree after all, flatten again tracking references
+            self._tracking = True
+            self._flattening.clear()
+            return self.flatten_value(data, caps, freezing)
+
+    def _activate_plan(self, caps, freezing):
+        plan = self._plans.get(freezing)
+        if plan is None or plan[0] is not caps:
+            flatteners = {}
+            flatten = self._compile_plan(flatteners, caps, freezing)
+            plan = (caps, flatten, flatteners, set())
+            self._plans[freezing] = plan
+        (self._plan_caps, self._plan_flatten,
+         self._flatteners, self._unplanned) = plan
+
+    def _overrides(self, name):
+        method = getattr(type(self), name)
+        return method.im_func is not getattr(Serializer, name).im_func
+
+    def _compile_plan(self, flatteners, caps, freezing):
+        get_flattener = flatteners.get
+        flatten_value = self.flatten_value
+        prepare = self._prepare
+        preserve = self._preserve
+
+        def flatten(value):
+            flattener = get_flattener(type(value))
+            if flattener is not None:
+                return flattener(value)
+            return flatten_value(value, caps, freezing)
+
+        if self._overrides("flatten_value"):
+            # Sub-class wants to see every value, do not shortcut anything
+            return flatten
+
+        self._add_leaf_flatteners(flatteners, self._plan_leaf_values, caps)
+
+        if self._overrides("flatten_key"):
+            flatten_key = lambda key: self.flatten_key(key, caps, freezing)
+        else:
+            key_flatteners = {}
+            self._add_leaf_flatteners(key_flatteners,
+                                      self._plan_leaf_keys, caps)
+            get_key_flattener = key_flatteners.get
+            generic_flatten_key = self.flatten_key
+
+            def flatten_key(key):
+                flattener = get_key_flattener(type(key))
+                if flattener is not None:
+                    return flattener(key)
+                return generic_flatten_key(key, caps, freezing)
+
+        for vtype, cap, name in self._plan_sequence_values:
+            if cap not in caps or not hasattr(self, name):
+                continue
+
+            def flatten_sequence(value, packer=getattr(self, name)):
+                deref = prepare(value)
+                if deref is not None:
+                    return deref
+                return preserve(value, packer, [flatten(v) for v in value])
+
+            flatteners[vtype] = flatten_sequence
+
+        if (Capabilities.dict_values in caps
+            and not self._overrides("flatten_item")):
+            pack_dict = self.pack_dict
+            pack_item = self.pack_item
+
+            def flatten_dict(value):
+                deref = prepare(value)
+                if deref is not None:
+                    return deref
+                items = value.items()
+                if freezing:
+                    _sort_items(items)
+                return preserve(value, pack_dict,
+                                [(pack_item, [flatten_key(k), flatten(v)])
+                                 for k, v in items])
+
+            flatteners[dict] = flatten_dict
+
+        return flatten
+
+    def _add_leaf_flatteners(self, flatteners, leaves, caps):
+        for vtype, cap, name in leaves:
+            if cap not in caps:
+                continue
+            packer = getattr(self, name)
+            if packer is None:
+                # Packing [None, value] would give the value itself
+                flatteners[vtype] = _flatten_leaf
+            else:
+                flatteners[vtype] = _leaf_flattener(packer)
+
+    def _plan_instance(self, vtype, caps, freezing):
+        if vtype in self._unplanned:
+            return None
+        flattener = self._compile_instance_plan(vtype, caps, freezing)
+        if flattener is None:
+            self._unplanned.add(vtype)
+        else:
+            self._flatteners[vtype] = flattener
+        return flattener
+
+    def _compile_instance_plan(self, vtype, caps, freezing):
+        iface = ISnapshotable if freezing else ISerializable
+        if (Capabilities.instance_values not in caps
+            or self._overrides("flatten_unknown_value")
+            or self._overrides("flatten_instance")
+            or issubclass(vtype, (enum.Enum, type, InterfaceClass))
+            or getattr(vtype, "__conform__", None) is not None
+            or not iface.implementedBy(vtype)):
+            # Needs adaptation or special handling, use the generic path
+            return None
+
+        flatten = self._plan_flatten
+        prepare = self._prepare
+        preserve = self._preserve
+        externalizer = self._externalizer
+        versioned = IVersionAdapter.implementedBy(vtype)
+        pack_type_name = self.pack_type_name
+        if freezing:
+            packer = self.pack_frozen_instance
+        else:
+            packer = self.pack_instance
+
+        def flatten_instance(value):
+            if externalizer is not None:
+                extid = externalizer.identify(value)
+                if extid is not None:
+                    return self.flatten_external(extid, caps, freezing)
+
+            referenceable = getattr(value, "referenceable", True)
+
+            if referenceable:
+                deref = prepare(value)
+                if deref is not None:
+                    return deref
+
+            snapshot = value.snapshot()
+
+            if versioned:
+                source = self.get_source_ver(value, snapshot)
+                target = self.get_target_ver(value, snapshot)
+                if target is not None:
+                    if target != source:
+                        snapshot = value.adapt_version(snapshot,
+                                                       source, target)
+                    value.store_version(snapshot, target)
+
+            dump = flatten(snapshot)
+
+            if freezing:
+                data = [dump]
+            else:
+                data = [[pack_type_name, value.type_name], dump]
+
+            if referenceable:
+                return preserve(value, packer, data)
+            return packer, data
+
+        return flatten_instance
+
+    _plan_leaf_values = ((str, Capabilities.str_values, "pack_str"),
+                         (unicode, Capabilities.unicode_values,
+                          "pack_unicode"),
+                         (int, Capabilities.int_values, "pack_int"),
+                         (long, Capabilities.long_values, "pack_long"),
+                         (float, Capabilities.float_values, "pack_float"),
+                         (bool, Capabilities.bool_values, "pack_bool"),
+                         (type(None), Capabilities.none_values, "pack_none"))
+
+    _plan_leaf_keys = ((str, Capabilities.str_keys, "pack_str"),
+                       (unicode, Capabilities.unicode_keys, "pack_unicode"),
+                       (int, Capabilities.int_keys, "pack_int"),
+                       (long, Capabilities.long_keys, "pack_long"),
+                       (float, Capabilities.float_keys, "pack_float"),
+                       (bool, Capabilities.bool_keys, "pack_bool"),
+                       (type(None), Capabilities.none_keys, "pack_none"))
+
+    _plan_sequence_values = ((tuple, Capabilities.tuple_values, "pack_tuple"),
+                             (list, Capabilities.list_values, "pack_list"),
+                             (set, Capabilities.set_values, "pack_set"))
+
     def _next_refid(self):
         self._refid += 1
         return self._refid
 
     def _prepare(self, value):
+        if not self._tracking:
+            ident = id(value)
+            if ident in self._flattening:
+                raise ReferenceCycle(value)
+            self._flattening.add(ident)
+            return None
+
         ident = id(value)
         # Check if already preserved
         if ident in self._preserved:
@@ -801,6 +1047,10 @@ class Serializer(object):
         return None
 
     def _preserve(self, value, packer, data):
+        if not self._tracking:
+            self._flattening.discard(id(value))
+            return [packer, data]
+
         ident = id(value)
         # Keep a reference to the value to prevent it to be garbage-collected.
         # If it was, a different value with the same id could appear
@@ -823,6 +1073,15 @@ class Serializer(object):
         return self._source_ver
 
 
+class ReferenceCycle(Exception):
+    """Raised internally by serializers not tracking references
+    when a value contains itself."""
+
+    def __init__(self, value):
+        Exception.__init__(self, value)
+        self.value = value
+
+
 class DelayPacking(Exception):
     """Exception raised when unpacking a dereference to an unknown
     reference. This allows to delay unpacking of mutable object
@@ -1211,3 +1470,33 @@ class Unserializer(object):
 ### private ###
 
 _global_registry = Registry()
+
+_flattened_types = (list, tuple)
+
+
+def _sort_items(items):
+    # frozen dictionaries must not depend on the iteration order,
+    # non-ASCII str keys cannot be compared with unicode ones though
+    try:
+        items.sort(key=operator.itemgetter(0))
+    except UnicodeError:
+        items.sort(key=_item_sorting_key)
+
+
+def _item_sorting_key(item):
+    key = item[0]
+    if isinstance(key, unicode):
+        return key.encode("utf8"), True
+    return key, False
+
+
+def _flatten_leaf(value):
+    return value
+
+
+def _leaf_flattener(packer):
+
+    def flatten_leaf(value):
+        return packer, value
+
+    return flatten_leaf
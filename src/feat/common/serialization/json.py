@@ -77,12 +77,13 @@ class PreSerializer(base.Serializer):
     pack_dict = dict
 
     def __init__(self, force_unicode=False, externalizer=None,
-                 source_ver=None, target_ver=None):
+                 source_ver=None, target_ver=None, track_references=True):
         base.Serializer.__init__(self, converter_caps=JSON_CONVERTER_CAPS,
                                  freezer_caps=JSON_FREEZER_CAPS,
                                  externalizer=externalizer,
                                  source_ver=source_ver,
-                                 target_ver=target_ver)
+                                 target_ver=target_ver,
+                                 track_references=track_references)
         self._force_unicode = force_unicode
 
     ### Overridden Methods ###
@@ -168,11 +169,12 @@ class Serializer(PreSerializer):
     def __init__(self, indent=None, separators=None,
                  force_unicode=False, encoding=None,
                  externalizer=None, source_ver=None, target_ver=None,
-                 sort_keys=False):
+                 sort_keys=False, track_references=True):
         PreSerializer.__init__(self, force_unicode=force_unicode,
                                  externalizer=externalizer,
                                  source_ver=source_ver,
-                                 target_ver=target_ver)
+                                 target_ver=target_ver,
+                                 track_references=track_references)
         self._indent = indent
         self._separators = separators
         self._encoding = encoding
@@ -50,13 +50,14 @@ class Serializer(base.Serializer):
 
     def __init__(self, post_converter=None, externalizer=None,
                  converter_caps=None, freezer_caps=None,
-                 source_ver=None, target_ver=None):
+                 source_ver=None, target_ver=None, track_references=True):
         base.Serializer.__init__(self, post_converter=post_converter,
                                  externalizer=externalizer,
                                  converter_caps=converter_caps,
                                  freezer_caps=freezer_caps,
                                  source_ver=source_ver,
-                                 target_ver=target_ver)
+                                 target_ver=target_ver,
+                                 track_references=track_references)
 
     def pack_unicode(self, value):
         return [UNICODE_ATOM, value.encode(UNICODE_FORMAT_ATOM)]
@@ -30,22 +30,25 @@ class Cache(model.Model):
     model.attribute('size', value.Integer(),
                     desc="Sum of sizes of cached fragments",
                     getter=call.source_call('get_size'))
-    model.attribute('average_size', value.Integer(),
-                    desc="Average size of cache calculated during the "
-                         "cleanup call",
-                    getter=call.model_call('get_average_size'))
-    model.attribute('average_cleanup_time', value.Integer(),
-                    desc="Average size of cache calculated during the "
-                         "cleanup call",
-                    getter=call.model_call('get_average_cleanup_time'))
     model.attribute('desired_size', value.Integer(),
                     desc="Desired size of cache.",
                     getter=getter.source_attr('desired_size'),
                     setter=setter.source_attr('desired_size'))
-    model.attribute('operation', value.Integer(),
-                    desc=("Internal counter of operations used to "
-                          "determine when to call cleanup()"),
-                    getter=getter.source_attr('_operation'))
+    model.attribute('policy', value.Enum(driver.CachePolicy),
+                    desc="Policy used for evicting the entries",
+                    getter=getter.source_attr('policy'))
+    model.attribute('evictions', value.Integer(),
+                    desc="Number of entries evicted to keep the desired size",
+                    getter=getter.source_attr('evictions'))
+    model.attribute('hits', value.Integer(),
+                    desc="Number of responses served without revalidation",
+                    getter=getter.source_attr('hits'))
+    model.attribute('misses', value.Integer(),
+                    desc="Number of responses which were not cached",
+                    getter=getter.source_attr('misses'))
+    model.attribute('revalidations', value.Integer(),
+                    desc="Number of responses revalidated with the ETag",
+                    getter=getter.source_attr('revalidations'))
     model.collection('entries',
                      child_names=call.source_call('keys'),
                      child_source=getter.source_get('get'),
@@ -56,19 +59,13 @@ class Cache(model.Model):
                                   'cached_at, last_accessed_at, '
                                   'num_accessed, size')])
 
-    def get_average_size(self):
-        return self.source.average_size.get_value()
-
-    def get_average_cleanup_time(self):
-        return self.source.average_cleanup_time.get_value()
-
     model.action('cleanup', action.MetaAction.new(
         'cleanup',
         ActionCategories.command,
         effects=[call.source_call('cleanup'),
                  response.done('Done')],
         result_info=value.Response()),
-                 label="Trigger normal cleanup")
+                 label="Remove invalid entries")
 
     model.delete('del',
                  call.source_call('clear'),
@@ -31,13 +31,14 @@ from zope.interface import implements
 
 from feat.common import log, defer, time, journal, serialization, error
 from feat.common.serialization import json
-from feat.database import document, query, common
+from feat.database import document, query, common, codec
 
 from feat.database.interface import IDatabaseClient, IDatabaseDriver
 from feat.database.interface import IRevisionStore, IDocument, IViewFactory
 from feat.database.interface import NotFoundError, ConflictResolutionStrategy
 from feat.database.interface import ResignFromModifying, ConflictError
 from feat.database.interface import IVersionedDocument, NotMigratable
+from feat.database.interface import DatabaseError
 from feat.interface.generic import ITimeProvider
 from feat.interface.serialization import ISerializable
 
@@ -52,7 +53,7 @@ class ViewFilter(object):
         self._listeners = dict()
 
     def match(self, doc):
-        # used only by emu
+        # used by emu and by the multiplexed changes feed
         return self.view.perform_filter(doc, self._request)
 
     def add_listener(self, callback, listener_id):
@@ -83,8 +84,8 @@ class DocIdFilter(object):
         self._listeners = {}
 
     def match(self, doc):
-        # used only by emu
-        return doc['_id'] in self._listeners.keys()
+        # used by emu and by the multiplexed changes feed
+        return doc['_id'] in self._listeners
 
     def notified(self, doc_id, rev, deleted):
         listeners = self._listeners.get(doc_id, list())
@@ -170,6 +171,30 @@ class ChangeListener(log.Logger):
         # to be overriden in the child classes
         return defer.succeed(None)
 
+    def _dispatch_change(self, change):
+        '''
+        Matches the line of the changes feed against all the active filters.
+        Used when a single unfiltered feed is shared by all of them.
+        Matching view filters requires the feed to include the documents.
+        '''
+        doc_id = change['id']
+        deleted = change.get('deleted', False)
+        doc = change.get('doc') or {'_id': doc_id}
+        revs = [line['rev'] for line in change.get('changes', [])]
+        for filter_i in self._filters.values():
+            if filter_i.extract_params() is None:
+                continue
+            try:
+                matched = filter_i.match(doc)
+            except Exception as e:
+                error.handle_exception(
+                    self, e, "Failed matching change of %s against the "
+                    "filter %s", doc_id, filter_i.name)
+                continue
+            if matched:
+                for rev in revs:
+                    filter_i.notified(doc_id, rev, deleted)
+
 
 class Connection(log.Logger, log.LogProxy):
     '''API for agency to call against the database.'''
@@ -182,7 +207,10 @@ class Connection(log.Logger, log.LogProxy):
         log.Logger.__init__(self, database)
         log.LogProxy.__init__(self, database)
         self._database = IDatabaseDriver(database)
-        self._serializer = json.Serializer(sort_keys=True, force_unicode=True)
+        self._serializer = json.Serializer(sort_keys=True, force_unicode=True,
+                                           track_references=False)
+        self._preserializer = json.PreSerializer(force_unicode=True,
+                                                 track_references=False)
         self._unserializer = (unserializer or common.CouchdbUnserializer())
 
 
@@ -255,7 +283,6 @@ class Connection(log.Logger, log.LogProxy):
         try:
             self._lock_notifications()
 
-            serialized = self._serializer.convert(doc)
             if IDocument.providedBy(doc):
                 following_attachments = dict(
                     (name, attachment) for name, attachment
@@ -265,6 +292,12 @@ class Connection(log.Logger, log.LogProxy):
             else:
                 following_attachments = dict()
                 doc_id = doc.get('_id')
+            if following_attachments:
+                # the driver might need to strip the following attachments
+                serialized = codec.JSONDocument(
+                    self._preserializer.convert(doc))
+            else:
+                serialized = self._serializer.convert(doc)
             resp = yield self._database.save_doc(serialized, doc_id,
                                                  following_attachments)
             self._update_id_and_rev(resp, doc)
@@ -285,6 +318,68 @@ class Connection(log.Logger, log.LogProxy):
         finally:
             self._unlock_notifications()
 
+    @serialization.freeze_tag('IDatabaseClient.save_documents')
+    @defer.inlineCallbacks
+    def save_documents(self, docs):
+        result = [None] * len(docs)
+        try:
+            self._lock_notifications()
+
+            batch = list()
+            for index, doc in enumerate(docs):
+                assert IDocument.providedBy(doc) or isinstance(doc, dict), \
+                       repr(doc)
+                if (IDocument.providedBy(doc) and
+                    any(not attachment.saved for attachment
+                        in doc.get_attachments().itervalues())):
+                    # following attachments cannot be uploaded with
+                    # the _bulk_docs request, save these one by one
+                    try:
+                        result[index] = yield self.save_document(doc)
+                    except DatabaseError as e:
+                        result[index] = e
+                else:
+                    batch.append((index, doc))
+
+            if batch:
+                serialized = [self._serializer.convert(doc)
+                              for _, doc in batch]
+                resp = yield self._database.bulk_save(serialized)
+
+                to_link = list()
+                for (index, doc), row in zip(batch, resp):
+                    if 'error' in row:
+                        msg = ("Saving document %s failed with %s: %s" %
+                               (row.get('id'), row['error'],
+                                row.get('reason')))
+                        if row['error'] == 'conflict':
+                            result[index] = ConflictError(msg)
+                        else:
+                            result[index] = DatabaseError(msg)
+                        continue
+                    result[index] = self._update_id_and_rev(row, doc)
+                    if IDocument.providedBy(doc):
+                        while doc.links.to_save:
+                            linked, linker_roles, linkee_roles = (
+                                doc.links.to_save.pop(0))
+                            linked.links.create(doc=doc,
+                                                linker_roles=linker_roles,
+                                                linkee_roles=linkee_roles)
+                            to_link.append(linked)
+
+                # now save all the documents which have been registered to
+                # be saved together with the saved documents
+                if to_link:
+                    saved = yield self.save_documents(to_link)
+                    for doc in saved:
+                        if isinstance(doc, DatabaseError):
+                            self.warning("Failed to save linked document: "
+                                         "%s", doc)
+
+            defer.returnValue(result)
+        finally:
+            self._unlock_notifications()
+
     @serialization.freeze_tag('IDatabaseClient.get_attachment_body')
     def get_attachment_body(self, attachment):
         d = self._database.get_attachment(attachment.doc_id, attachment.name)
@@ -396,6 +491,11 @@ class Connection(log.Logger, log.LogProxy):
             d.addCallback(self._parse_view_results, factory, options)
         return d
 
+    @serialization.freeze_tag('IDatabaseClient.is_view_warm')
+    def is_view_warm(self, factory):
+        factory = IViewFactory(factory)
+        return self._database.check_view_index(factory.design_doc_id)
+
     @serialization.freeze_tag('IDatabaseClient.disconnect')
     @journal.named_side_effect('IDatabaseClient.disconnect')
     def disconnect(self):
@@ -0,0 +1,123 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+'''
+Encoding and decoding of the JSON bodies exchanged with CouchDB.
+
+All the JSON handled by the database driver goes through this module, so
+that the fastest available implementation can be chosen in one place.
+The backends supported are:
+ - C{simplejson}: used for decoding if its C extension is available, the
+   data is decoded as unicode so that all the strings come out as unicode
+   like with the standard library module,
+ - C{json}: the module bundled with the standard library.
+
+Encoding always produces ASCII strings which can be sent as HTTP bodies.
+The standard library module is used for it because its C encoder is
+faster than the one of simplejson.
+'''
+
+from feat import hacks
+
+json = hacks.import_json()
+
+try:
+    # only worth using with its C extension
+    import simplejson._speedups
+except ImportError:
+    simplejson = None
+
+
+__all__ = ['decode', 'encode', 'use', 'get_backend', 'get_backends',
+           'JSONDocument']
+
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def _simplejson_decode(string):
+    if isinstance(string, str):
+        # simplejson decodes ASCII-only strings as str when given str
+        string = string.decode('utf-8')
+    return simplejson.loads(string)
+
+
+_backends = {'json': (json.loads, _encoder.encode)}
+
+if simplejson is not None:
+    _backends['simplejson'] = (_simplejson_decode, _encoder.encode)
+
+_using = None
+_decode = None
+_encode = None
+
+
+def decode(string):
+    '''
+    Decodes the JSON string, raises C{ValueError} if it cannot be parsed.
+    '''
+    return _decode(string)
+
+
+def encode(obj):
+    '''
+    Encodes the object as ASCII JSON string.
+    '''
+    return _encode(obj)
+
+
+def use(name=None):
+    '''
+    Selects the backend to use, picks the fastest available one if no name
+    is given.
+    '''
+    global _using, _decode, _encode
+    if name is None:
+        name = 'simplejson' if 'simplejson' in _backends else 'json'
+    if name not in _backends:
+        raise ValueError("Unknown or unavailable JSON backend %r, "
+                         "available are: %s"
+                         % (name, ", ".join(get_backends())))
+    _using = name
+    _decode, _encode = _backends[name]
+
+
+def get_backend():
+    return _using
+
+
+def get_backends():
+    return sorted(_backends)
+
+
+class JSONDocument(str):
+    '''
+    Encoded document which keeps the structure it was encoded from, so that
+    it can be modified and encoded again without parsing it.
+    '''
+
+    def __new__(cls, data):
+        self = str.__new__(cls, encode(data))
+        self.data = data
+        return self
+
+
+use()
@@ -109,8 +109,8 @@ def _initialize():
         global _decode, _encode
         import simplejson
         _decode = lambda string, loads=simplejson.loads: loads(string)
-        _encode = lambda obj, dumps=simplejson.dumps: \
-            dumps(obj, allow_nan=False, ensure_ascii=False)
+        # escaping non-ASCII characters is faster than encoding the result
+        _encode = simplejson.JSONEncoder(allow_nan=False).encode
 
     def _init_cjson():
         global _decode, _encode
@@ -122,8 +122,8 @@ def _initialize():
         global _decode, _encode
         json = __import__('json', {}, {})
         _decode = lambda string, loads=json.loads: loads(string)
-        _encode = lambda obj, dumps=json.dumps: \
-            dumps(obj, allow_nan=False, ensure_ascii=False)
+        # only the ASCII encoding is done by the C encoder
+        _encode = json.JSONEncoder(allow_nan=False).encode
 
     if _using == 'simplejson':
         _init_simplejson()
@@ -37,26 +37,29 @@ def run(input=sys.stdin, output=sys.stdout):
     """
     functions = []
     environments = dict()
+    # (source, function name) -> compiled function
+    compiled = dict()
 
-    def _writejson(obj):
+    def _writejson(obj, flush=True):
+        # CouchDB waits for the response of each command, so the output
+        # is flushed once per command, log lines are sent along with it
         obj = json.encode(obj)
         if isinstance(obj, unicode):
             obj = obj.encode('utf-8')
-        output.write(obj)
-        output.write('\n')
-        output.flush()
+        output.write(obj + '\n')
+        if flush:
+            output.flush()
 
     def _log(message):
         if not isinstance(message, basestring):
             message = json.encode(message)
-        _writejson({'log': message})
+        _writejson({'log': message}, flush=False)
 
     def reset(config=None):
         del functions[:]
         return True
 
     def add_fun(string):
-        string = BOM_UTF8 + string.encode('utf-8')
         try:
             function = _compile(string, "map_compilation_error", "map")
         except CompileError as e:
@@ -68,7 +71,8 @@ def run(input=sys.stdin, output=sys.stdout):
         results = []
         for function in functions:
             try:
-                results.append([[key, value] for key, value in function(doc)])
+                # tuples are encoded as arrays as well
+                results.append([(key, value) for key, value in function(doc)])
             except Exception, e:
                 log.error('runtime error in map function: %s', e,
                           exc_info=True)
@@ -77,7 +81,7 @@ def run(input=sys.stdin, output=sys.stdout):
         return results
 
     def reduce(*cmd, **kwargs):
-        code = BOM_UTF8 + cmd[0][0].encode('utf-8')
+        code = cmd[0][0]
         args = cmd[1]
 
         try:
@@ -177,6 +181,15 @@ def run(input=sys.stdin, output=sys.stdout):
         return [True, results]
 
     def _compile(func_str, error_id, f_name):
+        # reduce functions are sent with every reduce command and
+        # the map functions after every reset, compile them only once
+        function = compiled.get((func_str, f_name))
+        if function is None:
+            function = _do_compile(func_str, error_id, f_name)
+            compiled[(func_str, f_name)] = function
+        return function
+
+    def _do_compile(func_str, error_id, f_name):
         globals_ = {}
 
         if func_str in ('_count', '_sum', '_stats'):
@@ -184,6 +197,9 @@ def run(input=sys.stdin, output=sys.stdout):
             # by the python server
             return func_str
 
+        if isinstance(func_str, unicode):
+            func_str = BOM_UTF8 + func_str.encode('utf-8')
+
         try:
             exec func_str in {'log': _log}, globals_
         except Exception, e:
@@ -30,23 +30,24 @@ from twisted.protocols import basic
 from twisted.web.http import _DataLoss as DataLoss
 
 
-from feat.database.client import Connection, ChangeListener
-from feat.common import log, defer, time, error, enum, container
+from feat.database.client import Connection, ChangeListener, ViewFilter
+from feat.common import log, defer, time, error, enum
 from feat.agencies import common
 from feat.web import http, httpclient, auth, security
-from feat import hacks
-
-json = hacks.import_json()
 
 from feat.database.interface import IDatabaseDriver, IDbConnectionFactory
 from feat.database.interface import NotFoundError, NotConnectedError
 from feat.database.interface import ConflictError, IViewFactory, DatabaseError
 from feat.database.interface import IAttachmentPrivate
+from feat.database import codec
 
 
 DEFAULT_DB_HOST = "localhost"
 DEFAULT_DB_PORT = 5985
 DEFAULT_DB_NAME = "feat"
+# we should take roughly 10MB of cache
+DEFAULT_DB_CACHE_SIZE = 10 * 1024 * 1024
+DEFAULT_DB_CACHE_POLICY = "lru"
 
 BOUNDARY = '32c90c040f034b15959861e58b8ec35d'
 
@@ -97,7 +98,7 @@ class ChangeReceiver(basic.LineReceiver):
         if not line:
             return
 
-        change = json.loads(line)
+        change = codec.decode(line)
 
         if not 'id' in change:
             return
@@ -135,9 +136,14 @@ class Notifier(object):
         self.name = self._filter.name
         self._params = None
         self._changes = None
+        # sequence to resume the feed from after reconnecting
+        self._since = None
+
+    def extract_params(self):
+        return self._filter.extract_params()
 
     def setup(self):
-        new_params = self._filter.extract_params()
+        new_params = self.extract_params()
         if (self._params is not None and
             new_params == self._params and
             self._changes is not None):
@@ -158,6 +164,8 @@ class Notifier(object):
             query = dict(new_params)
             query['feed'] = 'continuous'
             query['heartbeat'] = 1000
+            if self._since is not None:
+                query['since'] = self._since
             if 'since' not in query:
                 url = '/%s/' % (self._db.db_name, )
                 d.addCallback(defer.drop_param, self._db.couchdb_call,
@@ -178,6 +186,7 @@ class Notifier(object):
                           query)
         else:
             self._db.log("Stopping notifier: %r", self.name)
+            self._since = None
         d.addErrback(self.connectionLost)
         d.addErrback(failure.Failure.trap, NotConnectedError)
         return d
@@ -196,6 +205,9 @@ class Notifier(object):
         else:
             self.info('Bizare notification received from CouchDB: %r', change)
 
+    def is_running(self):
+        return self._changes is not None
+
     def connectionLost(self, reason):
         self._changes = None
         if reason.check(NotFoundError):
@@ -203,6 +215,71 @@ class Notifier(object):
         self._db.connectionLost(reason)
 
 
+class MultiplexedNotifier(Notifier):
+    '''
+    Single continuous feed shared by all the filters of the database.
+    Changes are matched against the filters on the client side, so adding
+    or removing listeners doesn't reopen the feed. After reconnecting
+    the feed resumes from the last sequence seen, so that no changes
+    are missed in between.
+    '''
+
+    name = 'multiplexed'
+
+    def __init__(self, db):
+        self._db = db
+        self._params = None
+        self._changes = None
+        self._since = None
+        # (host, port, db_name) the sequence above refers to
+        self._position = None
+
+    def extract_params(self):
+        active = [x for x in self._db._filters.itervalues()
+                  if x.extract_params() is not None]
+        if not active:
+            return
+        if any(isinstance(x, ViewFilter) for x in active):
+            # view filters need the document body to match
+            return dict(include_docs='true')
+        return dict()
+
+    def setup(self):
+        position = (self._db.host, self._db.port, self._db.db_name)
+        if position != self._position:
+            self._position = position
+            self._since = None
+        return Notifier.setup(self)
+
+    def changed(self, change):
+        self._db._dispatch_change(change)
+        if 'seq' in change:
+            self._since = change['seq']
+
+
+class CacheFilter(object):
+    '''
+    Passes all the changes of the database to the response cache.
+    '''
+
+    name = 'cache'
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def match(self, doc):
+        return True
+
+    def notified(self, doc_id, rev, deleted):
+        self._cache.changed(doc_id)
+
+    def cancel_listener(self, listener_id):
+        return False
+
+    def extract_params(self):
+        return dict()
+
+
 class CouchDB(httpclient.ConnectionPool):
 
     log_category = 'couchdb-connection'
@@ -269,15 +346,32 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
     log_category = "database"
 
     LoopingCall = task.LoopingCall
-    # we should take roughly 10MB of cache
-    DESIRED_CACHE_SIZE = 10 * 1024 * 1024
+    DESIRED_CACHE_SIZE = DEFAULT_DB_CACHE_SIZE
+    # name of the CachePolicy
+    CACHE_POLICY = DEFAULT_DB_CACHE_POLICY
+    # use a single changes feed for all the filters
+    multiplex_changes = False
+    # follow the changes feed to avoid revalidating fresh cache entries
+    follow_changes = False
+    # query views with stale=update_after until their index is up to date
+    stale_until_warm = False
+    # minimal interval between checking the state of the view index
+    WARM_CHECK_INTERVAL = 5
 
     def __init__(self, host, port, db_name, username=None, password=None,
-                 https=False):
+                 https=False, multiplex_changes=None, follow_changes=None,
+                 cache_size=None, cache_policy=None, stale_until_warm=None):
         common.ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, log.get_default() or log.FluLogKeeper())
         ChangeListener.__init__(self, self)
 
+        if multiplex_changes is not None:
+            self.multiplex_changes = multiplex_changes
+        if follow_changes is not None:
+            self.follow_changes = follow_changes
+        if stale_until_warm is not None:
+            self.stale_until_warm = stale_until_warm
+
         self.couchdb = None
         self.db_name = None
         self.version = None
@@ -301,7 +395,16 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         self._pending_notifications = dict()
         # doc_id -> C{int} number of locks
         self._document_locks = dict()
-        self._cache = Cache(desired_size=self.DESIRED_CACHE_SIZE)
+        self._cache = Cache(desired_size=cache_size or self.DESIRED_CACHE_SIZE,
+                            policy=cache_policy or self.CACHE_POLICY)
+        self._cache_filter = None
+        # ids of the design documents with the index known to be up to date
+        self._warm_design_docs = set()
+        # design_doc_id -> epoch time of the last check of the index
+        self._index_checks = dict()
+        if self.follow_changes:
+            self._cache_filter = CacheFilter(self._cache)
+            self._filters[self._cache_filter.name] = self._cache_filter
 
         self._configure(host, port, db_name, username, password,
                         https)
@@ -313,7 +416,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
     def show_connection_status(self):
         eta = self.reconnector and self.reconnector.active() and \
               time.left(self.reconnector.getTime())
-        return "CouchDB", self.is_connected(), self.host, self.port, eta
+        return ("CouchDB", self.is_connected(), self.host, self.port, eta,
+                self._cache.show_statistics())
 
     def show_document_locks(self):
         return dict(self._document_locks), dict(self._pending_notifications)
@@ -387,11 +491,17 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
             # Updating documents with multipart/related doesnt work
             # in couchdb version prior to 1.1.2.
             # Also multipart request cannot be used when creating new documents
-            unserialized = json.loads(doc)
-            for name, body in unserialized['_attachments'].items():
-                if body.get('follows'):
-                    del unserialized['_attachments'][name]
-            doc = json.dumps(unserialized)
+            # The client passes the structure the document was encoded from,
+            # strip the attachments from it instead of parsing the document.
+            if isinstance(doc, codec.JSONDocument):
+                unserialized = dict(doc.data)
+            else:
+                unserialized = codec.decode(doc)
+            unserialized['_attachments'] = dict(
+                (name, body) for name, body
+                in unserialized['_attachments'].iteritems()
+                if not body.get('follows'))
+            doc = codec.encode(unserialized)
 
             r = yield self.couchdb_call(method, url, doc)
             for attachment in following_attachments.itervalues():
@@ -416,13 +526,14 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         url = '/_replicate'
         params = dict(source=source, target=target)
         params.update(options)
-        body = json.dumps(params)
+        body = codec.encode(params)
         return self.couchdb_call(self.couchdb.post, url, body)
 
     def disconnect(self):
         self._cancel_reconnector()
         self.couchdb.disconnect()
         self.disconnected = True
+        self._cache.stop_following()
 
     # listen_chagnes from ChangeListener
 
@@ -431,6 +542,10 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
     def query_view(self, factory, post_process=None, cache_id_suffix='',
                    if_modified_since=None, **options):
         factory = IViewFactory(factory)
+        design_doc = factory.design_doc_id
+        if 'stale' not in options and self._serve_stale(design_doc):
+            options['stale'] = 'update_after'
+        warms_up = 'stale' not in options
 
         url = "/%s/_design/%s/_view/%s" % (self.db_name,
                                            quote(str(factory.design_doc_id)),
@@ -438,14 +553,16 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         cache_id = None
         if 'keys' in options:
             keys = options.pop("keys")
-            body = json.dumps({"keys": keys})
+            body = codec.encode({"keys": keys})
             cache_id = "%s#%s" % (url, hash(tuple(sorted(keys))))
         else:
             body = None
 
         if options:
-            encoded = urlencode(dict((k, json.dumps(v))
-                                     for k, v in options.iteritems()))
+            # the value of stale is not JSON
+            encoded = urlencode(dict(
+                (k, v if k in RAW_VIEW_OPTIONS else codec.encode(v))
+                for k, v in options.iteritems()))
             url += '?' + encoded
 
         if cache_id is None:
@@ -458,13 +575,38 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
             parser = (parse_response, parse_view_result)
 
         if body:
-            return self.couchdb_call(self.couchdb.post, url, body=body,
-                                     cache_id=cache_id, parser=parser,
-                                     if_modified_since=if_modified_since)
+            d = self.couchdb_call(self.couchdb.post, url, body=body,
+                                  cache_id=cache_id, parser=parser,
+                                  if_modified_since=if_modified_since,
+                                  design_doc=design_doc)
         else:
-            return self.couchdb_call(self.couchdb.get, url,
-                                     cache_id=cache_id, parser=parser,
-                                     if_modified_since=if_modified_since)
+            d = self.couchdb_call(self.couchdb.get, url,
+                                  cache_id=cache_id, parser=parser,
+                                  if_modified_since=if_modified_since,
+                                  design_doc=design_doc)
+        if warms_up:
+            # CouchDB answers only once the index is up to date
+            d.addCallback(defer.bridge_param,
+                          self._warm_design_docs.add, design_doc)
+        return d
+
+    @defer.inlineCallbacks
+    def check_view_index(self, design_doc_id):
+        if design_doc_id not in self._warm_design_docs:
+            self._index_checks[design_doc_id] = time.time()
+            # the sequence is taken first, the index has to get past it
+            update_seq = yield self.get_update_seq()
+            url = '/%s/_design/%s/_info' % (
+                self.db_name, quote(design_doc_id.encode('utf-8')))
+            info = yield self.couchdb_call(self.couchdb.get, url)
+            index = info.get('view_index', dict())
+            self.log("Index of the design document %s is at the sequence "
+                     "%s of %s", design_doc_id, index.get('update_seq'),
+                     update_seq)
+            if (not index.get('updater_running') and
+                index.get('update_seq', 0) >= update_seq):
+                self._warm_design_docs.add(design_doc_id)
+        defer.returnValue(design_doc_id in self._warm_design_docs)
 
     def save_attachment(self, doc_id, revision, attachment):
         attachment = IAttachmentPrivate(attachment)
@@ -510,7 +652,15 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         body = dict(keys=doc_ids)
         cache_id = "%s#%s" % (url, hash(tuple(doc_ids)))
         return self.couchdb_call(self.couchdb.post,
-                                 url, json.dumps(body), cache_id=cache_id)
+                                 url, codec.encode(body), cache_id=cache_id,
+                                 doc_ids=doc_ids)
+
+    def bulk_save(self, docs):
+        # docs are already serialized, join them instead of parsing
+        # and dumping them again
+        url = '/%s/_bulk_docs' % (self.db_name, )
+        body = '{"docs": [%s]}' % (', '.join(docs), )
+        return self.couchdb_call(self.couchdb.post, url, body)
 
     def get_version(self):
         if self.version:
@@ -550,6 +700,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
             return self.wait_connected()
 
     def connectionLost(self, reason):
+        # one of the feeds is gone, we might have missed some changes
+        self._cache.stop_following()
         if reason.check(tw_error.ConnectionDone):
             # expected just pass
             return
@@ -576,6 +728,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         cache_id = kwargs.pop('cache_id', None)
         parser = kwargs.pop('parser', parse_response)
         if_modified_since = kwargs.pop('if_modified_since', None)
+        design_doc = kwargs.pop('design_doc', None)
+        doc_ids = kwargs.pop('doc_ids', None)
 
         tag = "%s on %s" % (method.__name__.upper(), url)
         entry = None
@@ -585,6 +739,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
             if entry and entry.state == EntryState.waiting:
                 # There is ongoing request to this URL, just wait
                 # for the result.
+                self._cache.hits += 1
                 return entry.wait()
 
             if not entry:
@@ -592,13 +747,20 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
                 # a cacheable entity.
 
                 entry = CacheEntry(tag, parser)
-                self._cache[cache_id] = entry
+                self._cache.track(cache_id, entry, design_doc, doc_ids)
+                self._cache.misses += 1
+
+            elif self._cache.is_fresh(entry):
+                # nothing it depends on has changed since it was validated
+                self._cache.hits += 1
+                return entry.wait()
 
             if entry.etag:
 
                 if if_modified_since and if_modified_since < entry.fresh_at:
                     # just reuse the cached response if the response was
                     # cached latere than the provided time
+                    self._cache.hits += 1
                     return entry.wait()
 
                 entry.state = EntryState.waiting
@@ -608,21 +770,47 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
                 # Below use the normal HTTP way of revalidating the cache.
                 kwargs.setdefault('headers', dict())
                 kwargs['headers']['If-None-Match'] = entry.etag
+                self._cache.revalidations += 1
+
+            entry.request_sent(self._cache.get_token(entry))
 
         d = method(url, *args, **kwargs)
         d.addCallback(defer.bridge_param, self._on_connected)
         if entry:
             d.addCallback(defer.keep_param, self._cache.freshen_entries)
             d.addBoth(defer.keep_param, entry.got_response)
+            d.addBoth(defer.bridge_param, self._cache.account, cache_id, entry)
             d.addErrback(self._error_handler)
             return entry.wait()
         else:
             d.addCallbacks(apply_parsers, self._error_handler,
                            callbackArgs=(parser, tag, ))
+            if method.__name__ != 'get':
+                # don't wait for the changes feed to expire the entries
+                # depending on what we have just modified
+                d.addBoth(self._notice_write)
             return d
 
+    def _notice_write(self, result):
+        if isinstance(result, failure.Failure):
+            # we cannot tell what has been modified
+            self._cache.expire_tokens()
+            return result
+        doc_ids = list()
+        if isinstance(result, dict) and 'id' in result:
+            doc_ids.append(result['id'])
+        elif isinstance(result, list):
+            doc_ids.extend(x['id'] for x in result
+                           if isinstance(x, dict) and 'id' in x)
+        if not doc_ids:
+            self._cache.changed()
+        for doc_id in doc_ids:
+            self._cache.changed(doc_id)
+        return result
+
     def _configure(self, host, port, name, username, password, https):
         self._cancel_reconnector()
+        self._cache.stop_following()
         self.host, self.port = host, port
         self.username, self.password = username, password
         self.https = https
@@ -633,21 +821,56 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
 
         self._pending_notifications.clear()
         self._document_locks.clear()
+        self._warm_design_docs.clear()
+        self._index_checks.clear()
 
         self.reconnect()
 
+    def _serve_stale(self, design_doc_id):
+        if (not self.stale_until_warm or
+            design_doc_id in self._warm_design_docs):
+            return False
+        checked = self._index_checks.get(design_doc_id)
+        if checked is None or time.time() - checked > self.WARM_CHECK_INTERVAL:
+            d = self.check_view_index(design_doc_id)
+            d.addErrback(self._view_index_check_failed, design_doc_id)
+        return True
+
+    def _view_index_check_failed(self, fail, design_doc_id):
+        error.handle_failure(self, fail, "Failed checking the state of "
+                             "the index of the design document %s",
+                             design_doc_id)
+
     def _setup_notifiers(self):
+        if self._cache_filter is not None:
+            self._get_notifier(self._cache_filter)
         defers = list()
         for notifier in self.notifiers.values():
             defers.append(notifier.setup())
-        return defer.DeferredList(defers, consumeErrors=True)
+        d = defer.DeferredList(defers, consumeErrors=True)
+        if self._cache_filter is not None:
+            d.addCallback(defer.drop_param, self._check_following)
+        return d
 
     def _setup_notifier(self, filter_):
         self.log('Setting up the notifier %s', filter_.name)
-        notifier = self.notifiers.get(filter_.name) or Notifier(self, filter_)
-        self.notifiers[filter_.name] = notifier
+        return self._get_notifier(filter_).setup()
 
-        return notifier.setup()
+    def _get_notifier(self, filter_):
+        if self.multiplex_changes:
+            name = MultiplexedNotifier.name
+            notifier = self.notifiers.get(name) or MultiplexedNotifier(self)
+        else:
+            name = filter_.name
+            notifier = self.notifiers.get(name) or Notifier(self, filter_)
+        self.notifiers[name] = notifier
+        return notifier
+
+    def _check_following(self):
+        if self._get_notifier(self._cache_filter).is_running():
+            self._cache.start_following()
+        else:
+            self._cache.stop_following()
 
     def _on_connected(self):
         common.ConnectionManager._on_connected(self)
@@ -700,9 +923,10 @@ class EntryState(enum.Enum):
 class CacheEntry(object):
 
     __slots__ = (
-        '_parsed', '_parser',
+        '_parsed', '_parser', '_pending_token',
         '_waiting', 'cached_at', 'etag', 'fresh_at', 'last_accessed_at',
-        'num_accessed', 'size', 'state', 'tag')
+        'num_accessed', 'size', 'state', 'tag',
+        'design_doc', 'doc_ids', 'doc_generation', 'token')
 
     def __init__(self, tag, parser):
         # tag is used for error handling
@@ -731,6 +955,18 @@ class CacheEntry(object):
         self.num_accessed = 0
         self.size = None
 
+        # dependencies used for invalidating the entry from the changes feed,
+        # either the design document of the view or the documents fetched
+        self.design_doc = None
+        self.doc_ids = None
+        self.doc_generation = 0
+        # token of the Cache state the entry has been validated at
+        self.token = None
+        self._pending_token = None
+
+    def request_sent(self, token):
+        self._pending_token = token
+
     def wait(self, ctime=None):
         self.last_accessed_at = ctime or time.time()
         self.num_accessed += 1
@@ -752,6 +988,7 @@ class CacheEntry(object):
         elif response.status == 304:
             self.state = EntryState.ready
             self.fresh_at = ctime
+            self.token = self._pending_token
         else:
             self._parsed = apply_parsers(response, self._parser, self.tag)
             if isinstance(self._parsed, failure.Failure):
@@ -765,6 +1002,7 @@ class CacheEntry(object):
                     self.fresh_at = ctime
                 if response.headers.get('etag'):
                     self.etag = response.headers.get('etag')
+                    self.token = self._pending_token
                 else:
                     self.state = EntryState.invalid
 
@@ -779,104 +1017,242 @@ class CacheEntry(object):
         return "<Entry, state: %s, tag: %s>" % (self.state.name, self.tag)
 
 
+# options of view queries passed as they are instead of encoding them
+RAW_VIEW_OPTIONS = frozenset(['stale'])
+
+
+class CachePolicy(enum.Enum):
+    '''
+    lru - the least recently used entries are evicted first
+    slru - segmented lru, the entries which have been used only once are
+           evicted before the ones which have been reused, so that a burst
+           of one-off requests doesn't flush the frequently used entries
+    '''
+
+    lru, slru = range(2)
+
+
+class RecencyList(object):
+    '''
+    Keys ordered from the least recently used, kept as a circular doubly
+    linked list with a dict of its nodes, so that moving a key to the end
+    and removing it don't depend on the number of keys.
+    (collections.OrderedDict is not available in Python 2.6)
+    '''
+
+    PREV, NEXT, KEY = range(3)
+
+    def __init__(self):
+        self._root = root = []
+        root[:] = [root, root, None]
+        # key -> [prev, next, key]
+        self._nodes = dict()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, key):
+        return key in self._nodes
+
+    def __iter__(self):
+        # the key just yielded can be removed while iterating
+        root = self._root
+        node = root[self.NEXT]
+        while node is not root:
+            next_node = node[self.NEXT]
+            yield node[self.KEY]
+            node = next_node
+
+    def append(self, key):
+        '''
+        Adds the key as the most recently used one.
+        '''
+        if key in self._nodes:
+            self.remove(key)
+        root = self._root
+        last = root[self.PREV]
+        last[self.NEXT] = root[self.PREV] = self._nodes[key] = \
+            [last, root, key]
+
+    def remove(self, key):
+        prev, next, _ = self._nodes.pop(key)
+        prev[self.NEXT] = next
+        next[self.PREV] = prev
+
+    def pop_oldest(self):
+        node = self._root[self.NEXT]
+        if node is self._root:
+            raise KeyError("pop_oldest(): the list is empty")
+        key = node[self.KEY]
+        self.remove(key)
+        return key
+
+
 class Cache(dict):
     '''
     url -> CacheEntry
     '''
 
     DEFAULT_DESIRED_SIZE = 10 * 1024 * 1024
-    OPERATIONS_PER_CLEANUP = 500
+    # part of the desired size which can be taken by the reused entries
+    # with the slru policy
+    PROTECTED_RATIO = 0.8
 
-    def __init__(self, desired_size=None):
+    def __init__(self, desired_size=None, policy=CachePolicy.lru):
         super(Cache, self).__init__()
-        self.desired_size = desired_size or self.DEFAULT_DESIRED_SIZE
-        self.average_size = container.RunningAverage(0)
-        self.average_cleanup_time = container.RunningAverage(0)
-        self.last_cleanup = None
-        self._operation = 0
+        self._desired_size = desired_size or self.DEFAULT_DESIRED_SIZE
+        self.policy = CachePolicy.get(policy)
+
+        # identifiers ordered from the least recently used,
+        # with the lru policy all the entries are kept in probation
+        self._probation = RecencyList()
+        self._protected = RecencyList()
+        # identifier -> size accounted for the entry
+        self._sizes = dict()
+        self._size = 0
+        self._protected_size = 0
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+        # Following the changes feed lets us consider the entries fresh
+        # without revalidating them. Any change to a regular document
+        # bumps the generation of views, changes of design documents bump
+        # only the generation of their own views, entries of fetched
+        # documents are bumped when one of these documents changes.
+        # The epoch changes whenever the feed is (re)started or lost.
+        self.following = False
+        self._epoch = 0
+        self._generation = 0
+        # design_doc -> C{int}
+        self._design_generations = dict()
+        # doc_id -> set([identifier])
+        self._dependents = dict()
+
+    @property
+    def desired_size(self):
+        return self._desired_size
+
+    @desired_size.setter
+    def desired_size(self, value):
+        self._desired_size = value
+        self._evict()
 
     def get_url(self, identifier):
-        self._bump_counter()
-        if identifier in self and self[identifier].state != EntryState.invalid:
-            return self[identifier]
+        entry = self.get(identifier)
+        if entry is not None and entry.state != EntryState.invalid:
+            self._touch(identifier)
+            return entry
 
     def __setitem__(self, key, value):
+        if key in self:
+            del self[key]
         super(Cache, self).__setitem__(key, value)
-        self._bump_counter()
-
-    def _bump_counter(self):
-        self._operation += 1
-        if self._operation % self.OPERATIONS_PER_CLEANUP == 0:
-            self.cleanup()
+        self._sizes[key] = 0
+        self._probation.append(key)
+
+    def __delitem__(self, key):
+        entry = self[key]
+        super(Cache, self).__delitem__(key)
+        size = self._sizes.pop(key)
+        self._size -= size
+        if key in self._protected:
+            self._protected.remove(key)
+            self._protected_size -= size
+        else:
+            self._probation.remove(key)
+        for doc_id in entry.doc_ids or ():
+            dependents = self._dependents.get(doc_id)
+            if dependents is not None:
+                dependents.discard(key)
+                if not dependents:
+                    del self._dependents[doc_id]
+
+    def clear(self):
+        for key in self.keys():
+            del self[key]
+
+    def account(self, identifier, entry):
+        '''
+        Called after the entry has received the response. Updates the total
+        size and evicts the entries exceeding the desired size.
+        '''
+        if self.get(identifier) is not entry:
+            # entry has been replaced or evicted in the meantime
+            return
+        if entry.state is EntryState.invalid:
+            del self[identifier]
+            return
+        size = entry.size or 0
+        diff = size - self._sizes[identifier]
+        self._sizes[identifier] = size
+        self._size += diff
+        if identifier in self._protected:
+            self._protected_size += diff
+        self._evict()
 
     def cleanup(self, ctime=None):
         '''
-        This method is called iteratively by the connection owning it.
-        Its job is to control the size of cache and remove old entries.
+        Removes the invalidated entries and makes sure the size of the cache
+        doesn't exceed the desired size. The eviction happens as the entries
+        are accounted, so calling this is not necessary.
         '''
-        ctime = ctime or time.time()
-        if self.last_cleanup:
-            self.average_cleanup_time.add_point(ctime - self.last_cleanup)
-        self.last_cleanup = ctime
+        for key, entry in self.items():
+            if entry.state is EntryState.invalid:
+                del self[key]
+        self._evict()
 
-        log.debug('couchdb', "Running cache cleanup().")
-        # first remove already invalidated entries, used this iteration to
-        # build up the map of usage
-        expire = list()
+    def get_size(self):
+        return self._size
+
+    def track(self, identifier, entry, design_doc=None, doc_ids=None):
+        self[identifier] = entry
+        entry.design_doc = design_doc
+        if doc_ids is not None:
+            entry.doc_ids = tuple(doc_ids)
+            for doc_id in entry.doc_ids:
+                self._dependents.setdefault(doc_id, set()).add(identifier)
+
+    def get_token(self, entry):
+        if entry.doc_ids is not None:
+            return (self._epoch, entry.doc_generation)
+        elif entry.design_doc is not None:
+            return (self._epoch, self._generation,
+                    self._design_generations.get(entry.design_doc, 0))
+
+    def is_fresh(self, entry):
+        return (self.following and entry.token is not None and
+                entry.token == self.get_token(entry))
+
+    def changed(self, doc_id=None):
+        if doc_id is not None and doc_id.startswith('_design/'):
+            design_doc = doc_id.split('/', 1)[1]
+            self._design_generations[design_doc] = (
+                self._design_generations.get(design_doc, 0) + 1)
+        else:
+            self._generation += 1
+        for identifier in self._dependents.get(doc_id, ()):
+            self[identifier].doc_generation += 1
 
-        # [(num_accessed / time_in_cache, size, ident)]
-        usage = list()
+    def expire_tokens(self):
+        self._epoch += 1
 
-        actual_size = 0
+    def start_following(self):
+        if not self.following:
+            self._epoch += 1
+            self.following = True
 
-        for ident, entry in self.iteritems():
-            if entry.state is EntryState.invalid:
-                expire.append(ident)
-                continue
-            elif entry.state is EntryState.waiting:
-                continue
-            else: # EntryState.ready
-                actual_size += entry.size
-                time_in_cache = max([ctime - entry.cached_at, 1])
-                usage.append((
-                    float(entry.num_accessed) / time_in_cache,
-                    -entry.size,
-                    ident))
-
-        self.average_size.add_point(actual_size)
-
-        if self.average_size.get_value() > 3 * self.desired_size:
-            log.warning("couchdb", "The average size of Cache is %.2f times "
-                        "bigger than the desired size of: %s. It might be "
-                        "a good idea to rethink the caching strategy.",
-                        self.average_size.get_value() / self.desired_size,
-                        self.desired_size)
-
-        if actual_size > self.desired_size:
-            log.debug('couchdb', "I will have to cleanup some data, "
-                      "the actual size is: %s, the desired limit is %s.",
-                      actual_size, self.desired_size)
-            # The usage list is sorted in order of things I will
-            # be removing first. The important factor is "density" of usages
-            # in time.
-            usage.sort()
-            size_to_delete = 0
-            num_to_delete = 0
-            while (len(usage) > 1 and
-                   actual_size - size_to_delete > self.desired_size):
-                _, negative_size, ident = usage.pop(0)
-                size_to_delete += -negative_size
-                num_to_delete += 1
-                expire.append(ident)
-            log.debug('couchdb', "I will remove %d entries from cache of the "
-                      "size of %s to compensate the size.",
-                      num_to_delete, size_to_delete)
-
-        for ident in expire:
-            del self[ident]
+    def stop_following(self):
+        if self.following:
+            self._epoch += 1
+            self.following = False
 
-    def get_size(self):
-        return sum([x.size for x in self.itervalues()])
+    def show_statistics(self):
+        return ("hits: %d\nmisses: %d\nrevalidations: %d" %
+                (self.hits, self.misses, self.revalidations))
 
     def freshen_entries(self, response):
         etag = response.headers.get('etag')
@@ -886,6 +1262,37 @@ class Cache(dict):
                 if entry.etag == etag:
                     entry.fresh_at = ctime
 
+    ### private ###
+
+    def _touch(self, identifier):
+        if identifier in self._protected:
+            self._protected.append(identifier)
+        elif self.policy is CachePolicy.slru:
+            # reused entry gets promoted to the protected segment
+            self._probation.remove(identifier)
+            self._protected.append(identifier)
+            self._protected_size += self._sizes[identifier]
+            limit = self._desired_size * self.PROTECTED_RATIO
+            while self._protected_size > limit and len(self._protected) > 1:
+                demoted = self._protected.pop_oldest()
+                self._protected_size -= self._sizes[demoted]
+                self._probation.append(demoted)
+        else:
+            self._probation.append(identifier)
+
+    def _evict(self):
+        # the entries with a request in progress are neither evicted nor
+        # counted, the callers of the same url are waiting for them
+        excess = self._size - self._desired_size
+        for segment in (self._probation, self._protected):
+            for identifier in segment:
+                if excess <= 0 or len(self) <= 1:
+                    return
+                excess -= self._sizes[identifier]
+                if self[identifier].state is not EntryState.waiting:
+                    del self[identifier]
+                    self.evictions += 1
+
 
 def apply_parsers(response, parsers, tag):
     if callable(parsers):
@@ -904,7 +1311,7 @@ def parse_response(response, tag):
     if response.status < 300:
         if (response.headers.get('content-type') == 'application/json'):
             try:
-                return json.loads(response.body)
+                return codec.decode(response.body)
             except ValueError:
                 log.error('couchdb',
                     "Could not parse json data from couchdb. Data: %r",
@@ -21,7 +21,9 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import bisect
 import copy
+import itertools
 import uuid
 import json
 import operator
@@ -45,6 +47,125 @@ class Biggest(object):
 BIGGEST = Biggest()
 
 
+class ViewIndex(object):
+    '''
+    Rows emitted by the map function of the view kept sorted by the key,
+    ties are ordered by the document id. The documents changed since the
+    last query are mapped again before the index is used.
+    '''
+
+    # above this ratio of stale documents to rows the index is sorted
+    # from scratch instead of updating the rows one by one
+    REBUILD_RATIO = 1.0 / 32
+
+    def __init__(self, factory):
+        self.factory = factory
+        # rows are tuples (key, doc_id, emit_index, value), keys are kept
+        # in a separate list in the same order for bisecting
+        self.rows = list()
+        self.keys = list()
+        # doc_id -> rows emitted for the document
+        self.emitted = dict()
+        # ids of the documents to map again
+        self.stale = set()
+        # (group, group_level, ranges) -> reduced rows
+        self.reduced = dict()
+
+    def expire(self, doc_id):
+        self.stale.add(doc_id)
+
+    def update(self, documents):
+        if not self.stale:
+            return
+        self.reduced.clear()
+        if len(self.stale) > len(self.rows) * self.REBUILD_RATIO:
+            self._rebuild(documents)
+            return
+        for doc_id in list(self.stale):
+            for row in self.emitted.pop(doc_id, ()):
+                index = bisect.bisect_left(self.rows, row)
+                del self.rows[index]
+                del self.keys[index]
+            for row in self._map(documents, doc_id):
+                index = bisect.bisect_right(self.rows, row)
+                self.rows.insert(index, row)
+                self.keys.insert(index, row[0])
+            self.stale.discard(doc_id)
+
+    def get_ranges(self, **options):
+        '''
+        Returns the list of (start, end) index ranges of the rows matching
+        the key, keys, startkey and endkey options in the ascending order.
+        '''
+        keys = self.keys
+        descending = options.get('descending', False)
+        lo, hi = 0, len(keys)
+        if 'startkey' in options:
+            if descending:
+                hi = min(hi, bisect.bisect_right(keys, options['startkey']))
+            else:
+                lo = max(lo, bisect.bisect_left(keys, options['startkey']))
+        if 'endkey' in options:
+            if descending:
+                lo = max(lo, bisect.bisect_left(keys, options['endkey']))
+            else:
+                hi = min(hi, bisect.bisect_right(keys, options['endkey']))
+        if 'key' in options:
+            lo = max(lo, bisect.bisect_left(keys, options['key']))
+            hi = min(hi, bisect.bisect_right(keys, options['key']))
+        if 'keys' not in options:
+            return [(lo, hi)] if lo < hi else []
+
+        ranges = list()
+        requested = sorted(options['keys'])
+        for position, key in enumerate(requested):
+            if position and key == requested[position - 1]:
+                continue
+            start = max(lo, bisect.bisect_left(keys, key))
+            end = min(hi, bisect.bisect_right(keys, key))
+            if start < end:
+                ranges.append((start, end))
+        return ranges
+
+    def iterrows(self, ranges, descending=False):
+        '''
+        Iterates over the rows in the ranges as tuples (key, value, id).
+        '''
+        rows = self.rows
+        if descending:
+            for start, end in reversed(ranges):
+                for index in xrange(end - 1, start - 1, -1):
+                    key, doc_id, _, value = rows[index]
+                    yield key, value, doc_id
+        else:
+            for start, end in ranges:
+                for index in xrange(start, end):
+                    key, doc_id, _, value = rows[index]
+                    yield key, value, doc_id
+
+    ### private ###
+
+    def _rebuild(self, documents):
+        rows = [row for row in self.rows if row[1] not in self.stale]
+        for doc_id in list(self.stale):
+            self.emitted.pop(doc_id, None)
+            rows.extend(self._map(documents, doc_id))
+            self.stale.discard(doc_id)
+        rows.sort()
+        self.rows = rows
+        self.keys = [row[0] for row in rows]
+
+    def _map(self, documents, doc_id):
+        doc = documents.get(doc_id)
+        if doc is None or doc.get('_deleted', False):
+            return ()
+        rows = [(key, doc_id, index, value) for index, (key, value)
+                in enumerate(self.factory.perform_map(doc))]
+        if rows:
+            self.emitted[doc_id] = rows
+        return rows
+
+
 class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
                common.Statistics):
 
@@ -66,8 +187,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         self._documents = {}
         # id -> name -> body
         self._attachments = {}
-        # id -> view_name -> (key, value)
-        self._view_cache = {}
+        # (design_doc_id, view_name) -> ViewIndex
+        self._view_indexes = {}
 
         self._on_connected()
 
@@ -105,49 +226,37 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             if not isinstance(doc, (str, unicode, )):
                 raise ValueError('Doc should be either str or unicode')
             doc = json.loads(doc)
-            doc = self._set_id_and_revision(doc, doc_id)
-
             self.increase_stat('save_doc')
-
-            self._documents[doc['_id']] = doc
-            if doc['_id'] not in self._attachments:
-                self._attachments[doc['_id']] = dict()
-            attachments = doc.get('_attachments', dict())
-            for name in attachments:
-                if attachments[name].get('follows'):
-                    if name not in following_attachments:
-                        raise ValueError("Document id %s had attachment name"
-                                         " %s marked with follows=True, but"
-                                         " it was not passed to save_doc() "
-                                         % (doc['_id'], name))
-
-                    del attachments[name]['follows']
-                    attachments[name]['stub'] = True
-                    b = following_attachments[name].get_body()
-                    self._attachments[doc['_id']][name] = b
-
-                elif name not in self._attachments[doc['_id']]:
-                    raise ValueError("Document id %s body has attachment "
-                                     "named %s "
-                                     "but it is not in our cache " %
-                                     (doc['_id'], name))
-            for name in self._attachments[doc['_id']].keys():
-                if name not in attachments:
-                    del self._attachments[doc['_id']][name]
-                    self.log('Deleted attachment %s of the doc: %s because '
-                             'its not in the _attachments key' %
-                             (name, doc['_id']))
-
-            self._expire_cache(doc['_id'])
-
-            r = Response(ok=True, id=doc['_id'], rev=doc['_rev'])
-            self._analize_changes(doc)
-            d.callback(r)
+            d.callback(self._save_doc(doc, doc_id, following_attachments))
         except (ConflictError, ValueError, ) as e:
             d.errback(e)
 
         return d
 
+    def bulk_save(self, docs):
+        '''Imitate the _bulk_docs request. Conflicts are reported in the
+        result rows instead of failing the whole request.'''
+
+        self.log("bulk_save called for %d docs", len(docs))
+
+        try:
+            docs = [json.loads(doc) for doc in docs]
+        except ValueError as e:
+            return defer.fail(e)
+
+        self.increase_stat('bulk_save')
+        result = list()
+        for doc in docs:
+            try:
+                result.append(self._save_doc(doc))
+            except ConflictError as e:
+                result.append(dict(id=doc.get('_id'), error='conflict',
+                                   reason=str(e)))
+            except ValueError as e:
+                result.append(dict(id=doc.get('_id'), error='bad_request',
+                                   reason=str(e)))
+        return defer.succeed(result)
+
     def _analize_changes(self, doc):
         for filter_i in self._filters.itervalues():
             if filter_i.match(doc):
@@ -222,8 +331,6 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             raise ValueError("Query parameter 'include_docs' is invalid for "
                              "reduce views.")
 
-        iterator = (self._perform_map(doc, factory)
-                    for doc in self._iterdocs())
         # In erlang ordering of objects is different than in python.
         # Empty dict ({}) is the "biggest" value, by convetion its used
         # to denote the end of the range. In python {} < str, so we substitute
@@ -232,15 +339,15 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             if keyname in options and isinstance(options[keyname], tuple):
                 options[keyname] = tuple(x if x != {} else BIGGEST
                                          for x in options[keyname])
-        d = defer.succeed(iterator)
-        d.addCallback(self._flatten, **options)
+        d = defer.succeed(factory)
+        d.addCallback(self._get_index)
         if use_reduce:
-            d.addCallback(self._perform_reduce, factory, group=group,
-                          group_level=group_level)
+            d.addCallback(self._query_reduced, group=group,
+                          group_level=group_level, **options)
+        else:
+            d.addCallback(self._query_rows, **options)
         if include_docs:
             d.addCallback(self._include_docs)
-        d.addCallback(self._apply_slice, **options)
-        d.addCallback(self._sort_by_key, **options)
         if 'post_process' in options:
             tag = 'query to %s' % (factory.name, )
             if callable(options['post_process']):
@@ -250,6 +357,10 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
                               *options['post_process'][1:])
         return d
 
+    def check_view_index(self, design_doc_id):
+        # the index is updated when the view is queried
+        return defer.succeed(True)
+
     def disconnect(self):
         pass
 
@@ -266,6 +377,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             length=attachment.length)
         self._attachments[doc['_id']][attachment.name] = attachment.get_body()
         self._set_id_and_revision(doc, doc_id)
+        self._expire_cache(doc['_id'])
         r = Response(ok=True, id=doc['_id'], rev=doc['_rev'])
         return defer.succeed(r)
 
@@ -313,6 +425,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         attachments if necessary.'''
         doc = json.loads(body)
         self._documents[doc['_id']] = doc
+        self._expire_cache(doc['_id'])
         self._attachments[doc['_id']] = dict()
         for name in doc.get('_attachments', list()):
             attachment_body = attachment_bodies.get(name, 'stub')
@@ -320,6 +433,45 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
     ### private ###
 
+    def _save_doc(self, doc, doc_id=None, following_attachments=None):
+        doc = self._set_id_and_revision(doc, doc_id)
+        following_attachments = following_attachments or dict()
+
+        self._documents[doc['_id']] = doc
+        if doc['_id'] not in self._attachments:
+            self._attachments[doc['_id']] = dict()
+        attachments = doc.get('_attachments', dict())
+        for name in attachments:
+            if attachments[name].get('follows'):
+                if name not in following_attachments:
+                    raise ValueError("Document id %s had attachment name"
+                                     " %s marked with follows=True, but"
+                                     " it was not passed to save_doc() "
+                                     % (doc['_id'], name))
+
+                del attachments[name]['follows']
+                attachments[name]['stub'] = True
+                b = following_attachments[name].get_body()
+                self._attachments[doc['_id']][name] = b
+
+            elif name not in self._attachments[doc['_id']]:
+                raise ValueError("Document id %s body has attachment "
+                                 "named %s "
+                                 "but it is not in our cache " %
+                                 (doc['_id'], name))
+        for name in self._attachments[doc['_id']].keys():
+            if name not in attachments:
+                del self._attachments[doc['_id']][name]
+                self.log('Deleted attachment %s of the doc: %s because '
+                         'its not in the _attachments key' %
+                         (name, doc['_id']))
+
+        self._expire_cache(doc['_id'])
+
+        r = Response(ok=True, id=doc['_id'], rev=doc['_rev'])
+        self._analize_changes(doc)
+        return r
+
     def _include_docs(self, rows):
         '''rows here are tuples (key, value, id), returns a list of tuples
         (key, value, id, doc)'''
@@ -348,60 +500,44 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         limit = slice_options.get('limit', None)
 
         if skip > 0 or limit is not None:
-            if limit is None:
-                index = slice(skip, -1)
-            else:
-                index = slice(skip, skip + limit)
-            rows = rows[index]
-
-        return rows
-
-    def _sort_by_key(self, rows, **options):
-        descend = options.get('descending', False)
-        return sorted(rows, key=operator.itemgetter(0), reverse=descend)
-
-    def _matches_filter(self, tup, **filter_options):
-        if 'key' in filter_options:
-            if filter_options['key'] != tup[0]:
-                return False
-        if 'keys' in filter_options:
-            if tup[0] not in filter_options['keys']:
-                return False
-        descending = filter_options.get('descending', False)
-        if 'startkey' in filter_options:
-            if ((not descending and filter_options['startkey'] > tup[0]) or
-                (descending and filter_options['startkey'] < tup[0])):
-                return False
-        if 'endkey' in filter_options:
-            if ((not descending and filter_options['endkey'] < tup[0]) or
-                (descending and filter_options['endkey'] > tup[0])):
-                return False
-        return True
-
-    def _flatten(self, iterator, **filter_options):
-        '''
-        iterator here gives as lists of tuples. Method flattens the structure
-        to a single list of tuples.
-        '''
-        resp = list()
-        for entry in iterator:
-            for tup in entry:
-                if self._matches_filter(tup, **filter_options):
-                    resp.append(tup)
-        return resp
-
-    def _perform_map(self, doc, factory):
-        cached = self._get_cache(doc['_id'], factory.name)
-        if cached:
-            return cached
-        res = list(x + (doc['_id'], ) for x in factory.perform_map(doc))
-        self._set_cache(doc['_id'], factory.name, res)
-        return res
+            stop = skip + limit if limit is not None else None
+            rows = itertools.islice(rows, skip, stop)
+
+        return list(rows)
+
+    def _get_index(self, factory):
+        name = (factory.design_doc_id, factory.name)
+        index = self._view_indexes.get(name)
+        if index is None or index.factory is not factory:
+            index = ViewIndex(factory)
+            index.stale.update(self._documents)
+            self._view_indexes[name] = index
+        index.update(self._documents)
+        return index
+
+    def _query_rows(self, index, **options):
+        ranges = index.get_ranges(**options)
+        rows = index.iterrows(ranges, options.get('descending', False))
+        return self._apply_slice(rows, **options)
+
+    def _query_reduced(self, index, group=False, group_level=None,
+                       **options):
+        ranges = index.get_ranges(**options)
+        cache_key = (group, group_level, tuple(ranges))
+        if cache_key not in index.reduced:
+            index.reduced[cache_key] = self._perform_reduce(
+                index.iterrows(ranges), index.factory,
+                group=group, group_level=group_level)
+        rows = index.reduced[cache_key]
+        if options.get('descending', False):
+            rows = reversed(rows)
+        return self._apply_slice(rows, **options)
 
     def _perform_reduce(self, map_results, factory, group=False,
                         group_level=None):
         '''
-        map_results here is a list of tuples (key, value, id)
+        map_results here is an iterable of tuples (key, value, id) sorted
+        by the key
         '''
 
         def get_group_key(key, group, group_level):
@@ -410,19 +546,19 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             return key[0:group_level]
 
         if not group and group_level is None:
+            map_results = list(map_results)
             keys = map(operator.itemgetter(0), map_results)
             values = map(operator.itemgetter(1), map_results)
             return self._reduce_values(factory, None, keys, values)
         else:
-            groups = dict()
-            for row in map_results:
-                key, value = row[:2]
-                group_key = get_group_key(key, group, group_level)
-                if group_key not in groups:
-                    groups[group_key] = list()
-                groups[group_key].append((key, value))
+            # map results come sorted by the key, so the rows of each group
+            # are next to each other
             resp = list()
-            for group_key, results in groups.iteritems():
+            groups = itertools.groupby(
+                map_results,
+                lambda row: get_group_key(row[0], group, group_level))
+            for group_key, results in groups:
+                results = list(results)
                 keys = map(operator.itemgetter(0), results)
                 values = map(operator.itemgetter(1), results)
                 resp.extend(
@@ -443,22 +579,9 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
         return [(group_key, result, )]
 
-    def _iterdocs(self):
-        for did, doc in self._documents.iteritems():
-            if doc.get('_deleted', False):
-                continue
-            yield doc
-
-    def _get_cache(self, doc_id, view_name):
-        return self._view_cache.get(doc_id, {}).get(view_name, None)
-
-    def _set_cache(self, doc_id, view_name, value):
-        if doc_id not in self._view_cache:
-            self._view_cache[doc_id] = dict()
-        self._view_cache[doc_id][view_name] = value
-
     def _expire_cache(self, doc_id):
-        self._view_cache.pop(doc_id, None)
+        for index in self._view_indexes.itervalues():
+            index.expire(doc_id)
 
     def _set_id_and_revision(self, doc, doc_id):
         doc_id = doc_id or doc.get('_id', None)
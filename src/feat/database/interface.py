@@ -125,6 +125,21 @@ class IDatabaseClient(Interface):
                   set)
         '''
 
+    def save_documents(documents):
+        '''
+        Save multiple documents into the database in a single request.
+        Conflicts are reported per document, the documents which were
+        saved have their id and revision updated in place. Documents
+        registered to be saved together with the saved documents are
+        saved in a following request.
+
+        @param documents: C{list} of documents to be saved.
+        @returns: Deferred called with the C{list} of the same length as the
+                  documents passed. Each item is either the updated
+                  Document or the instance of L{ConflictError} or
+                  L{DatabaseError} explaining why it was not saved.
+        '''
+
     def get_document(document_id):
         '''
         Download the document from the database and instantiate it.
@@ -217,6 +232,16 @@ class IDatabaseClient(Interface):
         @rtype: C{list} of results.
         '''
 
+    def is_view_warm(factory):
+        '''
+        Checks if the index of the view is up to date, so that querying it
+        doesn't have to wait for the indexer.
+        @param factory: View factory to check.
+        @type  factory: L{feat.interface.view.IViewFactory}
+        @rtype: Deferred
+        @callback: C{bool}
+        '''
+
     def disconnect():
         '''
         Disconnect from database server.
@@ -251,7 +276,9 @@ class IDatabaseDriver(Interface):
     def save_doc(doc, doc_id=None):
         '''
         Create new or update existing document.
-        @param doc: string with json document
+        @param doc: string with json document, it might be an instance of
+                    L{feat.database.codec.JSONDocument} which keeps
+                    the structure the document was encoded from
         @param doc_id: id of the document
         @return: Deferred fired with the HTTP response body (keys: id, rev)
         '''
@@ -300,6 +327,13 @@ class IDatabaseDriver(Interface):
         Query the view. See L{IDatabaseClient.query_view}.
         '''
 
+    def check_view_index(design_doc_id):
+        '''
+        Checks if the index of the design document is up to date.
+        @rtype: Deferred
+        @callback: C{bool}
+        '''
+
     def save_attachment(doc_id, revision, attachment):
         '''
         Saves the attachment to the database.
@@ -348,6 +382,17 @@ class IDatabaseDriver(Interface):
         @callback: list of documents
         '''
 
+    def bulk_save(docs):
+        '''
+        Like save_doc() but creates or updates multiple documents
+        in a single request.
+        @param docs: C{list} of strings with json documents
+        @rtype: Deferred
+        @callback: C{list} of C{dict} in the order of the documents passed,
+                   each having either the keys: id, rev or the keys: id,
+                   error, reason
+        '''
+
     def get_query_cache(self, create=True):
         '''Called by methods inside feat.database.query module to obtain
         the query cache.
@@ -566,6 +611,21 @@ class IQueryIndex(Interface):
         @returns: value or None
         '''
 
+    def get_numbers():
+        '''
+        Returns the entries translated to the dense numbers of the documents,
+        used to walk the index when sorting the query result.
+        @rtype: C{array.array}
+        '''
+
+    def get_bitmap():
+        '''
+        Returns the set of the documents in the index as a bitmap of their
+        numbers. The bitmaps of the indexes are combined to calculate
+        the query result.
+        @rtype: C{long}
+        '''
+
 
 class IPlanBuilder(Interface):
 
@@ -318,6 +318,9 @@ class QueryView(model.Collection):
     @classmethod
     def __class__init__(cls, name, bases, dct):
         cls._query_set_factory = None
+        # ordered results of the queries, paginating through the same
+        # query doesn't need to calculate it again
+        cls._query_cache = query.QueryCache()
 
     def init(self):
         context = IContextMaker(self).make_context()
@@ -341,10 +344,10 @@ class QueryView(model.Collection):
         else:
             method = query.select
         return method(self.connection, value, skip, limit,
-                      include_responses=True)
+                      include_responses=True, cache=self._query_cache)
 
     def do_count(self, value):
-        return query.count(self.connection, value)
+        return query.count(self.connection, value, cache=self._query_cache)
 
     def fetch_values(self, value, fields):
         res = applicationjson.AsyncDict()
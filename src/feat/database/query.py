@@ -1,6 +1,11 @@
+import array
+import binascii
 import decimal
 import inspect
+import itertools
+import operator
 import time
+import weakref
 
 from zope.interface import implements, classProvides
 
@@ -12,10 +17,65 @@ from feat.database.interface import IQueryIndex
 from feat.interface.serialization import IRestorator, ISerializable
 
 
+class DocumentIds(object):
+    '''
+    Assigns dense integers to the document ids seen in the query indexes,
+    so that the indexes can be combined as bitmaps. Once the mapping grows
+    past the limit it is started over in a new generation and the indexes
+    translate their entries again on the next use.
+    '''
+
+    limit = 2 ** 20
+
+    # generations are unique across the instances
+    _generations = itertools.count(1)
+
+    def __init__(self, limit=None):
+        self.limit = limit or type(self).limit
+        self.reset()
+
+    def reset(self):
+        self.generation = next(self._generations)
+        self._numbers = dict() # doc_id -> number
+        self._ids = list() # number -> doc_id
+
+    def rotate(self):
+        '''
+        Starts over if the mapping got too big. Should only be called
+        before calculating a query, not while combining its indexes.
+        '''
+        if len(self._ids) > self.limit:
+            self.reset()
+
+    def get_numbers(self, ids):
+        numbers = self._numbers
+        known = self._ids
+        result = array.array('l')
+        append = result.append
+        for doc_id in ids:
+            number = numbers.get(doc_id)
+            if number is None:
+                number = numbers[doc_id] = len(known)
+                known.append(doc_id)
+            append(number)
+        return result
+
+    def get_id(self, number):
+        return self._ids[number]
+
+    def __len__(self):
+        return len(self._ids)
+
+
+_document_ids = DocumentIds()
+
+
 class ParsedIndex(object):
 
     implements(IQueryIndex)
 
+    _generation = None
+
     def __init__(self, entries, keep_value=False):
         self.includes_values = keep_value
         if not keep_value:
@@ -32,6 +92,28 @@ class ParsedIndex(object):
     def get_value(self, id):
         return self.values.get(id)
 
+    def get_numbers(self):
+        '''
+        Returns the entries translated to the dense document numbers.
+        '''
+        self._translate()
+        return self._numbers
+
+    def get_bitmap(self):
+        '''
+        Returns the C{long} with the bits of the document numbers set.
+        '''
+        self._translate()
+        return self._bitmap
+
+    def _translate(self):
+        # the index is cached by the connection, it is translated once
+        # per generation of the document numbers
+        if self._generation != _document_ids.generation:
+            self._numbers = _document_ids.get_numbers(self.entries)
+            self._bitmap = _to_bitmap(self._numbers)
+            self._generation = _document_ids.generation
+
 
 class Field(object):
 
@@ -540,40 +622,124 @@ class Result(list):
         return cls()
 
 
+class CachedResult(object):
+
+    __slots__ = ('indexes', 'ids', 'aggregations')
+
+    def __init__(self, responses, ids, aggregations):
+        # the indexes are referenced weakly, so that the entries
+        # evicted by the connection cache are not kept alive
+        self.indexes = dict((k, weakref.ref(v))
+                            for k, v in responses.iteritems())
+        self.ids = ids
+        self.aggregations = aggregations
+
+    def is_valid(self, responses):
+        if len(responses) != len(self.indexes):
+            return False
+        for key, index in responses.iteritems():
+            ref = self.indexes.get(key)
+            if ref is None or ref() is not index:
+                return False
+        return True
+
+
+class QueryCache(object):
+    '''
+    Keeps the ordered ids of the query results, so that fetching the next
+    page doesn't need to calculate the result again. The subqueries are
+    still fetched; the connection returns the same index objects for as
+    long as the ETags of the view responses don't change. An entry is
+    only used if it was calculated from the very same indexes.
+    '''
+
+    size = 50
+
+    def __init__(self, size=None):
+        self.size = size or type(self).size
+        # normalized query -> (last use, CachedResult), the cache is small
+        # so the least recently used entry is simply searched for
+        self._entries = dict()
+        self._uses = itertools.count()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query, responses):
+        key = _get_cache_key(query)
+        _, entry = self._entries.get(key, (None, None))
+        if entry is None or not entry.is_valid(responses):
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries[key] = (next(self._uses), entry)
+        self.hits += 1
+        return entry
+
+    def put(self, query, responses, ids, aggregations=None):
+        key = _get_cache_key(query)
+        entry = CachedResult(responses, ids, aggregations)
+        self._entries[key] = (next(self._uses), entry)
+        while len(self._entries) > self.size:
+            oldest = min(self._entries, key=self._entries.get)
+            del self._entries[oldest]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
 @defer.inlineCallbacks
 def select_ids(connection, query, skip=0, limit=None,
-               include_responses=False):
-    temp, responses = yield _get_query_response(connection, query)
+               include_responses=False, cache=None):
+    responses = yield _fetch_responses(connection, query)
 
-    total_count = len(temp)
     if limit is not None:
         stop = skip + limit
     else:
         stop = None
 
-    name, direction = query.sorting
-    index = first(v.entries
-                  for k, v in responses.iteritems() if k.field == name)
-
-    if direction == Direction.DESC:
-        index = reversed(index)
-
-    if query.aggregate:
-        # we have to copy the collection, because _get_sorted_slice()
-        # treats it as a buffer, and modifies the content
-        aggregate_index = set(temp)
-
-    r = Result(_get_sorted_slice(index, temp, skip, stop))
-    r.total_count = total_count
-
-    # count reductions for aggregated fields based on the view index
-    if query.aggregate:
-        r.aggregations = list()
-        for handler, field in query.aggregate:
-            value_index = first(v for k, v in responses.iteritems()
-                                if k.field == field)
-            r.aggregations.append(handler(
-                x for x in value_iterator(aggregate_index, value_index)))
+    cached = cache is not None and cache.get(query, responses)
+    if cached:
+        r = Result(cached.ids[skip:stop])
+        r.total_count = len(cached.ids)
+        if cached.aggregations is not None:
+            r.aggregations = list(cached.aggregations)
+    else:
+        _document_ids.rotate()
+        bitmap = _calculate_query_response(responses, query)
+
+        name, direction = query.sorting
+        index = first(v.get_numbers()
+                      for k, v in responses.iteritems() if k.field == name)
+
+        if direction == Direction.DESC:
+            index = reversed(index)
+
+        if cache is None:
+            r = Result(_get_sorted_slice(index, bitmap, skip, stop))
+        else:
+            # the whole order is kept for fetching the other pages
+            ids = list(_get_sorted_slice(index, bitmap, 0, None))
+            r = Result(ids[skip:stop])
+        r.total_count = _count(bitmap)
+
+        # count reductions for aggregated fields based on the view index
+        if query.aggregate:
+            r.aggregations = list()
+            for handler, field in query.aggregate:
+                value_index = first(v for k, v in responses.iteritems()
+                                    if k.field == field)
+                r.aggregations.append(handler(
+                    x for x in value_iterator(_iter_ids(bitmap),
+                                              value_index)))
+        if cache is not None:
+            aggregations = r.aggregations
+            if aggregations is not None:
+                aggregations = list(aggregations)
+            cache.put(query, responses, ids, aggregations)
+
     if include_responses:
         defer.returnValue((r, responses))
     else:
@@ -588,9 +754,10 @@ def value_iterator(index, value_index):
 
 
 @defer.inlineCallbacks
-def select(connection, query, skip=0, limit=None, include_responses=False):
+def select(connection, query, skip=0, limit=None, include_responses=False,
+           cache=None):
     res, responses = yield select_ids(connection, query, skip, limit,
-                                      include_responses=True)
+                                      include_responses=True, cache=cache)
     temp = yield connection.bulk_get(res)
     res.update(temp)
 
@@ -614,9 +781,13 @@ def include_values(docs, responses, query):
 
 
 @defer.inlineCallbacks
-def count(connection, query):
-    temp, responses = yield _get_query_response(connection, query)
-    defer.returnValue(len(temp))
+def count(connection, query, cache=None):
+    responses = yield _fetch_responses(connection, query)
+    cached = cache is not None and cache.get(query, responses)
+    if cached:
+        defer.returnValue(len(cached.ids))
+    _document_ids.rotate()
+    defer.returnValue(_count(_calculate_query_response(responses, query)))
 
 
 @defer.inlineCallbacks
@@ -627,7 +798,7 @@ def values(connection, query, field, unique=True):
     query.include_value.append(field)
     query.reset() # ensures the field condition gets included
 
-    temp, responses = yield _get_query_response(connection, query)
+    bitmap, responses = yield _get_query_response(connection, query)
     index = first(v for k, v in responses.iteritems()
                   if k.field == field)
     if not index.includes_values:
@@ -638,12 +809,12 @@ def values(connection, query, field, unique=True):
                          (field, query.name))
     if unique:
         resp = set()
-        for x in temp:
+        for x in _iter_ids(bitmap):
             resp.add(index.get_value(x))
         defer.returnValue(list(resp))
     else:
         resp = list()
-        for x in temp:
+        for x in _iter_ids(bitmap):
             resp.append(index.get_value(x))
         defer.returnValue(resp)
 
@@ -661,7 +832,7 @@ def _do_fetch(connection, responses, ctime, factory, subquery):
 
 
 @defer.inlineCallbacks
-def _get_query_response(connection, query):
+def _fetch_responses(connection, query):
     responses = dict()
     defers = list()
 
@@ -684,6 +855,13 @@ def _get_query_response(connection, query):
             if not success:
                 defer.returnValue(res)
 
+    defer.returnValue(responses)
+
+
+@defer.inlineCallbacks
+def _get_query_response(connection, query):
+    responses = yield _fetch_responses(connection, query)
+    _document_ids.rotate()
     defer.returnValue((_calculate_query_response(responses, query), responses))
 
 
@@ -699,7 +877,7 @@ def _calculate_query_response(responses, query):
     for part in query.parts:
         if isinstance(part, Condition):
             key = part.get_basic_queries()[0]
-            for_parts.append(set(responses[key].entries))
+            for_parts.append(responses[key].get_bitmap())
         elif isinstance(part, Query):
             for_parts.append(_calculate_query_response(responses, part))
     if len(for_parts) == 1:
@@ -707,37 +885,111 @@ def _calculate_query_response(responses, query):
 
     operators = list(query.operators)
     if operators[0] == Operator.AND:
-        return set.intersection(*for_parts)
+        return reduce(operator.and_, for_parts)
     elif operators[0] == Operator.OR:
-        return set.union(*for_parts)
+        return reduce(operator.or_, for_parts)
     else:
-        raise ValueError("Unkown operator '%r' %" (operators[0], ))
+        raise ValueError("Unkown operator '%r'" % (operators[0], ))
 
 
-def _get_sorted_slice(index, rows, skip, stop):
-    seen = 0
+def _get_cache_key(query):
+    # the order of the parts doesn't change the result of the query
+    return (_normalize(query), tuple(query.sorting),
+            tuple(query.aggregate or ()))
+
+
+def _normalize(part):
+    if isinstance(part, Condition):
+        return part
+    operators = tuple(set(part.operators))
+    return (type(part), operators,
+            frozenset(_normalize(x) for x in part.parts))
+
+
+def _get_sorted_slice(index, bitmap, skip, stop):
+    '''
+    Yields the ids of the documents in the bitmap in the order of the index.
+    The documents missing in the index come after them sorted by their ids,
+    the document numbers depend on the previous queries so the order
+    of the numbers would not be stable.
+    '''
+    # the bitmap is copied to a buffer and the bits are cleared
+    # while walking the index, the index can repeat the same document
+    rows = _to_buffer(bitmap)
+    size = len(rows)
+    remaining = _count(bitmap)
     if stop is None:
-        stop = len(rows)
+        stop = remaining
+    seen = 0
 
-    for value in index:
-        if not rows:
+    for number in index:
+        if seen >= stop or not remaining:
             return
-        try:
-            rows.remove(value)
-        except KeyError:
+        byte = number >> 3
+        if byte >= size:
             continue
+        mask = 1 << (number & 7)
+        if not rows[byte] & mask:
+            continue
+        rows[byte] ^= mask
+        remaining -= 1
 
         seen += 1
-        if skip < seen <= stop:
-            yield value
-        if seen > stop:
-            break
-    else:
-        # if we haven't reached the sorted target,
-        # now just return the rows as they appear
-        missing = stop - seen
-        try:
-            for x in range(missing):
-                yield rows.pop()
-        except KeyError:
-            pass
+        if seen > skip:
+            yield _document_ids.get_id(number)
+
+    # if we haven't reached the sorted target,
+    # now just return the rest of the rows
+    if seen >= stop:
+        return
+    get_id = _document_ids.get_id
+    missing = sorted(get_id(number) for number in _iter_numbers(rows))
+    for doc_id in missing[max(skip - seen, 0):stop - seen]:
+        yield doc_id
+
+
+### bitmaps of document numbers ###
+
+# byte -> positions of the bits set in it
+_BITS = tuple(tuple(x for x in range(8) if byte & (1 << x))
+              for byte in range(256))
+
+
+def _to_bitmap(numbers):
+    if not numbers:
+        return 0
+    rows = bytearray((max(numbers) >> 3) + 1)
+    for number in numbers:
+        rows[number >> 3] |= 1 << (number & 7)
+    rows.reverse()
+    return long(binascii.hexlify(rows), 16)
+
+
+def _to_buffer(bitmap):
+    # returns bytearray with the byte 0 holding the bits 0-7
+    if not bitmap:
+        return bytearray()
+    digits = '%x' % (bitmap, )
+    if len(digits) % 2:
+        digits = '0' + digits
+    rows = bytearray(binascii.unhexlify(digits))
+    rows.reverse()
+    return rows
+
+
+def _count(bitmap):
+    return bin(bitmap).count('1')
+
+
+def _iter_numbers(rows):
+    for byte, value in enumerate(rows):
+        if value:
+            base = byte << 3
+            for bit in _BITS[value]:
+                yield base + bit
+
+
+def _iter_ids(bitmap):
+    get_id = _document_ids.get_id
+    for number in _iter_numbers(_to_buffer(bitmap)):
+        yield get_id(number)
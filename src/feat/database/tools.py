@@ -24,10 +24,11 @@ import os
 import re
 
 from twisted.internet import reactor, task
+from twisted.python import failure
 
 from feat.database import view, driver, document
 from feat.agencies.net import options, config
-from feat.common import log, defer, error, serialization
+from feat.common import log, defer, error, serialization, time
 from feat.agents.application import feat
 from feat import applications
 
@@ -371,13 +372,130 @@ def rebuild_view_index(connection, design_doc):
     return RebuildViewIndex(connection, design_doc).start(10)
 
 
+DEFAULT_WARMUP_CONCURRENCY = 4
+DEFAULT_WARMUP_INTERVAL = 10
+
+
+def warmup_view_indexes(connection, design_docs=None,
+                        concurrency=DEFAULT_WARMUP_CONCURRENCY,
+                        interval=DEFAULT_WARMUP_INTERVAL):
+    return ViewIndexWarmup(connection, design_docs, concurrency,
+                           interval).start()
+
+
+class ViewIndexWarmup(log.Logger):
+    '''
+    Triggers building the indexes of many design documents (by default all
+    the ones defined by the applications) with at most C{concurrency} of them
+    being built at the same time. The rebuilding tasks share a single poll
+    of _active_tasks, which is also used to keep track of the progress.
+    '''
+
+    def __init__(self, connection, design_docs=None,
+                 concurrency=DEFAULT_WARMUP_CONCURRENCY,
+                 interval=DEFAULT_WARMUP_INTERVAL):
+        log.Logger.__init__(self, connection)
+        self.connection = connection
+        self.db = connection._database
+        if design_docs is None:
+            design_docs = view.generate_design_docs()
+        self.design_docs = [x for x in design_docs if x.views]
+        self.interval = interval
+        # design_doc_id -> progress of building the index in percents
+        self.progress = dict((x.doc_id, 0) for x in self.design_docs)
+
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        # result of the last _active_tasks request and its epoch time
+        self._active_tasks = None
+        self._fetched = None
+        # Deferreds waiting for _active_tasks request in progress
+        self._waiting = None
+
+    def start(self):
+        '''
+        Returns the Deferred fired with the list of ids of the design
+        documents which failed to be rebuilt.
+        '''
+        self.info("Warming up the indexes of %d design documents",
+                  len(self.design_docs))
+        d = defer.DeferredList([self._semaphore.run(self._rebuild, x)
+                                for x in self.design_docs],
+                               consumeErrors=True)
+        d.addCallback(self._finished)
+        return d
+
+    def get_progress(self):
+        if not self.progress:
+            return 100
+        return sum(self.progress.itervalues()) / len(self.progress)
+
+    def get_active_tasks(self):
+        if (self._fetched is not None and
+            time.time() - self._fetched < self.interval / 2.0):
+            return defer.succeed(self._active_tasks)
+
+        d = defer.Deferred()
+        if self._waiting is None:
+            self._waiting = [d]
+            req = self.db.couchdb_call(self.db.couchdb.get, '/_active_tasks')
+            req.addBoth(self._got_active_tasks)
+        else:
+            self._waiting.append(d)
+        return d
+
+    ### private ###
+
+    def _rebuild(self, design_doc):
+        task = RebuildViewIndex(self.connection, design_doc,
+                                get_active_tasks=self.get_active_tasks)
+        d = task.start(self.interval)
+        d.addCallback(defer.drop_param, self._update_progress,
+                      design_doc.doc_id, 100)
+        return d
+
+    def _got_active_tasks(self, result):
+        waiting, self._waiting = self._waiting, None
+        if not isinstance(result, failure.Failure):
+            self._active_tasks, self._fetched = result, time.time()
+            for task in result:
+                if (task.get('type') == 'indexer' and
+                    task.get('database') == self.db.db_name and
+                    task.get('design_document') in self.progress):
+                    self._update_progress(task['design_document'],
+                                          task.get('progress', 0))
+        for d in waiting:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _update_progress(self, doc_id, progress):
+        self.progress[doc_id] = progress
+        self.debug("Progress of building the index of %s is %s%%, "
+                   "overall %s%%", doc_id, progress, self.get_progress())
+
+    def _finished(self, results):
+        failed = list()
+        for design_doc, (successful, result) in zip(self.design_docs,
+                                                    results):
+            if not successful:
+                error.handle_failure(
+                    self, result, 'Failed rebuilding the view index of '
+                    'the design document %s', design_doc.doc_id)
+                failed.append(design_doc.doc_id)
+        self.info("Warming up the view indexes finished, %d of %d "
+                  "design documents are ready",
+                  len(self.design_docs) - len(failed), len(self.design_docs))
+        return failed
+
+
 class RebuildViewIndex(task.LoopingCall, log.Logger):
     '''
     LoopingCall() responsible for the view rebuild. On its first call
     it triggeres the view rebuild and waits until indexer has done its job.
     '''
 
-    def __init__(self, connection, design_doc):
+    def __init__(self, connection, design_doc, get_active_tasks=None):
         log.Logger.__init__(self, connection)
         self.connection = connection
         self.db = connection._database
@@ -390,8 +508,13 @@ class RebuildViewIndex(task.LoopingCall, log.Logger):
                                          design_doc.views.keys()[0])
         else:
             self.query = None
+        if get_active_tasks is not None:
+            self.get_active_tasks = get_active_tasks
         task.LoopingCall.__init__(self, self.iterate)
 
+    def get_active_tasks(self):
+        return self.db.couchdb_call(self.db.couchdb.get, '/_active_tasks')
+
     @defer.inlineCallbacks
     def iterate(self):
         if not self.query:
@@ -407,8 +530,7 @@ class RebuildViewIndex(task.LoopingCall, log.Logger):
         else:
             from feat.common import first
 
-            active_tasks = yield self.db.couchdb_call(
-                self.db.couchdb.get, '/_active_tasks')
+            active_tasks = yield self.get_active_tasks()
             relevant = first(
                 x for x in active_tasks
                 if (x.get('type') == 'indexer' and
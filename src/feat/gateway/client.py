@@ -40,7 +40,8 @@ class Client(log.Logger, log.LogProxy):
     @defer.inlineCallbacks
     def request(self, method, host, port, location, **params):
         headers = {'content-type': 'application/json',
-                   'accept': ['application/json', '*; q=0.6']}
+                   'accept': ['application/json', '*; q=0.6'],
+                   'accept-encoding': ['gzip', 'deflate']}
         if params:
             body = json.dumps(params)
         else:
@@ -145,3 +145,6 @@ class Gateway(log.LogProxy, log.Logger):
         server.enable_mime_type(texthtml.MIME_TYPE)
         server.enable_mime_type(applicationjson.MIME_TYPE)
         server.enable_mime_type(applicationoctetstream.MIME_TYPE)
+        server.enable_compression(texthtml.MIME_TYPE)
+        server.enable_compression(applicationjson.MIME_TYPE)
+        server.enable_coalescing()
@@ -430,6 +430,24 @@ class Journaler(model.Model):
     model.attribute('state', value.Enum(journaler.State),
                     getter=getter.source_attr('state'),
                     label='Connection state')
+    model.attribute('queued_bytes', value.Integer(),
+                    getter=call.source_call('get_queued_bytes'),
+                    label='Bytes in cache')
+    model.attribute('saturated', value.Boolean(),
+                    getter=call.source_call('is_saturated'),
+                    label='Applying backpressure')
+    model.attribute('flushes', value.Integer(),
+                    getter=call.model_call('get_flushes'),
+                    label='Flushes done')
+    model.attribute('batch_sizes', value.String(),
+                    getter=call.model_call('get_batch_sizes'),
+                    label='Batch sizes histogram')
+    model.attribute('flush_latency', value.Float(),
+                    getter=call.model_call('get_flush_latency'),
+                    label='Average flush latency')
+    model.attribute('max_flush_latency', value.Float(),
+                    getter=call.model_call('get_max_flush_latency'),
+                    label='Maximum flush latency')
     model.collection('possible_targets',
                      child_names=getter.source_list_names('possible_targets'),
                      child_view=getter.source_list_get('possible_targets'),
@@ -444,7 +462,23 @@ class Journaler(model.Model):
                 label='Journal writer')
 
     def get_pending(self):
-        return len(self.source._cache)
+        return self.source.get_queue_depth()
+
+    def get_flushes(self):
+        return self.source.statistics.flushes
+
+    def get_batch_sizes(self):
+        buckets = []
+        for bound, count in self.source.statistics.batch_sizes:
+            bound = '<=%d' % (bound, ) if bound is not None else 'more'
+            buckets.append('%s: %d' % (bound, count))
+        return ', '.join(buckets)
+
+    def get_flush_latency(self):
+        return self.source.statistics.average_latency or 0.0
+
+    def get_max_flush_latency(self):
+        return self.source.statistics.max_latency or 0.0
 
 
 @featmodels.register_model
@@ -514,6 +548,21 @@ class SQLiteWriter(BaseJournalWriter):
                     getter=getter.source_attr('_filename'))
 
 
+@featmodels.register_model
+@featmodels.register_adapter(journaler.FileWriter, IModel)
+class FileWriter(BaseJournalWriter):
+
+    model.identity('feat.agency.journaler.file_writer')
+    model.attribute('filename', value.String(),
+                    getter=getter.source_attr('_filename'))
+    model.attribute('segments', value.Integer(),
+                    getter=call.model_call('get_segments'),
+                    label='Segment files')
+
+    def get_segments(self):
+        return len(self.source._segments)
+
+
 @featmodels.register_model
 class AgencyAgents(model.Collection):
     model.identity("feat.agency.agents")
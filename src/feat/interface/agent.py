@@ -210,6 +210,16 @@ class IAgencyAgent(Interface):
                   set)
         '''
 
+    def save_documents(documents):
+        '''
+        Save multiple documents into the database in a single request.
+
+        @param documents: C{list} of documents to be saved.
+        @returns: Deferred called with the C{list} of updated Documents,
+                  the documents which could not be saved are replaced by
+                  the instance of the error (for example ConflictError).
+        '''
+
     def get_document(document_id):
         '''
         Download the document from the database and instantiate it.
@@ -20,6 +20,7 @@
 
 # Headers in this file shall remain intact.
 
+import itertools
 import json
 
 from zope.interface import implements
@@ -29,6 +30,8 @@ from feat.common.serialization import json as feat_json
 from feat.common.container import AsyncDict
 from feat.web import document
 
+from feat.models.meta import Metadata, MetadataItem
+from feat.models.model import DynamicModelItem
 from feat.models.interface import IModel, IReference
 from feat.models.interface import IErrorPayload
 from feat.models.interface import IActionPayload, IMetadata, IAttribute
@@ -44,15 +47,27 @@ class ActionPayload(dict):
 
 
 def render_metadata(obj):
-    result = []
+    if isinstance(obj, Metadata) and not has_instance_meta(obj):
+        # only class metadata, the same for all the instances
+        return list(obj.get_class_cache("json-metadata",
+                                        _render_class_metadata))
     if IMetadata.providedBy(obj):
-        metadata = IMetadata(obj)
-        for metaitem in metadata.iter_meta():
-            m = {"name": metaitem.name,
-                 "value": metaitem.value}
-            if metaitem.scheme is not None:
-                m["scheme"] = metaitem.scheme
-            result.append(m)
+        return _render_metadata(IMetadata(obj).iter_meta())
+    return []
+
+
+def _render_class_metadata(cls):
+    return _render_metadata(cls.iter_class_meta())
+
+
+def _render_metadata(items):
+    result = []
+    for metaitem in items:
+        m = {"name": metaitem.name,
+             "value": metaitem.value}
+        if metaitem.scheme is not None:
+            m["scheme"] = metaitem.scheme
+        result.append(m)
     return result
 
 
@@ -203,7 +218,7 @@ def render_compact_model(model, context):
             d.addCallback(render_value, context)
             return d
         return defer.succeed(None)
-    if render_as_list(model):
+    if get_render_plan(model).as_list:
         return render_model_as_list(model, context)
 
     result = AsyncDict()
@@ -215,18 +230,28 @@ def render_compact_model(model, context):
 
 
 def render_compact_items(items, context, result):
+    for name, value in iter_compact_items(items, context):
+        result.add(name, value)
+    return result.wait()
+
+
+def iter_compact_items(items, context):
+    '''
+    Generates the pairs (name, value or Deferred) of the items of the
+    compact model. The items are only fetched when the pair is taken.
+    '''
     for item in items:
-        if render_inline(item):
+        plan = get_render_plan(item)
+        if plan.inline:
             d = item.fetch()
             d.addCallback(render_inline_model, context)
-            result.add(item.name, d)
-        elif iattribute_meta(item) and not prevent_inline(item):
+            yield item.name, d
+        elif plan.attribute:
             d = item.fetch()
             d.addCallback(render_compact_attribute, item, context)
-            result.add(item.name, d)
+            yield item.name, d
         elif item.reference is not None:
-            result.add(item.name, item.reference.resolve(context))
-    return result.wait()
+            yield item.name, item.reference.resolve(context)
 
 
 def _parse_meta(meta_items):
@@ -240,24 +265,98 @@ def get_parsed_meta(meta):
     return parsed
 
 
+class RenderPlan(object):
+    '''
+    How a model or a model item is rendered, as specified by its json
+    metadata. There is a single instance per set of metadata values,
+    the plan of the metadata declared in a class is cached in the class.
+    '''
+
+    __slots__ = ("flags", "as_list", "inline", "attribute")
+
+    def __init__(self, flags):
+        self.flags = flags
+        self.as_list = ('render-as-list', ) in flags
+        self.inline = ('render-inline', ) in flags
+        self.attribute = (not self.inline
+                          and ('attribute', ) in flags
+                          and ('prevent-inline', ) not in flags)
+
+
+# json metadata value -> parsed tuple
+_parsed_values = dict()
+# frozenset of parsed values -> RenderPlan
+_plans = dict()
+
+
+def get_render_plan(meta):
+    '''
+    Returns the RenderPlan of a model or a model item, only the metadata
+    added to the instance itself is parsed every time.
+    '''
+    if isinstance(meta, DynamicModelItem) and not meta.has_own_meta:
+        # the same for all the items of the collection
+        return meta.model.get_class_cache("json-item-plan", _get_item_plan)
+    if isinstance(meta, Metadata):
+        plan = meta.get_class_cache("json-plan", _get_class_plan)
+        instance_meta = list(meta.iter_instance_meta('json'))
+        if not instance_meta:
+            return plan
+        flags = plan.flags.union(_parse_values(instance_meta))
+    elif IMetadata.providedBy(meta):
+        flags = frozenset(_parse_values(meta.get_meta('json')))
+    else:
+        flags = frozenset()
+    return _get_plan(flags)
+
+
+def _get_class_plan(cls):
+    return _get_plan(frozenset(_parse_values(cls.iter_class_meta('json'))))
+
+
+def _get_item_plan(cls):
+    plan = DynamicModelItem.get_class_cache("json-plan", _get_class_plan)
+    child_meta = [MetadataItem(*meta) for meta in cls._item_meta
+                  if meta[0] == 'json']
+    return _get_plan(plan.flags.union(_parse_values(child_meta)))
+
+
+def _get_plan(flags):
+    plan = _plans.get(flags)
+    if plan is None:
+        plan = _plans[flags] = RenderPlan(flags)
+    return plan
+
+
+def _parse_values(meta_items):
+    for item in meta_items:
+        parsed = _parsed_values.get(item.value)
+        if parsed is None:
+            parsed = tuple(_parse_meta(item))
+            _parsed_values[item.value] = parsed
+        yield parsed
+
+
+def has_instance_meta(meta):
+    for _ in meta.iter_instance_meta():
+        return True
+    return False
+
+
 def iattribute_meta(meta):
-    parsed = get_parsed_meta(meta)
-    return ['attribute'] in parsed
+    return ('attribute', ) in get_render_plan(meta).flags
 
 
 def render_inline(meta):
-    parsed = get_parsed_meta(meta)
-    return ['render-inline'] in parsed
+    return get_render_plan(meta).inline
 
 
 def render_as_list(meta):
-    parsed = get_parsed_meta(meta)
-    return ['render-as-list'] in parsed
+    return get_render_plan(meta).as_list
 
 
 def prevent_inline(meta):
-    parsed = get_parsed_meta(meta)
-    return ['prevent-inline'] in parsed
+    return ('prevent-inline', ) in get_render_plan(meta).flags
 
 
 def render_compact_attribute(submodel, item, context):
@@ -292,12 +391,112 @@ def write_model(doc, obj, *args, **kwargs):
     verbose = "format" in kwargs and "verbose" in kwargs["format"]
     if verbose:
         d = render_verbose(obj, context)
-    else:
+    elif doc.encoding == 'nested-json' or IAttribute.providedBy(obj):
+        # nested documents are injected into the structure of the parent
         d = render_compact_model(obj, context)
+    else:
+        return write_compact_model(doc, obj, context)
 
     return d.addCallback(render_json, doc)
 
 
+def write_compact_model(doc, model, context):
+    '''
+    Writes the collection incrementally, the result is the same
+    as render_json() of the result of render_compact_model().
+    '''
+    writer = StreamWriter(doc)
+    if get_render_plan(model).as_list:
+        d = model.fetch_items()
+        d.addCallback(iter_inline_models, context)
+        d.addCallback(writer.write_list)
+        return d
+
+    d = model.fetch_items()
+    d.addCallback(iter_compact_items, context)
+    if model.reference:
+        href = model.reference
+        if not isinstance(href, defer.Deferred):
+            href = defer.succeed(href)
+        href.addCallback(resolve_reference, context)
+        d.addCallback(lambda items: itertools.chain([("href", href)], items))
+    d.addCallback(writer.write_dict)
+    return d
+
+
+def resolve_reference(reference, context):
+    return reference.resolve(context)
+
+
+class StreamWriter(object):
+    '''
+    Writes a JSON list or object to the document as its values resolve.
+    The values are taken from the iterator in windows of limited size,
+    each window is written in the original order once all its values are
+    resolved. The values which fail are left out, like with AsyncDict.
+    The output is formatted the same way as with CustomJSONEncoder.
+    '''
+
+    window = 50
+
+    def __init__(self, doc, window=None):
+        self.window = window or type(self).window
+        self._doc = doc
+        self._encoder = CustomJSONEncoder(encoding=doc.encoding)
+
+    def write_list(self, values):
+        return self._write(iter(values), "[", "]", self._encode_value,
+                           log_failures=True)
+
+    def write_dict(self, pairs):
+        pairs = iter(pairs)
+        names = list()
+
+        def values():
+            for name, value in pairs:
+                names.append(name)
+                yield value
+
+        def encode(value, index):
+            return "%s: %s" % (self._encoder.encode(names[index]),
+                               self._encode_value(value, index))
+
+        return self._write(values(), "{", "}", encode)
+
+    ### private ###
+
+    @defer.inlineCallbacks
+    def _write(self, values, opening, closing, encode, log_failures=False):
+        index = 0
+        written = False
+        while True:
+            window = list(itertools.islice(values, self.window))
+            if not window:
+                break
+            results = yield defer.DeferredList(
+                [x if isinstance(x, defer.Deferred) else defer.succeed(x)
+                 for x in window], consumeErrors=True)
+            chunks = list()
+            for successful, result in results:
+                if successful:
+                    chunks.append(", \n  " if written else opening + "\n  ")
+                    chunks.append(encode(result, index))
+                    written = True
+                elif log_failures:
+                    error.handle_failure(None, result,
+                                         "Failed rendering inline model")
+                index += 1
+            if chunks:
+                self._doc.write("".join(chunks))
+        if written:
+            self._doc.write("\n" + closing)
+        else:
+            self._doc.write(opening + closing)
+
+    def _encode_value(self, value, index):
+        return self._encoder.encode(value).replace("\n", "\n  ")
+
+
 class NestedJson(document.BaseDocument):
     '''
     This is an implementation used to represent nested documents which
@@ -335,13 +534,7 @@ def render_inline_model(obj, context, *args, **kwargs):
 def render_model_as_list(obj, context):
 
     def got_items(items):
-        defers = list()
-        for item in items:
-            d = item.fetch()
-            d.addCallbacks(render_inline_model, filter_model_errors,
-                           callbackArgs=(context, ),
-                           errbackArgs=(item, context))
-            defers.append(d)
+        defers = list(iter_inline_models(items, context))
         return defer.DeferredList(defers, consumeErrors=True)
 
     d = obj.fetch_items()
@@ -351,6 +544,15 @@ def render_model_as_list(obj, context):
     return d
 
 
+def iter_inline_models(items, context):
+    for item in items:
+        d = item.fetch()
+        d.addCallbacks(render_inline_model, filter_model_errors,
+                       callbackArgs=(context, ),
+                       errbackArgs=(item, context))
+        yield d
+
+
 def unpack_deferred_list_result(results):
 
     for successful, result in results:
@@ -40,6 +40,20 @@ def meta(name, value, scheme=None):
                                  name, value, scheme=scheme)
 
 
+# incremented every time some class metadata changes,
+# the values cached with Metadata.get_class_cache() are then recomputed
+_generation = 0
+
+
+def class_meta_changed():
+    """
+    Invalidates all the values derived from class metadata.
+    Should be called after changing anything class metadata depend on.
+    """
+    global _generation
+    _generation += 1
+
+
 class Metadata(annotate.Annotable):
     """I add metadata publishing to another class.
     @see: feat.models.interface.IMetadata"""
@@ -89,6 +103,17 @@ class Metadata(annotate.Annotable):
 
     ### public ###
 
+    def iter_instance_meta(self, *names):
+        """Iterates only over the metadata added to the instance."""
+        instance_meta = getattr(self, "_instance_meta", None)
+        if not instance_meta:
+            return
+        if not names:
+            names = list(instance_meta)
+        for k in names:
+            for m in instance_meta.get(k, ()):
+                yield m
+
     def put_meta(self, name, value, scheme=None):
         item = MetadataItem(name, value, scheme)
         self._put_meta(item.name, item)
@@ -110,12 +135,42 @@ class Metadata(annotate.Annotable):
         """@see: feat.models.meta.meta"""
         item = MetadataItem(name, value, scheme)
         cls._class_meta.put(item.name, item)
+        class_meta_changed()
 
     ### class methods ###
 
     @classmethod
     def apply_class_meta(cls, meta):
         cls._apply_meta(meta, cls._class_meta.put)
+        class_meta_changed()
+
+    @classmethod
+    def iter_class_meta(cls, *names):
+        """Iterates only over the metadata of the class,
+        in the same order than iter_meta()."""
+        class_meta = cls._class_meta
+        if not names:
+            names = set(class_meta)
+        for k in names:
+            if k in class_meta:
+                for m in class_meta[k]:
+                    yield m
+
+    @classmethod
+    def get_class_cache(cls, key, factory):
+        """
+        Returns the value derived from the class metadata by calling
+        factory(cls). It is only computed once per class, until any
+        class metadata changes.
+        """
+        cache = cls.__dict__.get("_class_meta_cache")
+        if cache is None or cache[0] != _generation:
+            cache = (_generation, {})
+            setattr(cls, "_class_meta_cache", cache)
+        values = cache[1]
+        if key not in values:
+            values[key] = factory(cls)
+        return values[key]
 
     @classmethod
     def _apply_meta(cls, meta, fun):
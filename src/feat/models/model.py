@@ -1457,6 +1457,7 @@ class DynamicItemsMixin(object):
     def annotate_child_meta(cls, name, value, scheme=None):
         """@see: feat.models.collection.child_meta"""
         cls._item_meta.append((name, value, scheme))
+        models_meta.class_meta_changed()
 
     @classmethod
     def annotate_child_model(cls, model_factory):
@@ -1479,6 +1480,10 @@ class DynamicItemsMixin(object):
         cls._fetch_view = _validate_effect(effect)
 
 
+def _get_item_meta(cls):
+    return list(cls._item_meta)
+
+
 class MetaCollection(type(AbstractModel)):
 
     @staticmethod
@@ -1534,7 +1539,7 @@ class DynCollection(Collection):
 
 class DynamicModelItem(BaseModelItem):
 
-    __slots__ = ("_name", "_reference", "_child")
+    __slots__ = ("_name", "_reference", "_child", "_own_meta")
 
     implements(IModelItem, IAspect)
 
@@ -1543,13 +1548,26 @@ class DynamicModelItem(BaseModelItem):
         self._name = name
         self._reference = models_reference.Relative(name)
         self._child = None
-        metadata = list(model._item_meta)
+        metadata = model.get_class_cache("item-meta", _get_item_meta)
         if metadata:
             for meta in metadata:
                 self.put_meta(*meta)
+        self._own_meta = False
+
+    ### public ###
+
+    @property
+    def has_own_meta(self):
+        """Tells if the item got any metadata besides the child
+        metadata of the collection, shared by all its items."""
+        return self._own_meta
 
     ### overridden ###
 
+    def _put_meta(self, name, item):
+        self._own_meta = True
+        BaseModelItem._put_meta(self, name, item)
+
     @property
     def aspect(self):
         return self
@@ -219,7 +219,9 @@ class Driver(log.Logger, log.LogProxy, Commands):
             jouropts['filename'] = jourfile
             jouropts['encoding'] = 'zip'
         self._jourwriter = journaler.SqliteWriter(self, **jouropts)
-        self._journaler = journaler.Journaler()
+        # flush on the next iteration, the simulation doesn't wait for
+        # the delayed group commit
+        self._journaler = journaler.Journaler(max_latency=0)
 
         self._output = Output()
         self._parser = manhole.Parser(self, self._output, self,
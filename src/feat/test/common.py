@@ -473,7 +473,9 @@ class AgencyTestHelper(object):
         mesg = rabbitmq.Client(self._messaging, 'agency_queue')
         self._db = database.Database()
         writer = journaler.SqliteWriter(self)
-        journal = journaler.Journaler()
+        # flush on the next iteration, the tests don't wait for
+        # the delayed group commit
+        journal = journaler.Journaler(max_latency=0)
         journal.configure_with(writer)
 
         d = writer.initiate()
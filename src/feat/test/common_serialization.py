@@ -252,6 +252,17 @@ class ConverterTest(common.TestCase):
                            self.unserializer.convert,
                            capabilities=capabilities)
 
+    def testCompiledPlans(self):
+        if self.serializer is None:
+            raise SkipTest("No serializer, cannot test compiled plans")
+
+        # Compiled flattening plans should give the same output
+        # than the generic flattening methods
+        self.checkCompiledPlans(self.serializer.convert,
+                                self.serializer.converter_capabilities)
+        self.checkCompiledPlans(self.serializer.freeze,
+                                self.serializer.freezer_capabilities)
+
     def serialize(self, data):
         return self.serializer.convert(data)
 
@@ -365,6 +376,23 @@ class ConverterTest(common.TestCase):
                 if must_change:
                     self.assertEqualButDifferent(result, expected)
 
+    def checkCompiledPlans(self, converter, capabilities):
+        for _, values, _ in self.symmetry_table(capabilities):
+            for value in values:
+                # Twice to use the plans compiled by the first convertion
+                for _ in range(2):
+                    self.serializer.compile_plans = False
+                    try:
+                        generic = converter(value)
+                    finally:
+                        del self.serializer.compile_plans
+                    compiled = converter(value)
+                    self.assertTrue(self.safe_equal(compiled, generic, False),
+                                    "Compiled plans changed the output:\n"
+                                    "VALUE:    %r\nCOMPILED: %r\n"
+                                    "GENERIC:  %r"
+                                    % (value, compiled, generic))
+
     def convertion_table(self, capabilities, freezing):
         raise SkipTest("No convertion table")
 
@@ -144,6 +144,9 @@ class DummyAgent(DummyBase):
     def save_document(self, document):
         return fiber.wrap_defer(self._db.save_document, document)
 
+    def save_documents(self, documents):
+        return fiber.wrap_defer(self._db.save_documents, documents)
+
     def update_document(self, doc_or_id, *args, **kwargs):
         return fiber.wrap_defer(self._db.update_document, doc_or_id,
                                 *args, **kwargs)
@@ -230,6 +233,9 @@ class DummyMedium(DummyMediumBase):
     def save_document(self, document):
         return self._db.save_document(document)
 
+    def save_documents(self, documents):
+        return self._db.save_documents(documents)
+
     def update_document(self, doc_or_id, *args, **kwargs):
         return self._db.update_document(doc_or_id, *args, **kwargs)
 
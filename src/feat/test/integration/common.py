@@ -359,22 +359,16 @@ class SimulationTest(common.TestCase, OverrideConfigMixin):
             yield self.wait_for(self.driver._journaler.is_idle, 10, 0.01)
             self.driver.snapshot_all_agents()
 
-            histories = yield self.driver._jourwriter.get_histories()
+            reader = self.driver._jourwriter
+            histories = yield reader.get_histories()
             for history in histories:
-                entries = yield self.driver._jourwriter.get_entries(history)
-                self._validate_replay_on_agent(history, entries)
+                self.log("Validating replay of agent %s.", history.agent_id)
+                yield replay.replay_history(reader, history)
         else:
             msg = ("\n\033[91mFIXME: \033[0mReplayability test "
                   "skipped: %s\n" % self.skip_replayability)
             print msg
 
-    def _validate_replay_on_agent(self, history, entries):
-        aid = history.agent_id
-        self.log("Found %d entries of this agent.", len(entries))
-        r = replay.Replay(iter(entries), aid)
-        for entry in r:
-            entry.apply()
-
     @defer.inlineCallbacks
     def wait_for_idle(self, timeout, freq=0.05):
         try:
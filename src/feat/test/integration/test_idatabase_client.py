@@ -892,6 +892,67 @@ class TestCase(object):
         self.assertEquals(docs[1:], gets[1:])
         self.assertIsInstance(gets[0], NotFoundError)
 
+    @defer.inlineCallbacks
+    def testBulkSave(self):
+        existing = yield self.connection.save_document(
+            DummyDocument(field=u'existing'))
+        stale = yield self.connection.get_document(existing.doc_id)
+        existing.field = u'changed'
+        yield self.connection.save_document(existing)
+
+        docs = [DummyDocument(field=u'first'), stale,
+                DummyDocument(field=u'second', doc_id=u'second')]
+        stale.field = u'this will fail'
+        saved = yield self.connection.save_documents(docs)
+
+        self.assertEqual(3, len(saved))
+        self.assertIs(docs[0], saved[0])
+        self.assertIsInstance(saved[1], ConflictError)
+        self.assertIs(docs[2], saved[2])
+        self.assertEqual(u'second', docs[2].doc_id)
+        for doc in (docs[0], docs[2]):
+            self.assertTrue(doc.rev)
+            fetched = yield self.connection.get_document(doc.doc_id)
+            self.assertEqual(doc, fetched)
+        fetched = yield self.connection.get_document(existing.doc_id)
+        self.assertEqual(u'changed', fetched.field)
+
+        # saving again with the revision set in place doesn't conflict
+        docs[0].field = u'updated'
+        saved = yield self.connection.save_documents([docs[0]])
+        self.assertIs(docs[0], saved[0])
+        fetched = yield self.connection.get_document(docs[0].doc_id)
+        self.assertEqual(u'updated', fetched.field)
+
+        # raw dictionaries are accepted as well
+        raw = {'_id': u'raw_doc', 'value': 1}
+        saved = yield self.connection.save_documents([raw])
+        self.assertEqual(u'raw_doc', saved[0]['_id'])
+        self.assertTrue(saved[0]['_rev'])
+
+    @defer.inlineCallbacks
+    def testBulkSaveWithLinks(self):
+        views = (links.Join, view.DocumentByType)
+        for doc in view.DesignDocument.generate_from_views(views):
+            yield self.connection.save_document(doc)
+
+        docs = [DummyDocument(field=u'first'), DummyDocument(field=u'other')]
+        docs[0].links.save_and_link(DummyDocument(field=u'second'),
+                                    linker_roles=['linkee'])
+        yield self.connection.save_documents(docs)
+
+        by_type = yield self.connection.query_view(
+            view.DocumentByType, reduce=False, include_docs=True,
+            **view.DocumentByType.keys(DummyDocument))
+        self.assertEqual(3, len(by_type))
+        indexed = dict((x.field, x) for x in by_type)
+        self.assertEqual(indexed['first'].doc_id,
+                         indexed['second'].links.first(DummyDocument))
+
+        fetched = yield links.fetch_one(self.connection,
+                                        indexed['first'].doc_id, 'linkee')
+        self.assertEqual(indexed['second'], fetched)
+
     @defer.inlineCallbacks
     def testReduceFieldInQueryView(self):
         '''
@@ -1497,6 +1558,7 @@ class CouchdbIntegrationTest(common.IntegrationTest, TestCase,
     timeout = 4
     slow = True
     skip_coverage = False
+    multiplex_changes = False
 
     @defer.inlineCallbacks
     def setUp(self):
@@ -1513,7 +1575,8 @@ class CouchdbIntegrationTest(common.IntegrationTest, TestCase,
 
         config = self.process.get_config()
         host, port = config['host'], config['port']
-        self.database = driver.Database(host, port, 'test')
+        self.database = driver.Database(
+            host, port, 'test', multiplex_changes=self.multiplex_changes)
         self.connection = self.database.get_connection()
 
         yield self.connection.create_database()
@@ -1522,3 +1585,12 @@ class CouchdbIntegrationTest(common.IntegrationTest, TestCase,
         self.connection.disconnect()
         self.database.disconnect()
         return self.process.terminate()
+
+
+@attr('slow')
+class MultiplexedCouchdbIntegrationTest(CouchdbIntegrationTest):
+
+    multiplex_changes = True
+
+    def testFilteredChanges404(self):
+        raise SkipTest("Filters are matched on the client side")
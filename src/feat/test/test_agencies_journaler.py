@@ -20,19 +20,25 @@
 
 # Headers in this file shall remain intact.
 import signal
+import shutil
 import tempfile
 import os
 import uuid
 
+from zope.interface import implements
 from twisted.trial.unittest import FailTest, SkipTest
 
 from feat.test import common
 from feat.test.integration.common import ModelTestMixin
-from feat.common import defer, time, error, log, manhole, first
+from feat.common import (defer, time, error, log, manhole, first,
+                         text_helper)
 from feat.agencies import journaler
 from feat.agencies.net import broker
 from feat.common.serialization import banana
 from feat.gateway import models
+from feat.utils import journal_migrate
+
+from feat.agencies.interface import IJournalWriter
 
 
 class GenerateEntryMixin(object):
@@ -530,12 +536,489 @@ class TestSqliteAsIJournalReader(common.TestCase, GenerateEntryMixin):
         categories = yield self.reader.get_log_categories()
         self.assertEqual(['feat'], categories)
 
+    @defer.inlineCallbacks
+    def testPaginatingEntries(self):
+        yield self._populate_data()
+        yield self.writer.insert_entries(
+            [self._generate_entry(args=str(x)) for x in range(5)])
+        histories = yield self.reader.get_histories()
+        history = histories[1]
+
+        # 7 entries in pages of 3
+        entries, cursor = yield self.reader.get_entries_page(history, limit=3)
+        self.assertEqual(3, len(entries))
+        self.assertTrue(cursor is not None)
+        entries, cursor = yield self.reader.get_entries_page(
+            history, after=cursor, limit=3)
+        self.assertEqual(['1', '2', '3'], [x['args'] for x in entries])
+        self.assertTrue(cursor is not None)
+        entries, cursor = yield self.reader.get_entries_page(
+            history, after=cursor, limit=3)
+        self.assertEqual(['4'], [x['args'] for x in entries])
+        self.assertIs(None, cursor)
+
+        # the exact fit doesn't produce an empty page
+        entries, cursor = yield self.reader.get_entries_page(
+            histories[0], limit=2)
+        self.assertEqual(2, len(entries))
+        self.assertIs(None, cursor)
+
+        # with start_date
+        entries, cursor = yield self.reader.get_entries_page(
+            histories[0], start_date=self.now-10)
+        self.assertEqual(1, len(entries))
+        self.assertIs(None, cursor)
+
+    @defer.inlineCallbacks
+    def testPaginatingLogEntries(self):
+        yield self._populate_data()
+
+        entries, cursor = yield self.reader.get_log_entries_page(limit=3)
+        self.assertEqual(['m1', 'm2', 'm3'], [x['message'] for x in entries])
+        entries, cursor = yield self.reader.get_log_entries_page(
+            after=cursor, limit=3)
+        self.assertEqual(['m4'], [x['message'] for x in entries])
+        self.assertIs(None, cursor)
+
+        # filters are applied before limiting
+        filters = [dict(category='feat', level=2)]
+        entries, cursor = yield self.reader.get_log_entries_page(
+            filters=filters, limit=1)
+        self.assertEqual(['m3'], [x['message'] for x in entries])
+        entries, cursor = yield self.reader.get_log_entries_page(
+            filters=filters, after=cursor, limit=1)
+        self.assertEqual(['m4'], [x['message'] for x in entries])
+        self.assertIs(None, cursor)
+
+        entries, cursor = yield self.reader.get_log_entries_page(
+            end_date=self.now-10, limit=1)
+        self.assertEqual(['m1'], [x['message'] for x in entries])
+        entries, cursor = yield self.reader.get_log_entries_page(
+            end_date=self.now-10, after=cursor, limit=1)
+        self.assertEqual(['m2'], [x['message'] for x in entries])
+        self.assertIs(None, cursor)
+
     @defer.inlineCallbacks
     def tearDown(self):
         yield self.writer.close()
         yield common.TestCase.tearDown(self)
 
 
+class TestFileAsIJournalReader(TestSqliteAsIJournalReader):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield common.TestCase.setUp(self)
+
+        self.hostname = 'hostname'
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.writer = journaler.FileWriter(
+            self, os.path.join(self.tempdir, 'journal'),
+            hostname=self.hostname)
+        self.reader = self.writer
+        yield self.writer.initiate()
+
+
+class TestFileWriter(common.TestCase, GenerateEntryMixin):
+
+    timeout = 10
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.filename = os.path.join(self.tempdir, 'journal')
+
+    @defer.inlineCallbacks
+    def testRotatingAndRecovering(self):
+        # random data doesn't compress
+        args = os.urandom(1000)
+        writer = self._writer()
+        yield writer.initiate()
+        yield writer.insert_entries(
+            [self._generate_entry(function_id='f%d' % (x, ), args=args)
+             for x in range(10)])
+        yield writer.insert_entries([self._generate_log()])
+        self.assertTrue(len(writer._segments) > 2)
+        yield writer.close()
+
+        # lose the index of the last segment and leave the
+        # half written record at the end of it
+        last = writer._segment_path(writer._segments[-1])
+        os.remove(last + '.idx')
+        size = os.path.getsize(last)
+        with open(last, 'ab') as f:
+            f.write('\x00\x00\x01\x00garbage')
+
+        writer = self._writer()
+        yield writer.initiate()
+        self.assertEqual(size, os.path.getsize(last))
+        self.assertTrue(os.path.exists(last + '.idx'))
+        histories = yield writer.get_histories()
+        self.assertEqual(1, len(histories))
+        entries = yield writer.get_entries(histories[0])
+        self.assertEqual(['f%d' % (x, ) for x in range(10)],
+                         [x['function_id'] for x in entries])
+        self.assertEqual(args, entries[0]['args'])
+        logs = yield writer.get_log_entries()
+        self.assertEqual(1, len(logs))
+
+        # new entries go after the recovered ones
+        yield writer.insert_entries([self._generate_entry()])
+        entries = yield writer.get_entries(histories[0])
+        self.assertEqual(11, len(entries))
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testIndexAheadOfSegment(self):
+        writer = self._writer(max_segment_size=None)
+        yield writer.initiate()
+        yield writer.insert_entries(
+            [self._generate_entry(function_id='f%d' % (x, ))
+             for x in range(3)])
+        yield writer.close()
+
+        # the index points to the record missing in the segment
+        path = writer._segment_path(1)
+        index = writer._journal_index
+        with open(path, 'r+b') as f:
+            f.truncate(index[2].offset)
+        index_size = os.path.getsize(path + '.idx')
+
+        writer = self._writer(max_segment_size=None)
+        yield writer.initiate()
+        self.assertTrue(os.path.getsize(path + '.idx') < index_size)
+        histories = yield writer.get_histories()
+        entries = yield writer.get_entries(histories[0])
+        self.assertEqual(['f0', 'f1'], [x['function_id'] for x in entries])
+
+        # the new records don't show up in the history of another agent
+        yield writer.insert_entries(
+            [self._generate_entry(agent_id='other', function_id='NEW')])
+        entries = yield writer.get_entries(histories[0])
+        self.assertEqual(['f0', 'f1'], [x['function_id'] for x in entries])
+        yield writer.close()
+
+        writer = self._writer(max_segment_size=None)
+        yield writer.initiate()
+        histories = yield writer.get_histories()
+        self.assertEqual(2, len(histories))
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testDetectingCorruption(self):
+        writer = self._writer(max_segment_size=None)
+        yield writer.initiate()
+        yield writer.insert_entries([self._generate_entry()
+                                     for x in range(3)])
+        yield writer.close()
+
+        path = writer._segment_path(1)
+        index = writer._journal_index
+        os.remove(path + '.idx')
+        with open(path, 'r+b') as f:
+            f.seek(index[1].offset + index[1].length - 1)
+            f.write('X')
+
+        writer = self._writer(max_segment_size=None)
+        yield writer.initiate()
+        self.assertEqual(1, len(writer._journal_index))
+        self.assertEqual(index[1].offset, os.path.getsize(path))
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testDeletingEntries(self):
+        writer = self._writer()
+        yield writer.initiate()
+        yield writer.insert_entries(
+            [self._generate_entry(function_id='f%d' % (x, ),
+                                  args=os.urandom(1000))
+             for x in range(10)])
+        segments = list(writer._segments)
+
+        yield writer.delete_top_journal_entries(5)
+        entries = yield writer.get_bare_journal_entries()
+        self.assertEqual(['f%d' % (x, ) for x in range(5, 10)],
+                         [x['function_id'] for x in entries])
+        self.assertTrue(len(writer._segments) < len(segments))
+        removed = writer._segment_path(segments[0])
+        self.assertFalse(os.path.exists(removed))
+        self.assertFalse(os.path.exists(removed + '.idx'))
+        yield writer.close()
+
+        # the deletion survives the restart
+        writer = self._writer()
+        yield writer.initiate()
+        entries = yield writer.get_bare_journal_entries()
+        self.assertEqual(5, len(entries))
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testMigratingSegments(self):
+        writer = self._writer()
+        yield writer.initiate()
+        yield writer.insert_entries(
+            [self._generate_entry(args='x' * 1000) for x in range(20)] +
+            [self._generate_log() for x in range(5)])
+        yield writer.close()
+
+        target = os.path.join(self.tempdir, 'journal.sqlite3')
+        yield journal_migrate.migrate(self.filename, ['sqlite://' + target],
+                                      hostname='hostname')
+
+        writer = self._writer()
+        yield writer.initiate()
+        self.assertEqual([], writer._journal_index)
+        self.assertEqual([], writer._log_index)
+        self.assertEqual(1, len(writer._segments))
+        yield writer.close()
+
+        sqlite = journaler.SqliteWriter(self, filename=target)
+        yield sqlite.initiate()
+        histories = yield sqlite.get_histories()
+        entries = yield sqlite.get_entries(histories[0])
+        self.assertEqual(20, len(entries))
+        logs = yield sqlite.get_log_entries()
+        self.assertTrue(len(logs) >= 5)
+        yield sqlite.close()
+
+    def testParsingConnectionString(self):
+        klass, params = journaler.parse_connstr(
+            'file:///var/log/feat/journal')
+        self.assertEqual(journaler.FileWriter, klass)
+        self.assertEqual('/var/log/feat/journal', params['filename'])
+
+    def _writer(self, max_segment_size=2500):
+        return journaler.FileWriter(self, self.filename,
+                                    max_segment_size=max_segment_size,
+                                    hostname='hostname')
+
+
+class RowByRowSqliteWriter(journaler.SqliteWriter):
+    '''
+    Writer inserting the entries one by one, the way it used to be done
+    before the bulk insert path. Used as a reference by the benchmark.
+    '''
+
+    def _perform_inserts(self, cache):
+
+        def do_insert_entry(connection, history_id, data):
+            command = text_helper.format_block("""
+            INSERT INTO entries VALUES (null, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """)
+            connection.execute(
+                command, (history_id,
+                          data['journal_id'], data['function_id'],
+                          data['fiber_id'], data['fiber_depth'],
+                          data['args'], data['kwargs'],
+                          data['side_effects'], data['result'],
+                          int(data['timestamp'])))
+
+        def do_insert_log(connection, data):
+            command = text_helper.format_block("""
+            INSERT INTO logs VALUES (null, ?, ?, ?, ?, ?, ?, ?)
+            """)
+            connection.execute(
+                command, (data['message'], int(data['level']),
+                          data['category'], data['log_name'],
+                          data['file_path'], data['line_num'],
+                          int(data['timestamp'])))
+
+        def transaction(connection, cache):
+            entries = cache.fetch()
+            if not entries:
+                return
+            try:
+                for data in map(self._encode, entries):
+                    if data['entry_type'] == 'journal':
+                        history_id = self._get_history_id(
+                            connection, data['agent_id'], data['instance_id'])
+                        do_insert_entry(connection, history_id, data)
+                    elif data['entry_type'] == 'log':
+                        do_insert_log(connection, data)
+                cache.commit()
+            except Exception:
+                cache.rollback()
+                raise
+
+        return self._db.runWithConnection(transaction, cache)
+
+
+class TestSqliteWriterBulkInserts(common.TestCase, GenerateEntryMixin):
+
+    @defer.inlineCallbacks
+    def testBatchWithManyHistories(self):
+        writer = journaler.SqliteWriter(self, encoding='zip')
+        yield writer.initiate()
+        data = list()
+        for x in range(30):
+            data.append(self._generate_entry(agent_id='agent%d' % (x % 3, ),
+                                             instance_id=x % 2,
+                                             function_id='f%d' % (x, )))
+            data.append(self._generate_log(message='m%d' % (x, )))
+        yield writer.insert_entries(data)
+
+        histories = yield writer.get_histories()
+        self.assertEqual(6, len(histories))
+        for history in histories:
+            entries = yield writer.get_entries(history)
+            self.assertEqual(5, len(entries))
+            indexes = [int(x['function_id'][1:]) for x in entries]
+            self.assertEqual(sorted(indexes), indexes)
+        logs = yield writer.get_log_entries()
+        self.assertEqual(['m%d' % (x, ) for x in range(30)],
+                         [x['message'] for x in logs])
+        yield writer.close()
+
+    @common.attr('slow', timeout=120)
+    @defer.inlineCallbacks
+    def testBenchmarkEntriesPerSecond(self):
+        batch = 2000
+        rounds = 5
+        data = [self._generate_entry(agent_id='agent%d' % (x % 20, ))
+                for x in range(batch)]
+        data += [self._generate_log() for x in range(batch / 4)]
+
+        results = dict()
+        for factory in (RowByRowSqliteWriter, journaler.SqliteWriter):
+            writer = factory(self, filename=self._get_tmp_file(),
+                             encoding='zip')
+            yield writer.initiate()
+            start = time.time()
+            for x in range(rounds):
+                yield writer.insert_entries([dict(x) for x in data])
+            elapsed = time.time() - start
+            results[factory.__name__] = len(data) * rounds / elapsed
+            yield writer.close()
+
+        self.info("Sqlite journal writer throughput (entries/s): %r",
+                  results)
+
+    def _get_tmp_file(self):
+        fd, name = tempfile.mkstemp(suffix='_journal.sqlite')
+        self.addCleanup(os.remove, name)
+        return name
+
+
+class StubWriter(object):
+    '''
+    Writer letting the test decide when the insert_entries() finishes.
+    '''
+    implements(IJournalWriter)
+
+    def __init__(self):
+        self.batches = list()
+        self.pending = list()
+
+    def configure_with(self, journaler):
+        pass
+
+    def insert_entries(self, entries):
+        self.batches.append(len(entries))
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def finish(self):
+        pending, self.pending = self.pending, list()
+        for d in pending:
+            d.callback(None)
+
+    def is_idle(self):
+        return not self.pending
+
+    def close(self, flush=True):
+        return defer.succeed(None)
+
+
+class TestGroupCommit(common.TestCase, ModelTestMixin, GenerateEntryMixin):
+
+    timeout = 5
+
+    @defer.inlineCallbacks
+    def testBatchSizeIsBounded(self):
+        jour = journaler.Journaler(max_batch_size=10)
+        writer = journaler.SqliteWriter(self)
+        yield writer.initiate()
+        jour.configure_with(writer)
+
+        yield jour.insert_entries([self._generate_entry() for x in range(25)])
+        self.assertEqual(0, jour.get_queue_depth())
+        self.assertEqual(0, jour.get_queued_bytes())
+        self.assertEqual(3, jour.statistics.flushes)
+        self.assertEqual(25, jour.statistics.entries)
+        self.assertEqual([(1, 0), (10, 3), (100, 0), (1000, 0), (10000, 0),
+                          (None, 0)], jour.statistics.batch_sizes)
+        self.assertTrue(jour.statistics.max_latency >= 0)
+        yield self._assert_entries(writer, 25)
+
+        yield self.validate_model_tree(models.Journaler(jour))
+        yield jour.close()
+
+    @defer.inlineCallbacks
+    def testFlushIsPostponed(self):
+        jour = journaler.Journaler(max_batch_size=10, max_latency=10)
+        writer = StubWriter()
+        jour.configure_with(writer)
+
+        d = jour.insert_entry(**self._generate_entry())
+        yield common.delay(None, 0.01)
+        self.assertEqual([], writer.batches)
+        self.assertEqual(1, jour.get_queue_depth())
+
+        # filling the batch triggers the flush right away
+        jour.insert_entries([self._generate_entry() for x in range(9)])
+        yield common.delay(None, 0.01)
+        self.assertEqual([10], writer.batches)
+        self.assertFalse(d.called)
+        writer.finish()
+        self.assertTrue(d.called)
+        self.assertEqual(0, jour.get_queue_depth())
+        yield jour.close()
+
+    @defer.inlineCallbacks
+    def testBackpressure(self):
+        entry = self._generate_entry()
+        size = journaler.entry_size(entry)
+        jour = journaler.Journaler(max_batch_size=2,
+                                   max_queued_bytes=size * 4 + 1)
+        writer = StubWriter()
+        jour.configure_with(writer)
+
+        defers = [jour.insert_entry(**self._generate_entry())
+                  for x in range(6)]
+        self.assertTrue(jour.is_saturated())
+        yield common.delay(None, 0.01)
+        self.assertEqual([2], writer.batches)
+
+        # first flush: 4 entries left, over the low water mark,
+        # the entries which got the backpressure are still waiting
+        writer.finish()
+        self.assertTrue(jour.is_saturated())
+        self.assertEqual([True] * 2 + [False] * 4,
+                         [x.called for x in defers])
+
+        # second flush: 2 entries left, drained enough
+        yield common.delay(None, 0.01)
+        writer.finish()
+        self.assertFalse(jour.is_saturated())
+        self.assertEqual([True] * 4 + [False] * 2,
+                         [x.called for x in defers])
+
+        yield common.delay(None, 0.01)
+        writer.finish()
+        self.assertEqual([2, 2, 2], writer.batches)
+        self.assertTrue(all(x.called for x in defers))
+        yield jour.close()
+
+    @defer.inlineCallbacks
+    def _assert_entries(self, writer, expected):
+        histories = yield writer.get_histories()
+        entries = yield writer.get_entries(histories[0])
+        self.assertEqual(expected, len(entries))
+
+
 class TestParsingConnection(common.TestCase):
 
     def testItWorks(self):
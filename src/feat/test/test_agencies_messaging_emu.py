@@ -21,15 +21,33 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import time
+
 from twisted.internet import reactor
 
-from feat.agencies.messaging import emu
+from feat.agencies.messaging import emu, messaging, rabbitmq
 from feat.agencies import message, recipient
 from feat.common import defer
 
 from . import common
 
 
+class SharedNotification(message.Notification):
+
+    shared_payload = True
+
+
+class CountingChannel(messaging.Channel):
+
+    def __init__(self, bus, agent):
+        messaging.Channel.__init__(self, bus, agent)
+        self.received = set()
+
+    def on_message(self, msg):
+        # Local routing and the emulated RabbitMQ deliver the same message
+        self.received.add(msg.message_id)
+
+
 class TestQueue(common.TestCase):
 
     def _appendConsumers(self, finished):
@@ -287,3 +305,74 @@ class TestMessaging(common.TestCase):
         reactor.callLater(0.1, asserts, d)
 
         return d
+
+
+class TestMessageCloning(common.TestCase):
+
+    def testStructuralClone(self):
+        recp = recipient.Agent('agent_id', 'lobby')
+        payload = {'values': [1, 2, 3]}
+        msg = SharedNotification(message_id='id', recipient=recp,
+                                 traversal_id='traversal', payload=payload)
+        clone = msg.clone()
+        self.assertEqual(msg, clone)
+        self.assertIsNot(msg, clone)
+        self.assertIs(payload, clone.payload)
+        clone.recipient = recipient.Agent('other_id', 'lobby')
+        clone.message_id = None
+        self.assertEqual('id', msg.message_id)
+        self.assertEqual(recp, msg.recipient)
+
+        msg = message.Notification(payload=payload)
+        clone = msg.clone()
+        self.assertEqual(msg, clone)
+        self.assertIsNot(payload, clone.payload)
+        self.assertEqual(payload, clone.payload)
+
+
+class TestMessagingThroughput(common.TestCase):
+
+    timeout = 120
+
+    @common.attr('slow', timeout=120)
+    @defer.inlineCallbacks
+    def testBenchmarkFanout(self):
+        agents = 50
+        messages = 100
+        payload = dict(("key%d" % i, range(20)) for i in range(20))
+        broadcast = recipient.Broadcast('benchmark', 'lobby')
+
+        for factory in (message.Notification, SharedNotification):
+            bus = messaging.Messaging(self)
+            rabbit = emu.RabbitMQ()
+            backend = rabbitmq.Client(rabbit, 'agency_queue')
+            yield bus.add_backend(backend)
+
+            channels = [CountingChannel(bus, common.StubAgent())
+                        for _ in range(agents)]
+            for channel in channels:
+                channel.create_binding(broadcast)
+
+            def check():
+                return all(len(c.received) == messages for c in channels)
+
+            start = time.time()
+            for _ in range(messages):
+                msg = factory(expiration_time=time.time() + 60,
+                              payload=payload)
+                channels[0].post(broadcast, msg)
+            yield self.wait_for(check, 100, 0.01)
+            elapsed = time.time() - start
+
+            for channel in channels:
+                channel.release()
+
+            def idle():
+                return bus.is_idle() and rabbit.is_idle()
+
+            yield self.wait_for(idle, 10, 0.01)
+            bus.remove_backend(backend.channel_type)
+
+            self.info("%s to %d agents: %d messages/s, %d deliveries/s",
+                      factory.__name__, agents, messages / elapsed,
+                      messages * agents / elapsed)
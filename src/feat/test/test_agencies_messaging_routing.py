@@ -426,3 +426,113 @@ class TestRouting(common.TestCase):
         m_id = msg.message_id
         m_ids = [msg.message_id for msg in sink.messages]
         self.assertFalse(m_id in m_ids, "Messages are: %r" % (sink.messages, ))
+
+
+class RecordingSink(object):
+
+    implements(routing.ISink)
+
+    def __init__(self, name, delivered):
+        self.name = name
+        self.delivered = delivered
+
+    ### ISink ###
+
+    def on_message(self, message):
+        self.delivered.append(self.name)
+
+
+class TestTable(common.TestCase):
+
+    implements(ITimeProvider)
+
+    def get_time(self):
+        return self._time
+
+    def setUp(self):
+        self._time = time.time()
+        self.table = routing.Table(self, ITimeProvider(self))
+        self.delivered = []
+
+    def route(self, name, key, priority=0, final=False):
+        sink = RecordingSink(name, self.delivered)
+        route = routing.Route(sink, key, priority, final)
+        self.table.append_route(route)
+        return route
+
+    def testRoutePriorities(self):
+        key = ('agent', 'shard')
+        self.route('a', key, priority=5)
+        self.route('b', key, priority=1)
+        self.route('c', key, priority=5)
+        self.route('d', key, priority=0)
+        self.route('e', ('other', 'shard'), priority=0)
+
+        self.table.dispatch(direct(key))
+        self.assertEqual(['d', 'b', 'a', 'c'], self.delivered)
+
+        del self.delivered[:]
+        final = self.route('f', key, priority=1, final=True)
+        self.table.dispatch(direct(key))
+        self.assertEqual(['d', 'b', 'f'], self.delivered)
+
+        del self.delivered[:]
+        self.table.remove_route(final)
+        self.table.dispatch(direct(key))
+        self.assertEqual(['d', 'b', 'a', 'c'], self.delivered)
+
+    def testRemoveSink(self):
+        sink = RecordingSink('a', self.delivered)
+        keys = [('agent%d' % i, 'shard') for i in range(3)]
+        for key in keys:
+            self.table.append_route(routing.Route(sink, key, 0, True))
+        self.route('b', keys[0])
+
+        self.table.remove_sink(sink)
+        for key in keys:
+            self.table.dispatch(direct(key))
+        self.assertEqual(['b'], self.delivered)
+
+    def testStoredMessages(self):
+        key = ('agent', 'shard')
+        expiration = self._time + 10
+        m1 = direct(key, expiration_time=expiration)
+        m2 = direct(('other', 'shard'), expiration_time=expiration)
+        self.table.dispatch(m1)
+        self.table.dispatch(m2)
+        self.table.dispatch(direct(key, expiration_time=expiration))
+
+        self.route('a', key)
+        self.assertEqual(['a', 'a'], self.delivered)
+
+        # Non final routes keep the messages stored
+        self.route('b', key, final=True)
+        self.assertEqual(['a', 'a', 'b', 'b'], self.delivered)
+        self.route('c', key, final=True)
+        self.assertEqual(['a', 'a', 'b', 'b'], self.delivered)
+
+        # Expired messages are not delivered
+        self._time += 20
+        self.route('d', ('other', 'shard'))
+        self.assertEqual(['a', 'a', 'b', 'b'], self.delivered)
+
+    @common.attr('slow', timeout=120)
+    def testBenchmarkRoutes(self):
+        count = 10000
+        sink = RecordingSink('a', self.delivered)
+        keys = [('agent%d' % i, 'shard') for i in range(count)]
+        messages = [direct(key) for key in keys]
+
+        start = time.time()
+        for key in keys:
+            self.table.append_route(routing.Route(sink, key, 0, True))
+        appended = count / (time.time() - start)
+
+        start = time.time()
+        for msg in messages:
+            self.table.dispatch(msg, outgoing=False)
+        dispatched = count / (time.time() - start)
+
+        self.assertEqual(count, len(self.delivered))
+        self.info("%d routes: %d routes appended/s, %d messages "
+                  "dispatched/s", count, appended, dispatched)
@@ -0,0 +1,55 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+from feat.test import common
+from feat.agencies import replay
+from feat.common.serialization import banana
+
+from feat.interface.journal import ReplayError
+
+
+class TestJournalReplayEntry(common.TestCase):
+
+    def setUp(self):
+        self.replay = replay.Replay(iter([]), 'agent_id')
+
+    def testSideEffectsRecordedWithReferences(self):
+        # journals written before the entries stopped tracking references
+        shared = [1, 2]
+        entry = self._entry(banana.Serializer(), "spam", (shared, shared))
+        self.assertEqual("ok", entry.next_side_effect("spam", shared, shared))
+
+        entry = self._entry(banana.Serializer(), "spam", (shared, shared))
+        self.assertRaises(ReplayError, entry.next_side_effect,
+                          "spam", shared, [1, 3])
+
+    def testSideEffectsRecordedWithoutReferences(self):
+        shared = [1, 2]
+        serializer = banana.Serializer(track_references=False)
+        entry = self._entry(serializer, "spam", (shared, shared))
+        self.assertEqual("ok", entry.next_side_effect("spam", shared, shared))
+
+    def _entry(self, serializer, function_id, args):
+        side_effect = (function_id, serializer.freeze(args),
+                       serializer.freeze({}), [], serializer.convert("ok"))
+        record = {'result': serializer.convert(None),
+                  'side_effects': serializer.convert([side_effect])}
+        return replay.JournalReplayEntry(self.replay, record)
@@ -21,6 +21,9 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import copy
+import timeit
+
 from twisted.internet import defer
 from zope.interface import implements
 
@@ -28,7 +31,7 @@ from feat.test import common
 from feat.agents.base import resource, descriptor
 from feat.common import time
 from feat.interface import journal
-from feat.common import fiber
+from feat.common import fiber, guard
 
 from feat.common.container import *
 from feat.common import serialization
@@ -516,3 +519,54 @@ class ResourcesTest(common.TestCase, Common):
 
         delta = yield self.resources.get_allocation_delta(alloc.id, a=3, b=4)
         self.assertEqual(dict(b=2), delta)
+
+    @defer.inlineCallbacks
+    def testReadOnlyState(self):
+        view = self.resources._get_view()
+        self.assertIs(view, self.resources._get_view())
+        self.assertEqual(view.definitions,
+                         self.resources._get_state().definitions)
+        self.assertRaises(AttributeError, setattr, view, 'definitions', {})
+        self.assertRaises(AttributeError, delattr, view, 'definitions')
+        # the view reflects the changes done by the mutable methods
+        self.assertEqual(1, view.id_autoincrement)
+        yield self.resources.allocate(a=3)
+        self.assertEqual(2, view.id_autoincrement)
+
+        # recovering the state replaces the view
+        state = guard.MutableState()
+        state.__dict__.update(self.resources._get_state().__dict__)
+        guard.Guarded.recover(self.resources, state)
+        self.assertIsNot(view, self.resources._get_view())
+        self.assertEqual(2, self.resources._get_view().id_autoincrement)
+
+    @common.attr('slow', timeout=60)
+    @defer.inlineCallbacks
+    def testBenchmarkImmutableCalls(self):
+        calls = 20000
+        alloc = yield self.resources.allocate(a=3, b=2)
+        resources = self.resources
+        cls = type(resources)
+        methods = [('get_allocation', (alloc.id, )),
+                   ('get_usage', ()),
+                   ('get_totals', ())]
+
+        def measure(function, *args):
+            start = timeit.default_timer()
+            for _ in xrange(calls):
+                function(*args)
+            return (timeit.default_timer() - start) * 1000000 / calls
+
+        for name, args in methods:
+            original = getattr(cls, name).original_func
+            # the mutable state passed as-is, as done before
+            plain = measure(lambda *args: original(
+                resources, resources._get_state(), *args), *args)
+            # the read-only view used by guard.immutable
+            guarded = measure(getattr(resources, name), *args)
+            # a copying freeze, for reference
+            copying = measure(lambda *args: original(
+                resources, copy.copy(resources._get_state()), *args), *args)
+            self.info("Resources.%s() per call: plain state %.2fus, "
+                      "read-only view %.2fus, copied state %.2fus",
+                      name, plain, guarded, copying)
@@ -23,6 +23,8 @@
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
+import time
+
 from twisted.trial.unittest import FailTest
 from zope.interface import implements
 
@@ -52,6 +54,13 @@ class BasicRecordingDummy(journal.Recorder):
         return f
 
 
+class NoopDummy(journal.Recorder):
+
+    @journal.recorded()
+    def noop(self):
+        pass
+
+
 class FiberInfoDummy(journal.Recorder):
 
     def __init__(self, parent, async=False):
@@ -1163,3 +1172,44 @@ class TestJournaling(common.TestCase):
         # Check that the identifier generator has not been reset
         self.assertNotEqual(sub.journal_id,
                             BasicRecordingDummy(obj2).journal_id)
+
+    @common.attr('slow', timeout=120)
+    def testBenchmarkRecordedCalls(self):
+        calls = 20000
+        root = journal.RecorderRoot(self.keeper, "dummy")
+        obj = NoopDummy(root)
+
+        def nested(depth, fun, *args):
+            # Simulates the deep python stack of the reactor callbacks
+            if depth:
+                return nested(depth - 1, fun, *args)
+            return fun(*args)
+
+        def call_noop():
+            for _ in xrange(calls):
+                obj.noop()
+            self.keeper.clear()
+
+        def lookup(getter, name):
+            for _ in xrange(calls):
+                getter(name)
+
+        results = dict()
+        for depth in (0, 50):
+            start = time.time()
+            nested(depth, call_noop)
+            results['recorded noop, depth %d' % depth] = \
+                calls / (time.time() - start)
+
+            section = fiber.WovenSection()
+            section.enter()
+            for name, getter in (("context stack", fiber.get_context_var),
+                                 ("frame walking", fiber.get_stack_var)):
+                start = time.time()
+                nested(depth, lookup, getter, fiber.SECTION_STATE_TAG)
+                results['%s lookup, depth %d' % (name, depth)] = \
+                    calls / (time.time() - start)
+            section.abort()
+
+        for name in sorted(results):
+            self.info("%s: %d calls/s", name, results[name])
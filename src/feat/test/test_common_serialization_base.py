@@ -23,10 +23,12 @@
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
+import time
+
 from twisted.spread import jelly
 
 from feat.common import serialization
-from feat.common.serialization import base
+from feat.common.serialization import base, banana, json, pytree, sexp
 from feat.interface.serialization import *
 
 from . import common
@@ -304,3 +306,54 @@ class TestVersionAdapter(common.TestCase):
 
         self.check_combinations(DummyVerAdapter2, range(1, 10), expected)
         self.check_combinations(DummyVerAdapter2(), range(1, 10), expected)
+
+
+class TestFlatteningPlans(common.TestCase):
+
+    def testSubclassOverrides(self):
+
+        class KeySerializer(pytree.Serializer):
+
+            def flatten_key(self, key, caps, freezing):
+                if isinstance(key, str):
+                    key = key.upper()
+                return pytree.Serializer.flatten_key(self, key,
+                                                     caps, freezing)
+
+        serializer = KeySerializer()
+        data = {"spam": [A(1), C({"bacon": (1, 2)})]}
+        result = serializer.convert(data)
+        self.assertEqual(["SPAM"], result.keys())
+        self.assertEqual(["BACON"], result["SPAM"][1].snapshot["Z"].keys())
+
+    @common.attr('slow', timeout=120)
+    def testBenchmarkConvert(self):
+        count = 200
+        data = {"items": [B(i, {"name": "item%d" % i, "ratio": i / 3.0,
+                                "tags": ["a", "b", u"c"], "pair": (i, "x"),
+                                "flag": bool(i % 2), "nothing": None})
+                          for i in range(50)],
+                "lists": [ListSerializableDummy(range(10))
+                          for i in range(10)],
+                "custom": [C(E([i], u"v")) for i in range(20)],
+                "matrix": [range(10) for i in range(10)],
+                "names": dict(("k%d" % i, "v%d" % i) for i in range(50))}
+
+        def measure(fun):
+            start = time.time()
+            for _ in xrange(count):
+                fun(data)
+            return count / (time.time() - start)
+
+        for name, module in (("banana", banana), ("json", json),
+                             ("pytree", pytree), ("sexp", sexp)):
+            serializer = module.Serializer()
+            for method in ("convert", "freeze"):
+                fun = getattr(serializer, method)
+                compiled = measure(fun)
+                serializer.compile_plans = False
+                generic = measure(fun)
+                del serializer.compile_plans
+                self.info("%s %s: %d/s compiled, %d/s generic (x%.2f)",
+                          name, method, compiled, generic,
+                          compiled / generic)
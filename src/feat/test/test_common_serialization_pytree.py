@@ -477,6 +477,14 @@ class GenericSerializationTest(common.TestCase):
         frozen = self.serializer.freeze(instance.dummer_method)
         self.assertEqual('dummy_tag', frozen)
 
+    def testFreezingMixedKeys(self):
+        # non-ASCII str keys cannot be compared with unicode keys
+        value = {'\xff': 1, u'\xe9': 2, 'a': 3, u'b': 4}
+        expected = {'\xff': 1, u'\xe9': 2, 'a': 3, u'b': 4}
+        self.assertEqual(expected, self.serializer.freeze(value))
+        self.serializer.compile_plans = False
+        self.assertEqual(expected, self.serializer.freeze(value))
+
     def testNotReferenceable(self):
         Klass = common_serialization.NotReferenceableDummy
         Inst = pytree.Instance
@@ -492,6 +500,34 @@ class GenericSerializationTest(common.TestCase):
 
         self.assertEqual(data, [{"value": 42}, {"value": 42}])
 
+    def testUntrackedReferences(self):
+        serializer = pytree.Serializer(track_references=False)
+        Inst = pytree.Instance
+        name = reflect.canonical_name(DummySerializable)
+
+        # Shared values are serialized multiple times
+        shared = [1, 2]
+        obj = DummySerializable(shared)
+        data = serializer.convert([shared, obj, obj, (shared, )])
+        self.assertEqual(data, [[1, 2],
+                                Inst(name, {"value": [1, 2]}),
+                                Inst(name, {"value": [1, 2]}),
+                                ([1, 2], )])
+
+        # Cycles are flattened again keeping track of references
+        cycle = DummySerializable(None)
+        cycle.value = [cycle]
+        data = serializer.convert([shared, cycle, cycle])
+        self.assertEqual(data, self.serializer.convert([shared, cycle, cycle]))
+        self.assertTrue(isinstance(data[1], pytree.Reference))
+
+        # Unless debugging references
+        self.patch(base, "debug_references", True)
+        self.assertRaises(ValueError, serializer.convert, cycle)
+        self.assertRaises(ValueError, serializer.freeze, [cycle])
+        self.assertEqual([[1, 2], [1, 2]],
+                         serializer.convert([shared, shared]))
+
 
 class PyTreeConvertersTest(common_serialization.ConverterTest):
 
@@ -1,6 +1,7 @@
 from feat.common.serialization import base
 from feat.common import defer
 from feat.database import client, document, common as dcommon, emu, migration
+from feat.database import driver, view
 from feat.test import common
 
 
@@ -79,3 +80,103 @@ class UnserializingAndMigrationgTest(common.TestCase):
         fetched = yield self.client.get_document("test-doc")
         self.assertEqual(3, fetched.version)
         self.assertIsInstance(fetched, MigratableDoc)
+
+
+class FilteringView(view.BaseView):
+
+    name = 'filter_view'
+
+    def filter(doc, request):
+        return doc.get('field') == request['query']['field']
+
+
+class DummyDatabase(client.ChangeListener):
+
+    host = 'localhost'
+    port = 5984
+    db_name = 'test'
+
+    def __init__(self):
+        client.ChangeListener.__init__(self, None)
+        self.couchdb = self
+        self.notifications = list()
+        self.requests = list()
+
+    def notified(self, doc_id, rev, deleted):
+        self.notifications.append((doc_id, rev, deleted))
+
+    def wait_connected(self):
+        return defer.succeed(self)
+
+    def couchdb_call(self, method, url):
+        return defer.succeed(dict(update_seq=5))
+
+    def get(self, url, **kwargs):
+        self.requests.append(url)
+        return defer.succeed(None)
+
+
+class MultiplexedChangesTest(common.TestCase):
+
+    def setUp(self):
+        self.db = DummyDatabase()
+        self.notifier = driver.MultiplexedNotifier(self.db)
+
+    @defer.inlineCallbacks
+    def testDispatchingChanges(self):
+        self.assertIs(None, self.notifier.extract_params())
+
+        yield self.db.listen_changes(['doc1', 'doc2'], self.db.notified)
+        self.assertEqual(dict(), self.notifier.extract_params())
+        l_id = yield self.db.listen_changes(
+            FilteringView, self.db.notified, dict(field='value'))
+        # view filters are matched against the included documents
+        self.assertEqual(dict(include_docs='true'),
+                         self.notifier.extract_params())
+
+        self.notifier.changed(self._change(1, 'doc1', '1-a'))
+        self.notifier.changed(self._change(2, 'doc3', '1-b', field='other'))
+        self.notifier.changed(self._change(3, 'doc4', '1-c', field='value'))
+        self.notifier.changed(self._change(4, 'doc2', '2-d', deleted=True))
+        self.assertEqual(4, self.notifier._since)
+        yield common.delay(None, 0.01)
+        self.assertEqual([('doc1', '1-a', False), ('doc4', '1-c', False),
+                          ('doc2', '2-d', True)], self.db.notifications)
+
+        yield self.db.cancel_listener(l_id)
+        self.assertEqual(dict(), self.notifier.extract_params())
+
+    @defer.inlineCallbacks
+    def testResumingFeed(self):
+        yield self.db.listen_changes(['doc1'], self.db.notified)
+        yield self.notifier.setup()
+        self.assertEqual(1, len(self.db.requests))
+        self.assertIn('since=5', self.db.requests[-1])
+
+        # adding listeners doesn't reopen the feed
+        yield self.db.listen_changes(['doc2'], self.db.notified)
+        yield self.notifier.setup()
+        self.assertEqual(1, len(self.db.requests))
+
+        # after losing the connection the feed resumes from the last change
+        self.notifier.changed(self._change(7, 'doc1', '2-a'))
+        self.notifier._changes = None
+        yield self.notifier.setup()
+        self.assertEqual(2, len(self.db.requests))
+        self.assertIn('since=7', self.db.requests[-1])
+
+        # the position is forgotten when pointing to other database
+        self.notifier._changes = None
+        self.db.db_name = 'other'
+        yield self.notifier.setup()
+        self.assertIn('/other/', self.db.requests[-1])
+        self.assertIn('since=5', self.db.requests[-1])
+
+    def _change(self, seq, doc_id, rev, deleted=False, **fields):
+        doc = dict(_id=doc_id, _rev=rev, **fields)
+        if deleted:
+            doc['_deleted'] = True
+        change = dict(seq=seq, id=doc_id, changes=[dict(rev=rev)], doc=doc)
+        if deleted:
+            change['deleted'] = True
+        return change
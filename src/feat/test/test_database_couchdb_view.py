@@ -0,0 +1,156 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+import json
+from cStringIO import StringIO
+
+from feat.common import time
+from feat.database import view
+from feat.database.couchdb import view as view_server
+
+from feat.test import common
+
+
+class PartnersView(view.BaseView):
+
+    name = 'partners'
+    use_reduce = True
+
+    def map(doc):
+        if doc.get('.type') == 'host_agent':
+            for partner in doc['partners']:
+                yield (doc['shard'], partner['role']), 1
+
+    def reduce(keys, values, rereduce):
+        return sum(values)
+
+
+REDUCE_COUNTING_CALLS = '''
+calls = []
+
+def reduce(keys, values):
+    calls.append(len(values))
+    return len(calls)
+'''
+
+MAP_LOGGING = '''
+def map(doc):
+    log("mapping %s" % (doc['_id'], ))
+    yield doc['_id'], None
+'''
+
+
+class Output(object):
+
+    def __init__(self):
+        self.flushes = 0
+        self._chunks = list()
+
+    def write(self, data):
+        self._chunks.append(data)
+
+    def flush(self):
+        self.flushes += 1
+
+    @property
+    def lines(self):
+        return [json.loads(line)
+                for line in ''.join(self._chunks).splitlines()]
+
+
+class TestViewServer(common.TestCase):
+
+    def testCompilingOnce(self):
+        commands = [['reset'],
+                    ['add_fun', PartnersView.get_code('map')],
+                    ['map_doc', descriptor(0)],
+                    ['reset'],
+                    ['add_fun', PartnersView.get_code('map')],
+                    ['map_doc', descriptor(1)]]
+        for _ in range(3):
+            commands.append(['reduce', [REDUCE_COUNTING_CALLS],
+                             [[['key', 'id'], 1]]])
+        commands.append(['rereduce', [REDUCE_COUNTING_CALLS], [1, 2, 3]])
+        output = self.run_server(commands)
+        expected = [[[[u'lobby', u'role_%d' % (i, )], 1]
+                     for i in range(5)]]
+        self.assertEqual([True, True, expected, True, True, expected,
+                          [True, [1]], [True, [2]], [True, [3]],
+                          [True, [4]]],
+                         output.lines)
+
+    def testBufferingOutput(self):
+        commands = [['add_fun', MAP_LOGGING],
+                    ['map_doc', {'_id': 'a'}],
+                    ['map_doc', {'_id': 'b'}]]
+        output = self.run_server(commands)
+        self.assertEqual([True,
+                          {u'log': u'mapping a'}, [[[u'a', None]]],
+                          {u'log': u'mapping b'}, [[[u'b', None]]]],
+                         output.lines)
+        # log lines are sent together with the response
+        self.assertEqual(3, output.flushes)
+
+    @common.attr('slow', timeout=300)
+    def testBenchmark(self):
+        # stream recorded the way CouchDB drives the server when building
+        # the index of a view: each document is mapped separately,
+        # the results are reduced in batches and then rereduced
+        commands = [['reset'], ['add_fun', PartnersView.get_code('map')]]
+        count = 10000
+        commands.extend(['map_doc', descriptor(index)]
+                        for index in xrange(count))
+        reduce_code = [PartnersView.get_code('reduce')]
+        rows = [[[[u'lobby', u'role_%d' % (i % 5, )], u'id_%d' % (i, )], 1]
+                for i in xrange(100)]
+        for _ in xrange(count / 10):
+            commands.append(['reduce', reduce_code, rows])
+            commands.append(['rereduce', reduce_code, [100] * 10])
+        stream = ''.join(json.dumps(command) + '\n' for command in commands)
+
+        start = time.time()
+        output = self.run_server(stream)
+        rate = len(commands) / (time.time() - start)
+        self.assertEqual(len(commands), len(output.lines))
+        self.info("%d commands processed/s", rate)
+
+    def run_server(self, commands):
+        if not isinstance(commands, str):
+            commands = ''.join(json.dumps(command) + '\n'
+                               for command in commands)
+        output = Output()
+        self.assertEqual(None, view_server.run(StringIO(commands), output))
+        return output
+
+
+def descriptor(index):
+    return {u'_id': u'descriptor_%d' % (index, ),
+            u'_rev': u'3-0123456789abcdef',
+            u'.type': u'host_agent',
+            u'shard': u'lobby',
+            u'hostname': u'host%d.example.com' % (index, ),
+            u'resources': {u'host': 1, u'bandwidth': 100, u'epu': 500},
+            u'partners': [
+                {u'.type': u'partner', u'role': u'role_%d' % (other, ),
+                 u'recipient': {u'.type': u'recipient',
+                                u'key': u'agent_%d' % (other, ),
+                                u'route': u'lobby'}}
+                for other in range(5)]}
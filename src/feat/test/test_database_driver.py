@@ -0,0 +1,478 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+import json
+
+from feat.common import defer, time, serialization
+from feat.database import driver, view, codec, document
+from feat.web import http, httpclient
+
+from feat.test import common
+
+
+class SomeView(view.BaseView):
+
+    name = 'some_view'
+
+    def map(doc):
+        yield doc['_id'], None
+
+
+@serialization.register
+class AttachedDocument(document.Document):
+
+    type_name = 'test-attached-document'
+
+    document.field('field', None)
+
+
+class DummyCouchDB(object):
+    '''
+    Replaces the connection pool, records the requests and lets the test
+    decide when and how to respond them.
+    '''
+
+    def __init__(self):
+        self.requests = list()
+        self.etag = '"1"'
+
+    def get(self, url, headers=dict(), **extra):
+        return self._request('GET', url, headers)
+
+    def post(self, url, body=None, headers=dict(), **extra):
+        return self._request('POST', url, headers, body)
+
+    def put(self, url, body=None, headers=dict(), **extra):
+        return self._request('PUT', url, headers, body)
+
+    def delete(self, url, headers=dict(), **extra):
+        return self._request('DELETE', url, headers)
+
+    def disconnect(self):
+        pass
+
+    def respond(self, body=None, status=http.Status.OK, index=-1):
+        _, url, headers, _, d = self.requests[index]
+        response = httpclient.Response()
+        response.status = status
+        response.headers = {'content-type': 'application/json',
+                            'etag': self.etag}
+        if status == 304:
+            response.body = ''
+        else:
+            response.body = json.dumps(body)
+        d.callback(response)
+
+    def get_header(self, name):
+        return self.requests[-1][2].get(name)
+
+    def get_body(self):
+        return self.requests[-1][3]
+
+    def _request(self, method, url, headers, body=None):
+        d = defer.Deferred()
+        self.requests.append((method, url, headers, body, d))
+        return d
+
+
+class TestCache(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.cache = driver.Cache(desired_size=100)
+
+    def testLeastRecentlyUsed(self):
+        for key in ('a', 'b'):
+            self.add(key, 40)
+        self.assertEqual(80, self.cache.get_size())
+        self.cache.get_url('a')
+        self.add('c', 40)
+        self.assertEqual(['a', 'c'], sorted(self.cache.keys()))
+        self.assertEqual(80, self.cache.get_size())
+        self.assertEqual(1, self.cache.evictions)
+
+        # invalidated entries are removed straight away
+        entry = self.add('d', 10, state=driver.EntryState.invalid)
+        self.assertNotIn('d', self.cache)
+        self.assertEqual(80, self.cache.get_size())
+
+        # responses of entries removed in the meantime are ignored
+        entry = driver.CacheEntry('tag', driver.parse_response)
+        self.cache['e'] = entry
+        del self.cache['e']
+        entry.size = 10
+        self.cache.account('e', entry)
+        self.assertEqual(80, self.cache.get_size())
+
+        self.cache.desired_size = 50
+        self.assertEqual(['c'], self.cache.keys())
+        self.cache.clear()
+        self.assertEqual(0, self.cache.get_size())
+
+    def testWaitingEntriesNotEvicted(self):
+        waiting = self.add('a', 0, state=driver.EntryState.waiting)
+        self.add('b', 60)
+        # the revalidated entry keeps the size of the previous response
+        self.add('c', 30)
+        self.cache['c'].state = driver.EntryState.waiting
+        self.add('d', 60)
+        self.assertEqual(['a', 'c', 'd'], sorted(self.cache.keys()))
+        self.assertIs(waiting, self.cache.get_url('a'))
+        self.assertEqual(1, self.cache.evictions)
+
+        # only the ready entries count for the desired size
+        self.add('e', 70)
+        self.assertEqual(['a', 'c', 'e'], sorted(self.cache.keys()))
+        self.assertEqual(100, self.cache.get_size())
+
+        waiting.size = 10
+        waiting.state = driver.EntryState.ready
+        self.cache.account('a', waiting)
+        self.assertEqual(['a', 'c', 'e'], sorted(self.cache.keys()))
+        self.assertEqual(110, self.cache.get_size())
+
+        self.cache['c'].state = driver.EntryState.ready
+        self.cache.account('c', self.cache['c'])
+        self.assertEqual(['a', 'e'], sorted(self.cache.keys()))
+        self.assertEqual(80, self.cache.get_size())
+
+    def testSegmentedLeastRecentlyUsed(self):
+        self.cache = driver.Cache(desired_size=100,
+                                  policy=driver.CachePolicy.slru)
+        for key in ('a', 'b'):
+            self.add(key, 30)
+            self.cache.get_url(key)
+        # a scan of one-off requests doesn't evict the reused entries
+        for key in range(10):
+            self.add(key, 30)
+        self.assertEqual(set(['a', 'b', 9]), set(self.cache.keys()))
+        self.assertEqual(90, self.cache.get_size())
+
+        # the reused entries can take only a part of the cache
+        self.add('c', 30)
+        self.cache.get_url('c')
+        self.assertEqual(60, self.cache._protected_size)
+        self.assertEqual(['b', 'c'], list(self.cache._protected))
+
+    @common.attr('slow', timeout=120)
+    def testBenchmarkEviction(self):
+        count = 100000
+        for policy in driver.CachePolicy:
+            # big enough to keep 50000 entries
+            self.cache = driver.Cache(desired_size=5000000, policy=policy)
+            start = time.time()
+            for key in xrange(count):
+                self.add(key, 100)
+                self.cache.get_url(key - key % 7)
+            inserted = count / (time.time() - start)
+            self.assertEqual(5000000, self.cache.get_size())
+            self.info("%s: %d entries cached and evicted/s",
+                      policy.name, inserted)
+
+    def add(self, key, size, state=driver.EntryState.ready):
+        entry = driver.CacheEntry('tag', driver.parse_response)
+        self.cache[key] = entry
+        entry.size = size
+        entry.state = state
+        self.cache.account(key, entry)
+        return entry
+
+
+class TestCodec(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.addCleanup(codec.use, codec.get_backend())
+
+    def testBackends(self):
+        self.assertIn('json', codec.get_backends())
+        self.assertRaises(ValueError, codec.use, 'unknown')
+
+        for backend in codec.get_backends():
+            codec.use(backend)
+            self.assertEqual(backend, codec.get_backend())
+            encoded = codec.encode({u'a': [1, u'\xf3', None, 0.5]})
+            self.assertIsInstance(encoded, str)
+            self.assertEqual('{"a":[1,"\\u00f3",null,0.5]}', encoded)
+            decoded = codec.decode('{"a": ["b", "\\u00f3"]}')
+            self.assertEqual({u'a': [u'b', u'\xf3']}, decoded)
+            # strings are always decoded as unicode
+            self.assertIsInstance(decoded[u'a'][0], unicode)
+            self.assertIsInstance(decoded.keys()[0], unicode)
+            self.assertRaises(ValueError, codec.decode, '{"a": ')
+
+    def testJSONDocument(self):
+        data = {u'_id': u'id', u'value': 1}
+        doc = codec.JSONDocument(data)
+        self.assertIsInstance(doc, str)
+        self.assertEqual(data, codec.decode(doc))
+        self.assertIs(data, doc.data)
+
+    @defer.inlineCallbacks
+    def testSavingFollowingAttachments(self):
+        db = driver.Database('localhost', 5984, 'test')
+        couchdb = DummyCouchDB()
+        db.couchdb = couchdb
+        db.version = (1, 2, 0)
+        self.addCleanup(db.disconnect)
+        connection = db.get_connection()
+
+        doc = AttachedDocument(doc_id=u'some_doc', field=u'value')
+        doc.create_attachment('attachment', 'data')
+        d = connection.save_document(doc)
+        body = codec.decode(couchdb.get_body())
+        # the attachments following the document are not sent along
+        self.assertEqual({}, body['_attachments'])
+        self.assertEqual(u'value', body['field'])
+        couchdb.respond(dict(ok=True, id=u'some_doc', rev=u'1-abc'))
+        self.assertEqual('PUT', couchdb.requests[-1][0])
+        self.assertEqual('data', couchdb.get_body())
+        couchdb.respond(dict(ok=True, id=u'some_doc', rev=u'2-abc'))
+        doc = yield d
+        self.assertEqual(u'2-abc', doc.rev)
+        self.assertTrue(doc.get_attachments()['attachment'].saved)
+
+    @common.attr('slow', timeout=120)
+    def testBenchmark(self):
+        serializer = serialization.json.Serializer(
+            force_unicode=True, sort_keys=True, track_references=False)
+        descriptors = [self.descriptor(index) for index in xrange(200)]
+        serialized = [serializer.convert(doc) for doc in descriptors]
+        result = codec.encode(dict(
+            total_rows=len(descriptors), offset=0,
+            rows=[dict(id=doc[u'_id'], key=doc[u'_id'], value=None, doc=doc)
+                  for doc in map(codec.decode, serialized)]))
+        view_result = codec.decode(result)
+        for backend in codec.get_backends():
+            codec.use(backend)
+            decoded = self.measure(codec.decode, serialized)
+            encoded = self.measure(codec.encode, descriptors)
+            self.info("%s: %d descriptors decoded/s, %d encoded/s",
+                      backend, decoded, encoded)
+            decoded = self.measure(codec.decode, [result])
+            encoded = self.measure(codec.encode, [view_result])
+            self.info("%s: %d view results of %d bytes decoded/s, "
+                      "%d encoded/s", backend, decoded, len(result), encoded)
+
+    def measure(self, function, items, repeat=50):
+        start = time.time()
+        for _ in xrange(repeat):
+            for item in items:
+                function(item)
+        return repeat * len(items) / (time.time() - start)
+
+    def descriptor(self, index):
+        return {u'_id': u'descriptor_%d' % (index, ),
+                u'_rev': u'3-0123456789abcdef',
+                u'.type': u'host_agent',
+                u'.version': 2,
+                u'shard': u'lobby',
+                u'hostname': u'host%d.example.com' % (index, ),
+                u'instance_id': 1,
+                u'under_restart': None,
+                u'resources': {u'host': 1, u'bandwidth': 100, u'epu': 500},
+                u'partners': [
+                    {u'.type': u'partner', u'role': None,
+                     u'recipient': {u'.type': u'recipient',
+                                    u'key': u'agent_%d' % (other, ),
+                                    u'route': u'lobby'}}
+                    for other in range(5)]}
+
+
+class TestFollowingChanges(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.db = driver.Database('localhost', 5984, 'test')
+        self.couchdb = DummyCouchDB()
+        self.db.couchdb = self.couchdb
+        self.cache = self.db._cache
+        # pretend the changes feed is running
+        self.cache.start_following()
+
+    def tearDown(self):
+        self.db.disconnect()
+        return common.TestCase.tearDown(self)
+
+    @defer.inlineCallbacks
+    def testViewEntries(self):
+        yield self.query()
+        self.assertEqual(1, self.cache.misses)
+
+        # nothing has changed, no request is done
+        result = yield self.db.query_view(SomeView)
+        self.assertEqual([('a', None, 'a')], result)
+        self.assertEqual(1, len(self.couchdb.requests))
+        self.assertEqual(1, self.cache.hits)
+
+        # changes to other design documents don't matter
+        self.cache.changed(u'_design/other')
+        yield self.db.query_view(SomeView)
+        self.assertEqual(1, len(self.couchdb.requests))
+
+        # changes to regular documents and own design document do
+        for doc_id in (u'some_doc', u'_design/feat'):
+            self.cache.changed(doc_id)
+            yield self.query(revalidate=True)
+            yield self.db.query_view(SomeView)
+        self.assertEqual(3, len(self.couchdb.requests))
+        self.assertEqual(2, self.cache.revalidations)
+        self.assertEqual(4, self.cache.hits)
+
+    @defer.inlineCallbacks
+    def testDocumentEntries(self):
+        d = self.db.bulk_get([u'a', u'b'])
+        self.couchdb.respond(dict(rows=[]))
+        yield d
+
+        self.cache.changed(u'c')
+        yield self.db.bulk_get([u'a', u'b'])
+        self.assertEqual(1, len(self.couchdb.requests))
+
+        self.cache.changed(u'b')
+        d = self.db.bulk_get([u'a', u'b'])
+        self.assertEqual(2, len(self.couchdb.requests))
+        self.assertEqual('"1"', self.couchdb.get_header('If-None-Match'))
+        self.couchdb.respond(status=304)
+        yield d
+
+        # removing the entry forgets about its dependencies
+        self.assertIn(u'a', self.cache._dependents)
+        for key in self.cache.keys():
+            del self.cache[key]
+        self.assertEqual(dict(), self.cache._dependents)
+
+    @defer.inlineCallbacks
+    def testLocalWrites(self):
+        yield self.query()
+
+        d = self.db.delete_doc(u'some_doc', u'1-abc')
+        self.couchdb.respond(dict(ok=True, id=u'some_doc', rev=u'2-abc'))
+        yield d
+
+        # revalidated without waiting for the changes feed
+        yield self.query(revalidate=True)
+        self.assertEqual(1, self.cache.revalidations)
+
+    @defer.inlineCallbacks
+    def testChangeDuringRequest(self):
+        d = self.db.query_view(SomeView)
+        self.cache.changed(u'some_doc')
+        self.couchdb.respond(dict(rows=[]))
+        yield d
+
+        # the response might not include the change
+        yield self.query(revalidate=True)
+        self.assertEqual(2, len(self.couchdb.requests))
+
+    @defer.inlineCallbacks
+    def testNotFollowing(self):
+        yield self.query()
+        self.cache.stop_following()
+        yield self.query(revalidate=True)
+        self.cache.start_following()
+        # entries validated before starting following are revalidated once
+        yield self.query(revalidate=True)
+        yield self.db.query_view(SomeView)
+        self.assertEqual(3, len(self.couchdb.requests))
+
+        status = self.db.show_connection_status()
+        self.assertEqual("hits: 1\nmisses: 1\nrevalidations: 2", status[-1])
+
+    @defer.inlineCallbacks
+    def testChangesFeed(self):
+        self.db.disconnect()
+        self.db = driver.Database('localhost', 5984, 'test',
+                                  multiplex_changes=True, follow_changes=True)
+        self.db.couchdb = self.couchdb
+        self.cache = self.db._cache
+        self.cache.start_following()
+        yield self.query()
+
+        notifier = self.db._get_notifier(self.db._cache_filter)
+        self.assertEqual(dict(), notifier.extract_params())
+        notifier.changed(dict(seq=1, id=u'some_doc',
+                              changes=[dict(rev=u'1-abc')]))
+        yield self.query(revalidate=True)
+
+    def query(self, revalidate=False):
+        d = self.db.query_view(SomeView)
+        if revalidate:
+            self.assertEqual('"1"', self.couchdb.get_header('If-None-Match'))
+            self.couchdb.respond(status=304)
+        else:
+            self.assertIs(None, self.couchdb.get_header('If-None-Match'))
+            self.couchdb.respond(
+                dict(rows=[dict(key='a', value=None, id='a')]))
+        return d
+
+
+class TestViewWarmness(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.db = driver.Database('localhost', 5984, 'test',
+                                  stale_until_warm=True)
+        self.couchdb = DummyCouchDB()
+        self.db.couchdb = self.couchdb
+        self.db.version = (1, 2, 0)
+
+    def tearDown(self):
+        self.db.disconnect()
+        return common.TestCase.tearDown(self)
+
+    @defer.inlineCallbacks
+    def testStaleUntilWarm(self):
+        yield self.query(stale=True)
+        # the state of the index is checked in the meantime
+        self.assertEqual('/test/', self.couchdb.requests[0][1])
+        self.couchdb.respond(dict(update_seq=10), index=0)
+        self.assertEqual('/test/_design/feat/_info',
+                         self.couchdb.requests[-1][1])
+        self.couchdb.respond(dict(view_index=dict(update_seq=10,
+                                                  updater_running=True)))
+
+        # it is not checked again too soon
+        yield self.query(stale=True)
+        self.assertEqual(4, len(self.couchdb.requests))
+
+        self.db._index_checks[u'feat'] -= self.db.WARM_CHECK_INTERVAL + 1
+        d = self.db.get_connection().is_view_warm(SomeView)
+        self.couchdb.respond(dict(update_seq=11))
+        self.couchdb.respond(dict(view_index=dict(update_seq=11,
+                                                  updater_running=False)))
+        self.assertTrue((yield d))
+        yield self.query(stale=False)
+
+    @defer.inlineCallbacks
+    def testWarmedByQuerying(self):
+        self.db.stale_until_warm = False
+        yield self.query(stale=False)
+        self.assertEqual(1, len(self.couchdb.requests))
+        self.assertTrue((yield self.db.check_view_index(u'feat')))
+        self.assertEqual(1, len(self.couchdb.requests))
+
+    def query(self, stale):
+        d = self.db.query_view(SomeView)
+        self.assertEqual(stale, 'stale=update_after' in
+                         self.couchdb.requests[-1][1])
+        self.couchdb.respond(dict(rows=[]))
+        return d
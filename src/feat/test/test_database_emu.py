@@ -23,12 +23,24 @@ import json
 
 from twisted.internet import defer
 
-from feat.database import emu
+from feat.database import emu, view
 from feat.database.interface import ConflictError, NotFoundError
 
 from . import common
 
 
+class GroupView(view.BaseView):
+
+    name = 'group_view'
+    use_reduce = True
+
+    def map(doc):
+        if 'group' in doc:
+            yield (doc['group'], doc['_id']), doc['value']
+
+    reduce = "_sum"
+
+
 class TestDatabase(common.TestCase):
 
     def setUp(self):
@@ -117,6 +129,32 @@ class TestDatabase(common.TestCase):
         self.assertEqual(1, len(self.database._documents))
         self.assertTrue(resp['id'] in self.database._documents)
 
+    @defer.inlineCallbacks
+    def testBulkSave(self):
+        resp = yield self.database.save_doc(
+            json.dumps(self._generate_content('some text')))
+        conflicting = self._generate_content('conflicting text')
+        conflicting['_id'] = resp['id']
+        updated = self._generate_content('updated text')
+        updated['_id'] = 'other'
+
+        docs = [self._generate_content('new text'), conflicting, updated]
+        rows = yield self.database.bulk_save([json.dumps(x) for x in docs])
+
+        self.assertEqual(3, len(rows))
+        self.assertTrue(rows[0]['id'] in self.database._documents)
+        self.assertTrue('rev' in rows[0])
+        self.assertEqual(resp['id'], rows[1]['id'])
+        self.assertEqual('conflict', rows[1]['error'])
+        self.assertEqual('other', rows[2]['id'])
+        self.assertEqual(3, len(self.database._documents))
+        doc = self.database._documents[resp['id']]
+        self.assertEqual('some text', doc['text'])
+
+        d = self.database.bulk_save(['not json'])
+        self.assertFailure(d, ValueError)
+        yield d
+
     def _generate_content(self, text):
         return dict(text=text)
 
@@ -198,6 +236,68 @@ class TestDatabaseIntegration(common.TestCase):
         yield self.database.delete_doc(doc_id, rev)
         self.assertEqual(1, len(self.calls))
 
+    @defer.inlineCallbacks
+    def testQueryingViewIndex(self):
+        revs = dict()
+        for doc_id, group, value in (('e', 2, 5), ('a', 1, 1), ('d', 2, 4),
+                                     ('c', 1, 3), ('b', 1, 2)):
+            resp = yield self.database.save_doc(json.dumps(
+                dict(_id=doc_id, group=group, value=value)))
+            revs[doc_id] = resp['rev']
+        yield self.database.save_doc(json.dumps(dict(_id='other')))
+
+        def query(**options):
+            d = self.database.query_view(GroupView, reduce=False, **options)
+            d.addCallback(lambda rows: [row[2] for row in rows])
+            return d
+
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'], (yield query()))
+        self.assertEqual(['e', 'd', 'c', 'b', 'a'],
+                         (yield query(descending=True)))
+        self.assertEqual(['c', 'd'], (yield query(skip=2, limit=2)))
+        self.assertEqual(['c', 'd', 'e'], (yield query(skip=2)))
+        self.assertEqual(['b', 'c', 'd'],
+                         (yield query(startkey=(1, 'b'), endkey=(2, 'd'))))
+        self.assertEqual(['d', 'e'], (yield query(startkey=(2, ),
+                                                  endkey=(2, {}))))
+        self.assertEqual(['c', 'b'], (yield query(
+            startkey=(1, {}), endkey=(1, 'b'), descending=True, limit=2)))
+        self.assertEqual(['c'], (yield query(key=(1, 'c'))))
+        self.assertEqual(['a', 'e'], (yield query(
+            keys=[(2, 'e'), (1, 'a'), (2, 'e'), (3, 'x')])))
+
+        # the index is updated with the changed documents, one by one
+        index = self.database._get_index(GroupView)
+        index.REBUILD_RATIO = 1
+        yield self.database.delete_doc('b', revs['b'])
+        yield self.database.save_doc(json.dumps(
+            dict(_id='c', _rev=revs['c'], group=2, value=3)))
+        yield self.database.save_doc(json.dumps(
+            dict(_id='f', group=1, value=6)))
+        self.assertEqual(['a', 'f', 'c', 'd', 'e'], (yield query()))
+
+        result = yield self.database.query_view(GroupView)
+        self.assertEqual([(None, 19)], result)
+        result = yield self.database.query_view(GroupView, group_level=1)
+        self.assertEqual([((1, ), 7), ((2, ), 12)], result)
+        result = yield self.database.query_view(
+            GroupView, group_level=1, descending=True, limit=1)
+        self.assertEqual([((2, ), 12)], result)
+        result = yield self.database.query_view(GroupView, group=True,
+                                                startkey=(2, ))
+        self.assertEqual([((2, 'c'), 3), ((2, 'd'), 4), ((2, 'e'), 5)],
+                         result)
+
+        # reduce results are computed once per group level and range
+        self.assertEqual(3, len(index.reduced))
+        yield self.database.query_view(GroupView, group_level=1)
+        self.assertEqual(3, len(index.reduced))
+        yield self.database.save_doc(json.dumps(
+            dict(_id='g', group=3, value=1)))
+        result = yield self.database.query_view(GroupView, group_level=1)
+        self.assertEqual([((1, ), 7), ((2, ), 12), ((3, ), 1)], result)
+        self.assertEqual(1, len(index.reduced))
+
     def change_cb(self, doc_id, rev, deleted):
         self.calls.append((doc_id, rev, deleted))
 
@@ -1,5 +1,8 @@
+import time
+
 from zope.interface import classProvides
 
+from feat.common import defer
 from feat.database import query
 from feat.database.interface import IViewFactory
 from feat.test import common
@@ -71,3 +74,227 @@ class TestQueryObject(common.TestCase):
                                           query.Evaluator.equals, 1))
         self.assertRaises(ValueError, DummyQuery,
                           aggregation=[['unknown handler', 'field1']])
+
+
+class DummyConnection(object):
+    '''
+    Serves the query view of DummyQuery from the dictionaries of
+    the document fields, caching the parsed indexes like the real one.
+    '''
+
+    def __init__(self, documents):
+        self.update(documents)
+
+    def update(self, documents):
+        # the new view responses would come with the new ETags
+        self.rows = sorted(((field, value), None, doc_id)
+                           for doc_id, doc in documents.iteritems()
+                           for field, value in doc.iteritems())
+        self.cache = dict()
+
+    def query_view(self, factory, parse_results=True, cache_id_suffix='',
+                   post_process=None, if_modified_since=None, **keys):
+        cache_id = repr(sorted(keys.items())) + cache_id_suffix
+        if cache_id not in self.cache:
+            rows = [x for x in self.rows if self._matches(x[0], keys)]
+            self.cache[cache_id] = post_process(rows, None)
+        return defer.succeed(self.cache[cache_id])
+
+    def _matches(self, key, options):
+        if 'keys' in options:
+            return key in options['keys']
+        if 'key' in options:
+            return key == options['key']
+        startkey, endkey = options['startkey'], options['endkey']
+        if key[0] != startkey[0]:
+            return False
+        # () and ({}) are the open ends of the range
+        if startkey[1:] and key[1] < startkey[1]:
+            return False
+        if endkey[1:] != ({}, ) and key[1] > endkey[1]:
+            return False
+        return True
+
+
+class TestSelectingIds(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        documents = dict(
+            (u'doc_%02d' % (x, ), dict(field1=x, field2=x % 10,
+                                       field3=u'AB'[x % 2]))
+            for x in range(20))
+        # documents missing in the index of field1
+        documents[u'doc_20'] = dict(field2=0, field3=u'A')
+        documents[u'doc_21'] = dict(field2=1, field3=u'B')
+        self.connection = DummyConnection(documents)
+
+    @defer.inlineCallbacks
+    def testCombiningIndexes(self):
+        C = query.Condition
+        E = query.Evaluator
+        O = query.Operator
+        D = query.Direction
+        c1 = C('field1', E.le, 9)
+        c2 = C('field2', E.ge, 5)
+        c3 = C('field3', E.equals, u'B')
+        c4 = C('field1', E.between, (5, 14))
+
+        yield self.check(range(10), c1)
+        yield self.check([5, 6, 7, 8, 9], c1, O.AND, c2)
+        yield self.check(range(10) + range(15, 20), c1, O.OR, c2)
+        yield self.check([9, 7, 6, 5], c1, O.AND, c4, O.AND,
+                         DummyQuery(c3, O.OR, C('field2', E.equals, 6)),
+                         sorting=('field1', D.DESC))
+        yield self.check(range(1, 20, 2) + [21], c3)
+        yield self.check(range(19, 0, -2) + [21], c3,
+                         sorting=('field1', D.DESC))
+        yield self.check([7, 9, 11], c3, skip=3, limit=3)
+        yield self.check([19, 21], c3, skip=9)
+
+        q = DummyQuery(c1, O.AND, c3, aggregate=[['sum', 'field1']])
+        res = yield query.select_ids(self.connection, q)
+        self.assertEqual([1 + 3 + 5 + 7 + 9], res.aggregations)
+
+        values = yield query.values(self.connection, DummyQuery(c3), 'field1')
+        self.assertEqual(set([None, 1, 3, 5, 7, 9, 11, 13, 15, 17, 19]),
+                         set(values))
+
+    @defer.inlineCallbacks
+    def testCachingResults(self):
+        C = query.Condition
+        E = query.Evaluator
+        O = query.Operator
+        c1 = C('field1', E.le, 9)
+        c3 = C('field3', E.equals, u'B')
+        cache = query.QueryCache()
+
+        q = DummyQuery(c1, O.AND, c3, aggregate=[['sum', 'field1']])
+        res = yield query.select_ids(self.connection, q, limit=2, cache=cache)
+        self.assertEqual([u'doc_01', u'doc_03'], res)
+        self.assertEqual(5, res.total_count)
+        self.assertEqual([25], res.aggregations)
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+
+        # the order of the parts doesn't matter
+        q = DummyQuery(c3, O.AND, c1, aggregate=[['sum', 'field1']],
+                       sorting=('field1', query.Direction.ASC))
+        res = yield query.select_ids(self.connection, q, skip=2, limit=2,
+                                     cache=cache)
+        self.assertEqual([u'doc_05', u'doc_07'], res)
+        self.assertEqual(5, res.total_count)
+        self.assertEqual([25], res.aggregations)
+        count = yield query.count(self.connection, q, cache=cache)
+        self.assertEqual(5, count)
+        self.assertEqual((2, 1), (cache.hits, cache.misses))
+
+        # different sorting is a different entry
+        q = DummyQuery(c1, O.AND, c3, aggregate=[['sum', 'field1']],
+                       sorting=('field1', query.Direction.DESC))
+        res = yield query.select_ids(self.connection, q, limit=2, cache=cache)
+        self.assertEqual([u'doc_09', u'doc_07'], res)
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+        self.assertEqual(2, len(cache))
+
+        # changed indexes invalidate the entry
+        self.connection.update(dict(doc_05=dict(field1=5, field3=u'B')))
+        res = yield query.select_ids(self.connection, q, limit=2, cache=cache)
+        self.assertEqual([u'doc_05'], res)
+        self.assertEqual([5], res.aggregations)
+        self.assertEqual((2, 3), (cache.hits, cache.misses))
+
+        cache = query.QueryCache(size=1)
+        yield query.select_ids(self.connection, DummyQuery(c1), cache=cache)
+        yield query.select_ids(self.connection, DummyQuery(c3), cache=cache)
+        yield query.select_ids(self.connection, DummyQuery(c1), cache=cache)
+        self.assertEqual((0, 3), (cache.hits, cache.misses))
+        self.assertEqual(1, len(cache))
+
+        # the least recently used entry is evicted
+        c2 = C('field2', E.equals, 6)
+        cache = query.QueryCache(size=2)
+        for c in (c1, c3, c1, c2, c1, c3):
+            yield query.select_ids(self.connection, DummyQuery(c),
+                                   cache=cache)
+        self.assertEqual((2, 4), (cache.hits, cache.misses))
+        self.assertEqual(2, len(cache))
+
+    @defer.inlineCallbacks
+    def testRotatingDocumentIds(self):
+        C = query.Condition
+        E = query.Evaluator
+        ids = query.DocumentIds(limit=5)
+        self.patch_document_ids(ids)
+
+        yield self.check([1, 3], C('field1', E.le, 3),
+                         query.Operator.AND, C('field3', E.equals, u'B'))
+        generation = ids.generation
+        # the mapping is started over before the next query,
+        # the cached indexes get translated again
+        self.assertTrue(len(ids) > 5)
+        yield self.check([1, 3], C('field1', E.le, 3),
+                         query.Operator.AND, C('field3', E.equals, u'B'))
+        self.assertNotEqual(generation, ids.generation)
+
+    def testBitmaps(self):
+        self.assertEqual(0, query._to_bitmap([]))
+        bitmap = query._to_bitmap([0, 9, 3, 9, 17])
+        self.assertEqual(2 ** 0 + 2 ** 3 + 2 ** 9 + 2 ** 17, bitmap)
+        self.assertEqual(4, query._count(bitmap))
+        rows = query._to_buffer(bitmap)
+        self.assertEqual([0, 3, 9, 17], list(query._iter_numbers(rows)))
+        self.assertEqual(bytearray(), query._to_buffer(0))
+
+    @common.attr('slow', timeout=300)
+    @defer.inlineCallbacks
+    def testBenchmark(self):
+        count = 100000
+        documents = dict(
+            (u'doc_%06d' % (x, ), dict(field1=x, field2=x % 100,
+                                       field3=u'ABC'[x % 3]))
+            for x in xrange(count))
+        self.connection = DummyConnection(documents)
+
+        C = query.Condition
+        E = query.Evaluator
+        O = query.Operator
+        D = query.Direction
+        q = DummyQuery(C('field1', E.ge, 1000), O.AND,
+                       DummyQuery(C('field2', E.le, 50), O.OR,
+                                  C('field3', E.equals, u'A')),
+                       sorting=('field1', D.DESC))
+        # fill the cache of the connection
+        res = yield query.select_ids(self.connection, q, limit=20)
+        total = res.total_count
+
+        repeat = 20
+        start = time.time()
+        for _ in xrange(repeat):
+            res = yield query.select_ids(self.connection, q, limit=20)
+        selected = repeat / (time.time() - start)
+        self.assertEqual(total, res.total_count)
+        self.assertEqual(u'doc_%06d' % (count - 1, ), res[0])
+
+        start = time.time()
+        for _ in xrange(repeat):
+            counted = yield query.count(self.connection, q)
+        counted_per_second = repeat / (time.time() - start)
+        self.assertEqual(total, counted)
+        self.info("%d of %d documents matched, %.1f selects/s, "
+                  "%.1f counts/s", total, count, selected,
+                  counted_per_second)
+
+    @defer.inlineCallbacks
+    def check(self, expected, *parts, **kwargs):
+        skip = kwargs.pop('skip', 0)
+        limit = kwargs.pop('limit', None)
+        q = DummyQuery(*parts, **kwargs)
+        res = yield query.select_ids(self.connection, q, skip, limit)
+        self.assertEqual([u'doc_%02d' % (x, ) for x in expected], res)
+        count = yield query.count(self.connection, q)
+        self.assertEqual(res.total_count, count)
+
+    def patch_document_ids(self, ids):
+        self.addCleanup(setattr, query, '_document_ids',
+                        query._document_ids)
+        query._document_ids = ids
@@ -270,3 +270,99 @@ class TestTriggeringViewUpdate(common.TestCase):
     def _query_view(self, factory, **params):
         self.view_query_defers.append(defer.Deferred())
         return self.view_query_defers[-1]
+
+
+class OtherView(view.BaseView):
+
+    name = "other_view"
+    design_doc_id = "other_design_doc"
+
+    def map(doc):
+        yield None, True
+
+
+class ThirdView(view.BaseView):
+
+    name = "third_view"
+    design_doc_id = "third_design_doc"
+
+    def map(doc):
+        yield None, True
+
+
+class TestViewIndexWarmup(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+
+        self.connection = mock.Mock(spec=client.Connection)
+        self.queries = list()
+        self.connection.query_view = mock.Mock(side_effect=self._query_view)
+        self.db = mock.Mock(spec=driver.Database)
+        self.db.db_name = 'dbname'
+        self.connection._database = self.db
+        self.active_tasks_requests = list()
+        self.db.couchdb_call = mock.Mock(side_effect=self._get_active_tasks)
+        self.db.couchdb = mock.Mock(spec=driver.CouchDB)
+
+        self.design_docs = view.DesignDocument.generate_from_views(
+            [SomeView, OtherView, ThirdView])
+        self.design_docs.append(
+            view.DesignDocument(doc_id=u"design_doc_without_views"))
+        self.warmup = tools.ViewIndexWarmup(
+            self.connection, self.design_docs, concurrency=2)
+
+    @defer.inlineCallbacks
+    def testConcurrencyLimit(self):
+        d = self.warmup.start()
+        self.assertEqual(2, len(self.queries))
+        self.assertEqual(0, self.warmup.get_progress())
+
+        factory, query = self.queries[0]
+        query.callback([])
+        self.assertEqual(3, len(self.queries))
+        doc_id = u'_design/' + factory.design_doc_id
+        self.assertEqual(100, self.warmup.progress[doc_id])
+
+        factory, query = self.queries[1]
+        query.errback(driver.DatabaseError('nope!'))
+        self.queries[2][1].callback([])
+
+        failed = yield d
+        self.assertEqual([u'_design/' + factory.design_doc_id], failed)
+
+    @defer.inlineCallbacks
+    def testSharingActiveTasks(self):
+        d1 = self.warmup.get_active_tasks()
+        d2 = self.warmup.get_active_tasks()
+        self.assertEqual(1, len(self.active_tasks_requests))
+
+        self.active_tasks_requests[0].callback(
+            [{'type': 'indexer',
+              'database': self.db.db_name,
+              'design_document': u'_design/other_design_doc',
+              'progress': 60},
+             {'type': 'indexer',
+              'database': 'other_db',
+              'design_document': u'_design/test_design_doc',
+              'progress': 90}])
+        tasks = yield d1
+        self.assertEqual(2, len(tasks))
+        self.assertIs(tasks, (yield d2))
+        self.assertEqual(60, self.warmup.progress[u'_design/other_design_doc'])
+        self.assertEqual(20, self.warmup.get_progress())
+
+        # the result is reused by the tasks polling at the same time
+        yield self.warmup.get_active_tasks()
+        self.assertEqual(1, len(self.active_tasks_requests))
+
+    def _get_active_tasks(self, method, location):
+        assert method is self.db.couchdb.get, repr(method)
+        assert location == '/_active_tasks', repr(location)
+
+        self.active_tasks_requests.append(defer.Deferred())
+        return self.active_tasks_requests[-1]
+
+    def _query_view(self, factory, **params):
+        self.queries.append((factory, defer.Deferred()))
+        return self.queries[-1][1]
@@ -23,6 +23,7 @@
 
 import json
 import pprint
+import time
 import types
 import StringIO
 
@@ -241,6 +242,45 @@ class DummyModel(model.Model):
                     effect.context_value('view'))
 
 
+@register
+class NumberModel(model.Model):
+    model.identity('test.number')
+    model.attribute('value', value.Integer(),
+                    getter.source_attr('value'))
+
+
+@register
+class NumbersModel(model.Collection):
+    model.identity('test.numbers')
+    model.child_model('test.number')
+    model.child_names(getter.source_list_names('numbers'))
+    model.child_source(getter.source_list_get('numbers'))
+    model.child_meta('json', 'render-inline')
+
+
+@register
+class NumbersListModel(NumbersModel):
+    model.identity('test.numbers_list')
+    model.meta('json', 'render-as-list')
+
+
+class DummyNumbers(object):
+
+    def __init__(self, count):
+        self.numbers = [DummyChild(x) for x in range(count)]
+
+
+class RecordingDocument(document.WritableDocument):
+
+    def __init__(self, *args, **kwargs):
+        document.WritableDocument.__init__(self, *args, **kwargs)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return document.WritableDocument.write(self, data)
+
+
 class TestApplicationJSON(common.TestCase):
 
     @defer.inlineCallbacks
@@ -715,6 +755,113 @@ class TestApplicationJSON(common.TestCase):
         structs = yield item.fetch()
         yield self.check(structs, {u"href": u"root/some/place"})
 
+    @defer.inlineCallbacks
+    def testStreamingCollections(self):
+        ctx = DummyContext(("ROOT", ), ("root", ))
+        source = DummyNumbers(120)
+        expected = [{u"value": x} for x in range(120)]
+
+        # the list is written in windows of 50 items plus the closing
+        numbers = NumbersListModel(source)
+        doc = RecordingDocument("application/json", encoding="UTF8")
+        yield document.write(doc, numbers, context=ctx, format="compact")
+        self.assertEqual(4, doc.writes)
+        data = doc.get_data()
+        self.assertEqual(expected, json.loads(data))
+
+        # the output is the same as when rendering the whole structure
+        struct = yield applicationjson.render_compact_model(numbers, ctx)
+        buffered = document.WritableDocument("application/json",
+                                             encoding="UTF8")
+        applicationjson.render_json(struct, buffered)
+        self.assertEqual(buffered.get_data(), data)
+
+        numbers = NumbersModel(source)
+        doc = RecordingDocument("application/json", encoding="UTF8")
+        yield document.write(doc, numbers, context=ctx, format="compact")
+        self.assertEqual(4, doc.writes)
+        self.assertEqual(dict((unicode(x), {u"value": x})
+                              for x in range(120)),
+                         json.loads(doc.get_data()))
+
+        empty = NumbersListModel(DummyNumbers(0))
+        yield self.check(empty, [])
+
+    @defer.inlineCallbacks
+    def testRenderPlans(self):
+        rm = RootModelTest(object())
+        inline = yield rm.fetch_item("inline")
+        toto = yield rm.fetch_item("toto")
+        structs = yield rm.fetch_item("structs")
+        plan = applicationjson.get_render_plan(inline)
+        self.assertTrue(plan.inline)
+        self.assertFalse(plan.attribute)
+        plan = applicationjson.get_render_plan(toto)
+        self.assertFalse(plan.inline)
+        self.assertTrue(plan.attribute)
+        plan = applicationjson.get_render_plan(structs)
+        self.assertFalse(plan.inline)
+        self.assertFalse(plan.attribute)
+
+        # the plan is computed once for all the items of a class
+        other = yield RootModelTest(object()).fetch_item("toto")
+        self.assertIs(applicationjson.get_render_plan(toto),
+                      applicationjson.get_render_plan(other))
+
+        # instance metadata is taken into account
+        other.put_meta("json", "prevent-inline")
+        self.assertFalse(applicationjson.get_render_plan(other).attribute)
+        self.assertTrue(applicationjson.get_render_plan(toto).attribute)
+
+        # the same for the items of collections
+        numbers = NumbersListModel(DummyNumbers(2))
+        self.assertTrue(applicationjson.get_render_plan(numbers).as_list)
+        first, second = yield numbers.fetch_items()
+        plan = applicationjson.get_render_plan(first)
+        self.assertTrue(plan.inline)
+        self.assertIs(plan, applicationjson.get_render_plan(second))
+        # the plan of the child metadata is kept by the collection class
+        self.assertFalse(first.has_own_meta)
+        self.assertIs(plan, NumbersListModel.get_class_cache(
+            "json-item-plan", None))
+        second.put_meta("json", "render-as-list")
+        self.assertTrue(second.has_own_meta)
+        plan = applicationjson.get_render_plan(second)
+        self.assertTrue(plan.inline)
+        self.assertTrue(plan.as_list)
+        self.assertFalse(applicationjson.get_render_plan(first).as_list)
+
+    @common.attr('slow', timeout=300)
+    @defer.inlineCallbacks
+    def testBenchmark(self):
+        ctx = DummyContext(("ROOT", ), ("root", ))
+        numbers = NumbersModel(DummyNumbers(1000))
+        repeat = 10
+
+        def render(verbose):
+            fmt = "verbose" if verbose else "compact"
+            doc = document.WritableDocument("application/json",
+                                            encoding="UTF8")
+            d = document.write(doc, numbers, context=ctx, format=fmt)
+            return d.addCallback(lambda _: doc.get_data())
+
+        data = yield render(False)
+        self.assertEqual(1000, len(json.loads(data)))
+        start = time.time()
+        for _ in xrange(repeat):
+            yield render(False)
+        compact = repeat / (time.time() - start)
+
+        data = yield render(True)
+        self.assertEqual(1000, len(json.loads(data)["items"]))
+        start = time.time()
+        for _ in xrange(repeat):
+            yield render(True)
+        verbose = repeat / (time.time() - start)
+
+        self.info("Rendering a collection of 1000 models, "
+                  "%.1f compact/s, %.1f verbose/s", compact, verbose)
+
     @defer.inlineCallbacks
     def testActionPayloadReader(self):
 
@@ -296,3 +296,33 @@ class TestModelsMeta(common.TestCase):
                          set([M("foo", "1"), M("booz", "5"),
                               M("booz", "7"), M("foo", "8", "num"),
                               M("toto", "E")]))
+
+    def testClassCache(self):
+        M = meta.MetadataItem
+        calls = []
+
+        def get_foos(cls):
+            calls.append(cls)
+            return [m.value for m in cls.iter_class_meta("foo")]
+
+        class E(D):
+            pass
+
+        e = E()
+        e.put_meta("foo", "A")
+        self.assertEqual([M("foo", "A")], list(e.iter_instance_meta()))
+        self.assertEqual(set([M("foo", "1"), M("foo", "8", "num")]),
+                         set(e.iter_class_meta("foo")))
+
+        self.assertEqual([u"1", u"8"], e.get_class_cache("foos", get_foos))
+        self.assertEqual([u"1", u"8"], E.get_class_cache("foos", get_foos))
+        self.assertEqual([u"1"], A.get_class_cache("foos", get_foos))
+        self.assertEqual([E, A], calls)
+
+        # changing the metadata of a base class invalidates the cache
+        D.annotate_meta("foo", "9")
+        self.addCleanup(meta.class_meta_changed)
+        self.addCleanup(D._mro_meta["foo"].pop)
+        self.assertEqual([u"1", u"8", u"9"],
+                         e.get_class_cache("foos", get_foos))
+        self.assertEqual([E, A, E], calls)
@@ -1,5 +1,6 @@
 import re
 import time
+import zlib
 
 from twisted.test.proto_helpers import StringTransportWithDisconnection
 from twisted.test.proto_helpers import MemoryReactor
@@ -251,6 +252,60 @@ class TestProtocol(common.TestCase):
                '0.(\d+)s after it was sent.')
         self.assertTrue(re.match(exp, str(f)), str(f))
 
+    @defer.inlineCallbacks
+    def testCompressedResponses(self):
+        body = "This is body " * 100
+
+        def gzip(data):
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            return compressor.compress(data) + compressor.flush()
+
+        def raw_deflate(data):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            return compressor.compress(data) + compressor.flush()
+
+        encodings = [("gzip", gzip(body)),
+                     ("deflate", zlib.compress(body)),
+                     ("deflate", raw_deflate(body))]
+        for encoding, data in encodings:
+            d = self.protocol.request(http.Methods.GET, '/')
+            self.protocol.dataReceived(
+                self.protocol.delimiter.join([
+                    "HTTP/1.1 200 OK",
+                    "Content-Type: text/plain",
+                    "Content-Encoding: %s" % (encoding, ),
+                    "Transfer-Encoding: chunked",
+                    "", ""]))
+            # the body is decompressed as it comes
+            chunks = [data[:1]] + [data[i:i + 100]
+                                   for i in range(1, len(data), 100)]
+            for chunk in chunks:
+                self.protocol.dataReceived("%x\r\n%s\r\n" % (len(chunk),
+                                                                chunk))
+            self.protocol.dataReceived("0\r\n\r\n")
+            response = yield d
+            self.assertEqual(200, response.status)
+            self.assertEqual(body, response.body)
+            self.assertEqual([encoding],
+                             response.headers["content-encoding"])
+
+        # broken compressed data fails the request
+        d = self.protocol.request(http.Methods.GET, '/')
+        self.protocol.dataReceived(
+            self.protocol.delimiter.join([
+                "HTTP/1.1 200 OK",
+                "Content-Encoding: gzip",
+                "Content-Length: 12",
+                "",
+                "This is body",
+                ]))
+        self.assertFailure(d, httpclient.InvalidResponse)
+        yield d
+        # the connection is still usable
+        self.assertTrue(self.transport.connected)
+        self.assertTrue(self.protocol.is_idle())
+
     def _disconnect_protocol(self):
         if self.transport.connected:
             self.transport.loseConnection()
@@ -25,6 +25,7 @@
 import os
 import tempfile
 import types
+import zlib
 
 from feat.test import common
 
@@ -263,6 +264,7 @@ class DummyPrivateRequest(object):
         self.client = address.IPv4Address("TCP", "127.0.0.1", 12345)
         self.host = address.IPv4Address("TCP", "127.0.0.2", 12345)
         self.content = StringIO()
+        self.cookies = []
         self.request_headers = {}
         self.responseHeaders = Headers()
         self._finished = defer.Deferred()
@@ -1087,6 +1089,389 @@ class TestWebServer(common.TestCase):
         self.assertIn('Date', content)
         self.assertIn('Fields: %s' % (format, ), content)
 
+    @defer.inlineCallbacks
+    def testBufferedElfLog(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+        rotated = path + '.1'
+
+        format = 'cs-method cs-uri sc-status'
+        elf = webserver.BufferedELFLog(path, format, flush_interval=100,
+                                       max_pending=2)
+        self.assertEqual({'written': 0, 'dropped': 0, 'pending': 0},
+                         elf.get_statistics())
+        elf.init()
+        self.addCleanup(elf.cleanup)
+        self.server.statistics = elf
+
+        self.assertIn('#Fields: %s' % (format, ), open(path).read())
+
+        # the lines are only kept in memory until flushed
+        yield self.check_async('/?name=1', 404, 'ERROR')
+        self.assertEqual({'written': 0, 'dropped': 0, 'pending': 1},
+                         elf.get_statistics())
+        self.assertNotIn('GET', open(path).read())
+
+        yield elf.flush()
+        self.assertEqual({'written': 1, 'dropped': 0, 'pending': 0},
+                         elf.get_statistics())
+        content = open(path).read()
+        self.assertEqual('GET /?name=1 404', content.split("\n")[-2])
+
+        # the lines over the limit are dropped
+        yield self.check_async('/?name=2', 404, 'ERROR')
+        yield self.check_async('/?name=3', 404, 'ERROR')
+        yield self.check_async('/?name=4', 404, 'ERROR')
+        self.assertEqual({'written': 1, 'dropped': 1, 'pending': 2},
+                         elf.get_statistics())
+
+        # rotating while a batch is written reopens the file afterwards
+        os.rename(path, rotated)
+        self.addCleanup(os.unlink, rotated)
+        d = elf.flush()
+        elf._sighup_handler(None, None)
+        self.assertFalse(os.path.exists(path))
+        yield d
+        self.assertEqual({'written': 3, 'dropped': 1, 'pending': 0},
+                         elf.get_statistics())
+        lines = open(rotated).read().split("\n")
+        self.assertEqual(['GET /?name=2 404', 'GET /?name=3 404', ''],
+                         lines[-3:])
+        content = open(path).read()
+        self.assertIn('#Fields: %s' % (format, ), content)
+        self.assertNotIn('GET', content)
+
+        # cleanup writes the remaining lines
+        yield self.check_async('/?name=5', 404, 'ERROR')
+        yield elf.cleanup()
+        self.assertEqual({'written': 4, 'dropped': 1, 'pending': 0},
+                         elf.get_statistics())
+        content = open(path).read()
+        self.assertEqual('GET /?name=5 404', content.split("\n")[-2])
+
+        # nothing is logged after the cleanup
+        yield self.check_async('/?name=6', 404, 'ERROR')
+        self.assertEqual({'written': 4, 'dropped': 2, 'pending': 0},
+                         elf.get_statistics())
+
+
+class DummyTransport(object):
+
+    def __init__(self):
+        self.connected = True
+
+    def loseConnection(self):
+        self.connected = False
+
+
+class StreamingResource(webserver.BasicResource):
+
+    def __init__(self, chunks, error=None):
+        webserver.BasicResource.__init__(self)
+        self._chunks = chunks
+        self._error = error
+        self.writes = []
+
+    def render_resource(self, request, response, location):
+        response.set_mime_type(TEXT_PLAIN)
+        for chunk in self._chunks:
+            response.write(chunk)
+            self.writes.append(response.has_started_writing)
+        if self._error is not None:
+            raise self._error
+
+
+class TestResponseStreaming(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        root = webserver.BasicResource()
+        self.server = webserver.Server(0, root)
+        self.server._scheme = http.Schemes.HTTP
+        self.server.enable_mime_type(TEXT_PLAIN)
+
+        size = webserver.Response.buffer_size
+        self.small = StreamingResource(["spam", "eggs"])
+        self.big = StreamingResource(["x" * size, "y", "z"])
+        broken = StreamingResource(["x" * size, "y"],
+                                   error=ValueError("broken"))
+        root["small"] = self.small
+        root["big"] = self.big
+        root["broken"] = broken
+        root["medium"] = StreamingResource(["spam " * 1000])
+
+    def request(self, uri, accept_encoding=None):
+        request = DummyPrivateRequest(uri)
+        request.request_headers["accept"] = "*"
+        if accept_encoding is not None:
+            request.request_headers["accept-encoding"] = accept_encoding
+        request.channel.transport = DummyTransport()
+        result = self.server._process_request(request)
+        self.assertEqual(result, NOT_DONE_YET)
+        return request
+
+    @defer.inlineCallbacks
+    def testBufferedResponse(self):
+        request = self.request("/small")
+        yield request.notifyFinish()
+        self.assertEqual(http.Status.OK, request.code)
+        self.assertEqual("spameggs", request.content.getvalue())
+        self.assertEqual([False, False], self.small.writes)
+        # the body is known as a whole when finishing
+        self.assertEqual("8", request.response_headers["content-length"])
+
+    @defer.inlineCallbacks
+    def testStreamedResponse(self):
+        size = webserver.Response.buffer_size
+        request = self.request("/big")
+        yield request.notifyFinish()
+        self.assertEqual(http.Status.OK, request.code)
+        self.assertEqual("x" * size + "yz", request.content.getvalue())
+        # only the data over the buffer size makes the response stream
+        self.assertEqual([False, True, True], self.big.writes)
+        self.assertNotIn("content-length", request.response_headers)
+        self.assertTrue(request.channel.transport.connected)
+
+    @defer.inlineCallbacks
+    def testCompressedResponses(self):
+        size = webserver.Response.buffer_size
+        gzip = 16 + zlib.MAX_WBITS
+
+        # not enabled for the mime type
+        request = self.request("/medium", "gzip")
+        yield request.notifyFinish()
+        self.assertNotIn("content-encoding", request.response_headers)
+        self.assertNotIn("vary", request.response_headers)
+
+        self.server.enable_compression("text/*", 9)
+
+        # buffered response
+        request = self.request("/medium", "gzip, deflate")
+        yield request.notifyFinish()
+        headers = request.response_headers
+        self.assertEqual("gzip", headers["content-encoding"])
+        self.assertEqual("accept-encoding", headers["vary"])
+        data = request.content.getvalue()
+        self.assertEqual(str(len(data)), headers["content-length"])
+        self.assertEqual("spam " * 1000, zlib.decompress(data, gzip))
+
+        request = self.request("/medium", "gzip; q=0, deflate")
+        yield request.notifyFinish()
+        self.assertEqual("deflate",
+                         request.response_headers["content-encoding"])
+        self.assertEqual("spam " * 1000,
+                         zlib.decompress(request.content.getvalue()))
+
+        # streamed response
+        request = self.request("/big", "*")
+        yield request.notifyFinish()
+        self.assertEqual("gzip", request.response_headers["content-encoding"])
+        self.assertNotIn("content-length", request.response_headers)
+        self.assertEqual("x" * size + "yz",
+                         zlib.decompress(request.content.getvalue(), gzip))
+
+        # not accepted by the client
+        request = self.request("/medium")
+        yield request.notifyFinish()
+        self.assertNotIn("content-encoding", request.response_headers)
+        self.assertEqual("accept-encoding", request.response_headers["vary"])
+        self.assertEqual("spam " * 1000, request.content.getvalue())
+
+        # too small to be worth it
+        request = self.request("/small", "gzip")
+        yield request.notifyFinish()
+        self.assertNotIn("content-encoding", request.response_headers)
+        self.assertEqual("spameggs", request.content.getvalue())
+
+        self.server.enable_compression("text/*", 0)
+        request = self.request("/medium", "gzip")
+        yield request.notifyFinish()
+        self.assertNotIn("content-encoding", request.response_headers)
+
+    def testAbortedResponse(self):
+        size = webserver.Response.buffer_size
+        request = self.request("/broken")
+        # the client cannot be told about the error anymore, it gets
+        # a closed connection instead of a seemingly complete body
+        self.assertFalse(request.channel.transport.connected)
+        self.assertFalse(request._finished.called)
+        self.assertEqual("x" * size + "y", request.content.getvalue())
+
+
+class PendingResource(webserver.BasicResource):
+
+    def __init__(self, body, caching_policy=None, expiration_policy=None,
+                 head=None):
+        webserver.BasicResource.__init__(self)
+        self.body = body
+        self.head = head
+        self.caching_policy = caching_policy
+        self.expiration_policy = expiration_policy
+        self.renders = 0
+        self._pending = []
+
+    def render_resource(self, request, response, location):
+        self.renders += 1
+        response.set_mime_type(TEXT_PLAIN)
+        if self.caching_policy is not None:
+            response.set_caching_policy(self.caching_policy)
+        if self.expiration_policy is not None:
+            response.set_expiration_policy(self.expiration_policy)
+        if self.head is not None:
+            response.write(self.head)
+        d = defer.Deferred()
+        self._pending.append(d)
+        return d
+
+    def release(self, error=None):
+        pending, self._pending = self._pending, []
+        for d in pending:
+            if error is not None:
+                d.errback(error)
+            else:
+                d.callback(self.body)
+
+
+class TestCoalescing(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        root = webserver.BasicResource()
+        self.server = webserver.Server(0, root)
+        self.server._scheme = http.Schemes.HTTP
+        self.server.enable_mime_type(TEXT_PLAIN)
+        self.server.enable_compression(TEXT_PLAIN)
+
+        self.resource = PendingResource("spam " * 1000)
+        self.cached = PendingResource("eggs",
+                                      http.PublicCachingPolicy(),
+                                      http.FixedExpirationPolicy(10))
+        size = webserver.Response.buffer_size
+        self.streamed = PendingResource("tail", head="x" * (size + 1))
+        root["res"] = self.resource
+        root["cached"] = self.cached
+        root["streamed"] = self.streamed
+
+    def request(self, uri, accept_encoding=None, method="GET"):
+        request = DummyPrivateRequest(uri)
+        request.method = method
+        request.request_headers["accept"] = "*"
+        if accept_encoding is not None:
+            request.request_headers["accept-encoding"] = accept_encoding
+        request.channel.transport = DummyTransport()
+        self.server._process_request(request)
+        return request
+
+    def assertResponse(self, request, body, encoding=None):
+        self.assertTrue(request._finished.called)
+        self.assertEqual(http.Status.OK, request.code)
+        headers = request.response_headers
+        self.assertEqual(encoding, headers.get("content-encoding"))
+        data = request.content.getvalue()
+        self.assertEqual(str(len(data)), headers["content-length"])
+        if encoding == "gzip":
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        self.assertEqual(body, data)
+
+    def testNotEnabled(self):
+        requests = [self.request("/res"), self.request("/res")]
+        self.assertEqual(2, self.resource.renders)
+        self.resource.release()
+        for request in requests:
+            self.assertResponse(request, self.resource.body)
+
+    def testCoalescedRequests(self):
+        self.server.enable_coalescing()
+        plain = [self.request("/res") for _ in range(3)]
+        gzipped = [self.request("/res", "gzip") for _ in range(2)]
+        # the requests not considered safe are rendered on their own
+        self.request("/res", method="POST")
+        self.request("/res", method="POST")
+        self.assertEqual(4, self.resource.renders)
+        for request in plain + gzipped:
+            self.assertFalse(request._finished.called)
+
+        self.resource.release()
+        for request in plain:
+            self.assertResponse(request, self.resource.body)
+        for request in gzipped:
+            self.assertResponse(request, self.resource.body, "gzip")
+
+        # the responses of the finished requests are not cached
+        request = self.request("/res")
+        self.assertEqual(5, self.resource.renders)
+        self.resource.release()
+        self.assertResponse(request, self.resource.body)
+
+    def testNotSharedResponse(self):
+        self.server.enable_coalescing()
+        requests = [self.request("/res") for _ in range(3)]
+        self.assertEqual(1, self.resource.renders)
+
+        # the failed response is not shared, the others render themselves
+        self.resource.release(ValueError("broken"))
+        self.assertEqual(http.Status.INTERNAL_SERVER_ERROR, requests[0].code)
+        self.assertEqual(3, self.resource.renders)
+        self.resource.release()
+        for request in requests[1:]:
+            self.assertResponse(request, self.resource.body)
+
+    def testStreamedResponse(self):
+        self.server.enable_coalescing()
+        requests = [self.request("/streamed") for _ in range(3)]
+        # the body over the buffer size is streamed and cannot be shared,
+        # the identical requests do not wait for it to finish
+        self.assertEqual(3, self.streamed.renders)
+        for request in requests:
+            self.assertFalse(request._finished.called)
+
+        self.streamed.release()
+        for request in requests:
+            self.assertTrue(request._finished.called)
+            self.assertEqual(http.Status.OK, request.code)
+            self.assertEqual(self.streamed.head + "tail",
+                             request.content.getvalue())
+
+        # the released key does not hold the next identical requests
+        self.request("/streamed")
+        self.request("/streamed")
+        self.assertEqual(5, self.streamed.renders)
+        self.streamed.release()
+
+    @defer.inlineCallbacks
+    def testCachedResponses(self):
+        self.server.enable_coalescing(max_cache_age=0.1)
+        first = self.request("/cached")
+        self.cached.release()
+        self.assertResponse(first, "eggs")
+
+        # served from the cache without rendering
+        request = self.request("/cached")
+        self.assertEqual(1, self.cached.renders)
+        self.assertResponse(request, "eggs")
+        self.assertEqual(first.response_headers, request.response_headers)
+
+        # the response without caching policy is not kept
+        self.request("/res")
+        self.resource.release()
+        self.request("/res")
+        self.assertEqual(2, self.resource.renders)
+        self.resource.release()
+
+        # the maximum age of the server is shorter than the one
+        # of the expiration policy
+        yield common.delay(None, 0.2)
+        request = self.request("/cached")
+        self.assertEqual(2, self.cached.renders)
+        self.cached.release()
+        self.assertResponse(request, "eggs")
+
+        # the cache can be disabled
+        self.server.enable_coalescing(max_cache_age=0)
+        self.request("/cached")
+        self.assertEqual(3, self.cached.renders)
+        self.cached.release()
+
 
 def _write_upper(doc, obj):
     doc.write(obj.value.upper())
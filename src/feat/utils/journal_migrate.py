@@ -0,0 +1,79 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+import optparse
+
+from twisted.internet import reactor
+
+from feat.agencies import journaler
+from feat.common import log, defer, error
+
+
+@defer.inlineCallbacks
+def migrate(filename, connection_strings, hostname=None):
+    '''
+    Moves the entries stored by the FileWriter to the journal described
+    by the connection strings. Migrated entries are removed from the
+    segment files.
+    '''
+    reader = journaler.FileWriter(log.get_default(), filename,
+                                  hostname=hostname)
+    jour = journaler.Journaler(hostname=hostname)
+    try:
+        yield reader.initiate()
+        log.info('journal_migrate', "Loaded %d segments from %s.",
+                 len(reader._segments), filename)
+        yield jour.set_connection_strings(connection_strings)
+        yield jour.migrate_entries(reader)
+    finally:
+        yield jour.close()
+        yield reader.close()
+
+
+def parse_options():
+    usage = "%prog [options] JOURNAL_FILE CONNECTION_STRING..."
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('--hostname', action='store', dest='hostname',
+                      type='str', default=None,
+                      help=("hostname of the agency which produced the "
+                            "entries (default: local hostname)"))
+    opts, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error("journal file and at least one connection string "
+                     "are required")
+    return opts, args
+
+
+def script():
+    log.init()
+    log.FluLogKeeper.set_debug('3')
+
+    opts, args = parse_options()
+
+    def errback(fail):
+        error.handle_failure('journal_migrate', fail, 'Migration failed')
+
+    d = defer.Deferred()
+    d.addCallback(lambda _: migrate(args[0], args[1:], opts.hostname))
+    d.addErrback(errback)
+    d.addBoth(defer.drop_param, reactor.stop)
+    reactor.callWhenRunning(d.callback, None)
+    reactor.run()
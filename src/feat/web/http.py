@@ -23,7 +23,7 @@ import urllib
 import urlparse
 import re
 
-from zope.interface import Interface
+from zope.interface import Interface, implements
 
 from twisted.protocols import basic
 from twisted.web import http
@@ -257,16 +257,43 @@ class MovedPermanently(HTTPError):
 
 
 class ICachingPolicy(Interface):
-    """Place holder."""
+    """Decides if a response can be reused for identical requests."""
+
+    def may_cache(response):
+        """@return: C{bool} telling if the response can be reused."""
 
 
 class IExpirationPolicy(Interface):
-    """Place holder."""
+    """Decides for how long a response stays valid."""
+
+    def get_max_age(response):
+        """@return: number of seconds the response stays valid or None."""
 
 
 ### Implementations ###
 
 
+class PublicCachingPolicy(object):
+    """Lets any identical request reuse the response."""
+
+    implements(ICachingPolicy)
+
+    def may_cache(self, response):
+        return True
+
+
+class FixedExpirationPolicy(object):
+    """The response stays valid for a fixed number of seconds."""
+
+    implements(IExpirationPolicy)
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+
+    def get_max_age(self, response):
+        return self.max_age
+
+
 class BaseProtocol(log.Logger, basic.LineReceiver, timeout.Mixin):
 
     max_headers = 20
@@ -819,6 +846,21 @@ def parse_accepted_languages(value):
     return dict([parse_accepted_language(p) for p in value.split(',')])
 
 
+def parse_accepted_content_encoding(value):
+    type, params = _split_http_definition(value)
+    if type:
+        type = type.lower()
+    priority = float(params.get("q", DEFAULT_PRIORITY))
+    return type, priority
+
+
+def parse_accepted_content_encodings(value):
+    if not value:
+        return {}
+    return dict([parse_accepted_content_encoding(p)
+                 for p in value.split(',')])
+
+
 def compose_user_agent(name, version=None):
     if version is None:
         return name
@@ -1,3 +1,5 @@
+import zlib
+
 from zope.interface import Interface, Attribute, implements
 
 from twisted.internet import reactor as treactor, error as terror
@@ -105,6 +107,48 @@ class ResponseDecoder(object, Protocol):
         return self._deferred
 
 
+class ContentDecoder(object):
+    '''
+    Decompresses a response body received with a gzip or deflate
+    content encoding. Some servers send deflate without the zlib header,
+    it is detected from the first bytes received.
+    '''
+
+    def __init__(self, encoding):
+        wbits = zlib.MAX_WBITS
+        if encoding != "deflate":
+            # accepts only the gzip header and trailer
+            wbits += 16
+        self._decompressor = zlib.decompressobj(wbits)
+        # the two bytes of the zlib header when not known to be there yet
+        self._head = "" if encoding == "deflate" else None
+
+    def decode(self, data):
+        if self._head is None:
+            return self._decompressor.decompress(data)
+
+        self._head += data
+        try:
+            result = self._decompressor.decompress(data)
+        except zlib.error:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            result = self._decompressor.decompress(self._head)
+            self._head = None
+            return result
+        if len(self._head) >= 2:
+            self._head = None
+        return result
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+# the content encodings ContentDecoder can decompress
+CONTENT_ENCODINGS = {"gzip": "gzip",
+                     "x-gzip": "gzip",
+                     "deflate": "deflate"}
+
+
 STATE_DESCRIPTIONS = {
     http.BaseProtocol.STATE_REQLINE: 'waiting for the status line',
     http.BaseProtocol.STATE_HEADERS: 'receiving the headers',
@@ -133,6 +177,8 @@ class Protocol(http.BaseProtocol):
         http.BaseProtocol.__init__(self, log_keeper)
 
         self._response = None
+        self._content_decoder = None
+        self._content_failed = False
         self._requests = []
         # queue of Protocol instances which will receive the body
         self._pending_decoders = []
@@ -226,6 +272,7 @@ class Protocol(http.BaseProtocol):
             return
         protocol, status = parts
         self._response = self._requests.pop(0)
+        self._content_failed = False
         self._response.protocol = protocol
         self._response.status = status
         self._response.makeConnection(self.transport)
@@ -260,12 +307,40 @@ class Protocol(http.BaseProtocol):
         assert self._response is not None, "No response information"
         self._response.headers[name] = value
 
+    def process_body_start(self):
+        assert self._response is not None, "No response information"
+        self._content_decoder = None
+        self._content_failed = False
+        encodings = self._response.headers.get("content-encoding")
+        if encodings and len(encodings) == 1:
+            encoding = CONTENT_ENCODINGS.get(encodings[0].lower())
+            if encoding is not None:
+                self._content_decoder = ContentDecoder(encoding)
+
     def process_body_data(self, data):
         assert self._response is not None, "No response information"
-        self._response.dataReceived(data)
+        if self._content_decoder is not None:
+            try:
+                data = self._content_decoder.decode(data)
+            except zlib.error, e:
+                self._content_error(e)
+                return
+        if data and not self._content_failed:
+            self._response.dataReceived(data)
 
     def process_body_finished(self):
-        self._response.connectionLost()
+        if self._content_decoder is not None:
+            try:
+                data = self._content_decoder.flush()
+            except zlib.error, e:
+                self._content_error(e)
+            else:
+                if data:
+                    self._response.dataReceived(data)
+            self._content_decoder = None
+        if not self._content_failed:
+            self._response.connectionLost()
+        self._content_failed = False
         self._response = None
 
     def process_timeout(self):
@@ -297,7 +372,8 @@ class Protocol(http.BaseProtocol):
 
     def process_error(self, exception):
         if self._response:
-            self._response.connectionLost(failure.Failure(exception))
+            if not self._content_failed:
+                self._response.connectionLost(failure.Failure(exception))
             self._response = None
 
     ### Private Methods ###
@@ -330,10 +406,19 @@ class Protocol(http.BaseProtocol):
             raise TypeError(repr(type(body)))
         return body
 
+    def _content_error(self, exception):
+        # the rest of the body is still received and dropped,
+        # the connection can be reused as it is still in a known state
+        self._content_decoder = None
+        self._content_failed = True
+        msg = "Failed decompressing the response body: %s" % (exception, )
+        self._response.connectionLost(failure.Failure(InvalidResponse(msg)))
+
     def _client_error(self, exception):
         reason = failure.Failure(exception)
         if self._response:
-            self._response.connectionLost(reason)
+            if not self._content_failed:
+                self._response.connectionLost(reason)
             self._response = None
         self.transport.loseConnection()
 
@@ -27,10 +27,11 @@ import sys
 import time
 import tempfile
 import types
+import zlib
 
 from zope.interface import Interface, Attribute, implements
 
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.python.failure import Failure
 from twisted.web import server, resource, http as webhttp
 
@@ -76,6 +77,13 @@ class IWebStatistics(Interface):
         '''
         Called when the webserver is shuting down.
         You should close all the filedescriptors, release signals, etc.
+        May return a Deferred fired when the cleanup is done.
+        '''
+
+    def get_statistics():
+        '''
+        @returns: dictionary with the counters of the log lines: written,
+                  dropped and pending (waiting to be written).
         '''
 
 
@@ -150,6 +158,7 @@ class IWebRequest(Interface):
     accepted_mime_types = Attribute("")
     accepted_encodings = Attribute("")
     accepted_languages = Attribute("")
+    accepted_content_encodings = Attribute("")
     length = Attribute("")
     context = Attribute("")
     cancelled = Attribute("C{bool} set if the underlying connection was "
@@ -204,6 +213,7 @@ class IWebResponse(Interface):
     language = Attribute("")
     caching_policy = Attribute("")
     expiration_policy = Attribute("")
+    content_encoding = Attribute("Compression applied to the body or None")
     finished = Attribute("C{float} epoch time web the response was finished")
     bytes = Attribute("C{int} number of bytes transfered")
 
@@ -513,6 +523,9 @@ class ELFLog(object):
                                   for x in self._template_parts)
         self._template += "\n"
 
+        self.written = 0
+        self.dropped = 0
+
     ### IWebStatistics ###
 
     def init(self):
@@ -520,10 +533,9 @@ class ELFLog(object):
         self._reopen_output_file()
 
     def request_finished(self, request, response):
-        data = dict((name, handler(request, response))
-                    for name, handler in self._template_parts)
-        self._output.write(self._template % data)
+        self._output.write(self._format_line(request, response))
         self._output.flush()
+        self.written += 1
 
     def cleanup(self):
         try:
@@ -536,6 +548,9 @@ class ELFLog(object):
             self._output.close()
             del self._output
 
+    def get_statistics(self):
+        return dict(written=self.written, dropped=self.dropped, pending=0)
+
     ### extracting data ###
 
     def _extract_cs(self, name):
@@ -601,6 +616,11 @@ class ELFLog(object):
 
     ### private ###
 
+    def _format_line(self, request, response):
+        data = dict((name, handler(request, response))
+                    for name, handler in self._template_parts)
+        return self._template % data
+
     def _sighup_handler(self, signum, frame):
         self._reopen_output_file()
 
@@ -615,6 +635,155 @@ class ELFLog(object):
             self._output.flush()
 
 
+class BufferedELFLog(ELFLog):
+    '''
+    Extended log which doesn't touch the file from the reactor thread.
+    The lines are kept in memory and written in batches by a thread
+    from the reactor pool every flush_interval seconds, one batch at a time.
+    When max_pending lines are already waiting the new ones are dropped,
+    the number of dropped lines is reported by get_statistics().
+
+    @param flush_interval: seconds to collect the lines before writing them
+    @param max_pending: maximum number of lines kept in memory
+    '''
+
+    flush_interval = 1
+    max_pending = 10000
+
+    def __init__(self, path, format, dateformat="%d-%m-%Y",
+                 timeformat="%H:%M:%S", flush_interval=None,
+                 max_pending=None):
+        ELFLog.__init__(self, path, format, dateformat=dateformat,
+                        timeformat=timeformat)
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if max_pending is not None:
+            self.max_pending = max_pending
+
+        self._pending = list()
+        self._flush_call = None
+        # the Deferred of the batch being written in the thread
+        self._writing = None
+        self._reopen_requested = False
+        self._closing = False
+        # set when someone waits for all the pending lines to be written
+        self._flushing = False
+        self._notifier = defer.Notifier()
+
+    ### IWebStatistics ###
+
+    def init(self):
+        self._closing = False
+        ELFLog.init(self)
+
+    def request_finished(self, request, response):
+        if (self._closing or not hasattr(self, '_output')
+            or len(self._pending) >= self.max_pending):
+            self.dropped += 1
+            return
+        self._pending.append(self._format_line(request, response))
+        if self._flush_call is None and self._writing is None:
+            self._flush_call = reactor.callLater(self.flush_interval,
+                                                 self._write_pending)
+
+    def cleanup(self):
+        try:
+            signal.unregister(signal.SIGHUP, self._sighup_handler)
+        except ValueError:
+            pass
+        self._closing = True
+        d = self.flush()
+        d.addCallback(defer.drop_param, self._close_output)
+        return d
+
+    def get_statistics(self):
+        return dict(written=self.written, dropped=self.dropped,
+                    pending=len(self._pending))
+
+    ### public ###
+
+    def flush(self):
+        '''
+        Writes all the pending lines.
+        @returns: Deferred fired when nothing is left to write.
+        '''
+        self._cancel_flush_call()
+        if self._writing is None:
+            self._write_pending()
+        if self._writing is None:
+            return defer.succeed(None)
+        self._flushing = True
+        return self._notifier.wait('flushed')
+
+    ### private ###
+
+    def _cancel_flush_call(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+
+    def _write_pending(self):
+        self._flush_call = None
+        if not self._pending or not hasattr(self, '_output'):
+            return
+        lines, self._pending = self._pending, list()
+        d = threads.deferToThread(self._write_lines, self._output, lines)
+        d.addCallbacks(self._lines_written, self._writing_failed,
+                       callbackArgs=(len(lines), ),
+                       errbackArgs=(len(lines), ))
+        d.addCallback(self._batch_finished)
+        self._writing = d
+
+    def _lines_written(self, _, count):
+        self.written += count
+
+    def _writing_failed(self, fail, count):
+        self.dropped += count
+        error.handle_failure(None, fail,
+                             "Failed writing %d lines to the log file %s",
+                             count, self._path)
+
+    def _batch_finished(self, _):
+        self._writing = None
+        if self._reopen_requested:
+            self._reopen_requested = False
+            self._reopen_output_file()
+        if not self._pending:
+            self._flushing = False
+            self._notifier.callback('flushed', None)
+        elif self._closing or self._flushing:
+            self._write_pending()
+        else:
+            self._flush_call = reactor.callLater(self.flush_interval,
+                                                 self._write_pending)
+
+    def _sighup_handler(self, signum, frame):
+        if self._writing is not None:
+            # the file is being written in the thread, reopen it afterwards
+            self._reopen_requested = True
+        else:
+            self._reopen_output_file()
+
+    def _reopen_output_file(self):
+        self._close_output()
+        ELFLog._reopen_output_file(self)
+
+    def _close_output(self):
+        if hasattr(self, '_output'):
+            self._output.close()
+            del self._output
+
+    ### methods run in the thread ###
+
+    def _write_lines(self, output, lines):
+        '''
+        BEWARE: This method runs in a thread.
+        '''
+        output.write("".join(lines))
+        output.flush()
+
+
 class HTTPChannel(webhttp.HTTPChannel):
 
     def connectionMade(self):
@@ -691,6 +860,19 @@ class Server(log.LogProxy, log.Logger):
 
     log_category = 'webserver'
 
+    # responses known to be smaller are not worth compressing
+    compression_threshold = 1024
+
+    # maximum number of responses kept in the response cache
+    cache_size = 100
+
+    # request headers which must be the same for the requests
+    # to share a response, the credentials are compared separately
+    COALESCING_HEADERS = ("host", "accept", "accept-charset",
+                          "accept-languages", "accept-encoding",
+                          "authorization", "cookie", "cache-control",
+                          "if-modified-since", "if-none-match", "range")
+
     def __init__(self, port, root_resource, registry=None,
                  security_policy=None, server_identity=None,
                  default_authenticator=None, default_authorizer=None,
@@ -713,6 +895,16 @@ class Server(log.LogProxy, log.Logger):
 
         self._scheme = None
         self._mime_types = {}
+        # mime type -> compression level
+        self._compressions = {}
+
+        self._coalescing = False
+        self._max_cache_age = 0
+        # keys of the shared requests being rendered
+        self._rendering = set()
+        # key -> (expiration time, reply)
+        self._response_cache = {}
+        self._coalesced = defer.Notifier()
 
         self._listener = None
         self._site = None
@@ -740,9 +932,9 @@ class Server(log.LogProxy, log.Logger):
         return defer.succeed(self)
 
     def cleanup(self):
-        if self.statistics:
-            self.statistics.cleanup()
         defers = list()
+        if self.statistics:
+            defers.append(defer.maybeDeferred(self.statistics.cleanup))
         if self._listener:
             d = self._listener.stopListening()
             defers.append(d)
@@ -751,6 +943,7 @@ class Server(log.LogProxy, log.Logger):
             d = self._site.cleanup()
             defers.append(d)
             self._site = None
+        self._response_cache.clear()
         if defers:
             d = defer.DeferredList(defers)
             d.addCallback(defer.override_result, self)
@@ -794,6 +987,34 @@ class Server(log.LogProxy, log.Logger):
         type, sub = http.mime2tuple(mime_type)
         self._mime_types.setdefault(type, {})[sub] = min(1.0, float(priority))
 
+    def enable_compression(self, mime_type, level=6):
+        """
+        Enables compressing the responses of specified mime type
+        for the clients accepting it. The mime type can be a wildcard
+        like "text/*". Level 0 disables compression again.
+        """
+        self._compressions[mime_type] = int(level)
+
+    def get_compression_level(self, mime_type):
+        level = self._compressions.get(mime_type)
+        if level is None and mime_type:
+            type, _sub = http.mime2tuple(mime_type)
+            level = self._compressions.get(type + "/*")
+        return level or None
+
+    def enable_coalescing(self, max_cache_age=5):
+        """
+        Lets the identical GET and HEAD requests processed at the same time
+        share a single rendering of the resource. The responses allowed
+        by their caching policy are also kept for the time given
+        by their expiration policy, but not longer than max_cache_age
+        seconds. Max cache age 0 disables the response cache.
+        """
+        self._coalescing = True
+        self._max_cache_age = max_cache_age
+        if not max_cache_age:
+            self._response_cache.clear()
+
     def negotiate_mime_types(self, obj, accepts={}):
         acc_types = http.build_mime_tree(accepts, True)
         priorities = {}
@@ -872,10 +1093,26 @@ class Server(log.LogProxy, log.Logger):
             elif location[0] != '':
                 raise http.BadRequestError()
 
+            key = self._get_coalescing_key(request)
+            if key is not None and self._coalesce(key, request, response):
+                return server.NOT_DONE_YET
+
+            self._render_request(request, response, key)
+            return server.NOT_DONE_YET
+
+        except:
+
+            self._emergency_termination(Failure(), request, response)
+            response._finish()
+            return server.NOT_DONE_YET
+
+    def _render_request(self, request, response, key=None):
+        try:
+
             # render the resource
             d = self._process_resource(request, response,
                                        self._resource, request.credentials,
-                                       (u'', ), location[1:])
+                                       (u'', ), request.location[1:])
 
             if isinstance(d, defer.Deferred):
                 # Asynchronous rendering
@@ -884,19 +1121,119 @@ class Server(log.LogProxy, log.Logger):
                 # # _emergency_termination bridges through the CancelledError
                 # # so that we don't try to finalize the response
                 # d.addErrback(Failure.trap, defer.CancelledError)
+                if key is not None:
+                    d.addBoth(defer.bridge_param, self._coalesced_finished,
+                              key, response)
                 finished = request.wait_finished()
                 finished.addErrback(defer.drop_param, d.cancel)
+                return
             else:
                 response._finish()
 
-            return server.NOT_DONE_YET
-
         except:
 
             self._emergency_termination(Failure(), request, response)
             response._finish()
-            return server.NOT_DONE_YET
 
+        if key is not None:
+            self._coalesced_finished(key, response)
+
+    ### coalescing ###
+
+    def _get_coalescing_key(self, request):
+        if not self._coalescing:
+            return None
+        if request.method not in (http.Methods.GET, http.Methods.HEAD):
+            return None
+        if request.length:
+            return None
+        peer_info = request.peer_info
+        headers = tuple(request.get_header(name)
+                        for name in self.COALESCING_HEADERS)
+        return ((request.method, request._ref.uri,
+                 peer_info and peer_info.context) + headers)
+
+    def _coalesce(self, key, request, response):
+        '''
+        Serves the request from the response cache or makes it wait
+        for the identical one being rendered. Returns False if the request
+        should be rendered, the other identical requests will wait for it.
+        '''
+        reply = self._get_cached_reply(key)
+        if reply is not None:
+            self.log("Request %s served from the response cache", request)
+            response._replay(reply)
+            return True
+
+        if key in self._rendering:
+            self.log("Request %s waits for an identical request "
+                     "being rendered", request)
+            d = self._coalesced.wait(key)
+            d.addCallback(self._coalesced_rendered, request, response)
+            finished = request.wait_finished()
+            finished.addErrback(defer.drop_param, d.cancel)
+            return True
+
+        self._rendering.add(key)
+        response._coalescing_key = key
+        return False
+
+    def _coalesced_streaming(self, key):
+        # a streamed body cannot be shared, the waiting requests render
+        # on their own instead of waiting for the whole response
+        self._rendering.discard(key)
+        self._coalesced.callback(key, None)
+
+    def _coalesced_finished(self, key, response):
+        if response._coalescing_key is None:
+            # the waiting requests were released when it started streaming
+            return
+        response._coalescing_key = None
+        self._rendering.discard(key)
+        reply = response._get_reply()
+        if reply is not None:
+            max_age = self._get_cache_age(response)
+            if max_age > 0:
+                self._cache_reply(key, reply, max_age)
+        self._coalesced.callback(key, reply)
+
+    def _coalesced_rendered(self, reply, request, response):
+        if request.cancelled:
+            return
+        if reply is None:
+            # the response couldn't be shared, render the request on its own
+            self._render_request(request, response)
+            return
+        response._replay(reply)
+
+    def _get_cache_age(self, response):
+        caching = response.caching_policy
+        expiration = response.expiration_policy
+        if not (self._max_cache_age and caching and expiration):
+            return 0
+        if not http.ICachingPolicy(caching).may_cache(response):
+            return 0
+        max_age = http.IExpirationPolicy(expiration).get_max_age(response)
+        return min(max_age or 0, self._max_cache_age)
+
+    def _get_cached_reply(self, key):
+        entry = self._response_cache.get(key)
+        if entry is None:
+            return None
+        expiration, reply = entry
+        if expiration > time.time():
+            return reply
+        del self._response_cache[key]
+
+    def _cache_reply(self, key, reply, max_age):
+        now = time.time()
+        cache = self._response_cache
+        if len(cache) >= self.cache_size:
+            for k, (expiration, _) in cache.items():
+                if expiration <= now:
+                    del cache[k]
+        if key in cache or len(cache) < self.cache_size:
+            cache[key] = (now + max_age, reply)
 
     ### private ###
 
@@ -1223,6 +1560,7 @@ class Server(log.LogProxy, log.Logger):
     def _render_error(self, request, response, resource, error):
         if response.has_started_writing:
             # Nothing we can do now
+            response._abort()
             return self._terminate(request, response)
 
         response._try_reset()
@@ -1274,6 +1612,8 @@ class Server(log.LogProxy, log.Logger):
                 msg = failure.getErrorMessage()
                 if msg:
                     response.write("Error: %s\n" % (msg, ))
+            elif response.has_started_writing:
+                response._abort()
 
             if failure.check(http.HTTPError):
                 return self._terminate(request, response,
@@ -1326,6 +1666,9 @@ class Request(log.Logger, log.LogProxy):
         accepted_encodings = http.parse_accepted_charsets(accept_charset)
         accept_languages = self.get_header("accept-languages")
         accepted_languages = http.parse_accepted_languages(accept_languages)
+        accept_encoding = self.get_header("accept-encoding")
+        accepted_content_encodings = \
+            http.parse_accepted_content_encodings(accept_encoding)
 
         try:
             method = http.Methods[self._ref.method]
@@ -1349,6 +1692,7 @@ class Request(log.Logger, log.LogProxy):
         self._accept_tree = accept_tree
         self._accepted_encodings = accepted_encodings
         self._accepted_languages = accepted_languages
+        self._accepted_content_encodings = accepted_content_encodings
         self._method = method
         self._protocol = protocol
         self._credentials = None
@@ -1455,6 +1799,10 @@ class Request(log.Logger, log.LogProxy):
     def accepted_languages(self):
         return self._accepted_languages
 
+    @property
+    def accepted_content_encodings(self):
+        return self._accepted_content_encodings
+
     @property
     def length(self):
         return self._length
@@ -1598,6 +1946,14 @@ class Response(log.Logger):
 
     strict_negotiation = True
 
+    # the body is buffered until it grows over this size, then the headers
+    # are sent and the rest is written as it comes, if the length is not
+    # known HTTP/1.1 clients get it with chunked transfer encoding
+    buffer_size = 64 * 1024
+
+    # content encodings the body can be compressed with, by preference
+    CONTENT_ENCODINGS = ("gzip", "deflate")
+
     # map encodings unknown to Python but used by browsers to what Python
     # knows how to handle
     ENCODING_TRANSLATION = {'x-gbk': 'gbk'}
@@ -1609,8 +1965,8 @@ class Response(log.Logger):
         self._encoding = None
         self._mime_type = None
         self._language = None
-        self._cachingPolicy = None
-        self._expirationPolicy = None
+        self._caching_policy = None
+        self._expiration_policy = None
         self._prepared = False
         self._cache = StringIO()
         self._location = None
@@ -1620,6 +1976,14 @@ class Response(log.Logger):
         self._finished = None
         self._bytes = 0
         self._cancelled = False
+        self._aborted = False
+        self._body_started = False
+        self._compressor = None
+        self._content_encoding = None
+        # the body sent at once at the end, None if it was streamed
+        self._sent_body = None
+        # the key of the identical requests waiting for this response
+        self._coalescing_key = None
 
     ### IWebResponse ###
 
@@ -1656,6 +2020,10 @@ class Response(log.Logger):
     def expiration_policy(self):
         return self._expiration_policy
 
+    @property
+    def content_encoding(self):
+        return self._content_encoding
+
     @property
     def can_update_headers(self):
         return self._cache is not None
@@ -1693,7 +2061,12 @@ class Response(log.Logger):
         data = self._cache and self._cache.getvalue()
         self._cache = None
         if data:
-            self.write(data)
+            # the data is already encoded and accounted for
+            self.prepare()
+            self._write_body(data)
+        if self._coalescing_key is not None:
+            key, self._coalescing_key = self._coalescing_key, None
+            self._server._coalesced_streaming(key)
 
     def set_status(self, code, message=None):
         self._check_header_not_sent()
@@ -1747,11 +2120,11 @@ class Response(log.Logger):
 
     def set_caching_policy(self, policy):
         self._check_header_not_sent()
-        self._cachingPolicy = policy
+        self._caching_policy = policy
 
     def set_expiration_policy(self, policy):
         self._check_header_not_sent()
-        self._expirationPolicy = policy
+        self._expiration_policy = policy
 
     def add_cookie(self, name, payload, expires=None, max_age=None,
                    domain=None, path=None, secure=None):
@@ -1857,8 +2230,9 @@ class Response(log.Logger):
         data = self._encode(data)
         if self._cache:
             self._cache.write(data)
+            self._check_buffer()
         else:
-            self._request._ref.write(data)
+            self._write_body(data)
 
     def writelines(self, sequence):
         self.prepare()
@@ -1866,8 +2240,9 @@ class Response(log.Logger):
         self._bytes += sum(len(l) for l in lines)
         if self._cache is not None:
             self._cache.writelines(lines)
+            self._check_buffer()
         else:
-            self._request._ref.writelines(lines)
+            self._write_body("".join(lines))
 
     ### protected ###
 
@@ -1889,6 +2264,11 @@ class Response(log.Logger):
             self._cache = StringIO()
             self._objects = []
 
+    def _abort(self):
+        # the body written so far is incomplete, the connection is closed
+        # instead of finishing the request, so the client can tell
+        self._aborted = True
+
     def _finish(self):
         if self._request.cancelled:
             return
@@ -1901,9 +2281,19 @@ class Response(log.Logger):
         self._finished = time.time()
         try:
             if self._cache is not None:
-                data = self._cache.getvalue()
+                data = self._encode(self._cache.getvalue())
                 self.prepare()
-                self._request._ref.write(self._encode(data))
+                self._start_body(len(data))
+                if self._compressor is not None:
+                    data = self._compress(data, zlib.Z_FINISH)
+                headers = self._request._ref.responseHeaders
+                if data and not headers.hasHeader("content-length"):
+                    # the whole body is known, no need for chunking it
+                    self._set_header("content-length", str(len(data)))
+                self._sent_body = data
+                self._request._ref.write(data)
+            elif self._compressor is not None and not self._aborted:
+                self._request._ref.write(self._compressor.flush())
         except http.HTTPError:
             pass
         except Exception, e:
@@ -1915,6 +2305,13 @@ class Response(log.Logger):
         if self._server.statistics:
             self._server.statistics.request_finished(self._request, self)
 
+        if self._aborted:
+            channel = self._request._ref.channel
+            transport = channel and channel.transport
+            if transport is not None:
+                transport.loseConnection()
+            return
+
         try:
             self._request._ref.finish()
         except http.HTTPError:
@@ -1923,8 +2320,91 @@ class Response(log.Logger):
             msg = "Exception during response finalization"
             error.handle_exception(self, e, msg)
 
+    def _get_reply(self):
+        # the copy of the response which can be sent for identical requests
+        ref = self._request._ref
+        if (self._sent_body is None or self._aborted
+            or self._request.cancelled or ref.cookies or ref.code >= 500):
+            return None
+        headers = [(key, list(values))
+                   for key, values in ref.responseHeaders.getAllRawHeaders()
+                   if key.lower() != "date"]
+        return ref.code, headers, self._sent_body, self._bytes
+
+    def _replay(self, reply):
+        # sends the response rendered for an identical request
+        code, headers, body, length = reply
+        ref = self._request._ref
+        ref.setResponseCode(code)
+        for key, values in headers:
+            ref.responseHeaders.setRawHeaders(key, list(values))
+        self._prepared = True
+        self._cache = None
+        self._body_started = True
+        self._bytes = length
+        if body:
+            ref.write(body)
+        self._finish()
+
     ### private ###
 
+    def _start_body(self, length=None):
+        # called before sending the headers along with the first data,
+        # the length is only known if the whole body was buffered
+        self._body_started = True
+        level = self._server.get_compression_level(self._mime_type)
+        if level is None:
+            return
+        headers = self._request._ref.responseHeaders
+        if (headers.hasHeader("content-encoding")
+            or headers.hasHeader("content-length")):
+            # the resource is taking care of the body itself
+            return
+        threshold = self._server.compression_threshold
+        if length is not None and (not length or length < threshold):
+            return
+
+        vary = headers.getRawHeaders("vary", [])
+        headers.setRawHeaders("vary", vary + ["accept-encoding"])
+
+        encoding = self._select_content_encoding()
+        if encoding is None:
+            return
+        wbits = zlib.MAX_WBITS
+        if encoding == "gzip":
+            # tells zlib to write the gzip header and trailer
+            wbits += 16
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+        self._content_encoding = encoding
+        self._set_header("content-encoding", encoding)
+
+    def _select_content_encoding(self):
+        accepted = self._request.accepted_content_encodings
+        default = accepted.get("*", 0)
+        selected, selected_priority = None, 0
+        for encoding in self.CONTENT_ENCODINGS:
+            priority = accepted.get(encoding, default)
+            if priority > selected_priority:
+                selected, selected_priority = encoding, priority
+        return selected
+
+    def _write_body(self, data):
+        if not self._body_started:
+            self._start_body()
+        if self._compressor is not None:
+            # flushing so the client can use what has been written so far
+            data = self._compress(data, zlib.Z_SYNC_FLUSH)
+        if data:
+            self._request._ref.write(data)
+
+    def _compress(self, data, mode):
+        return self._compressor.compress(data) + self._compressor.flush(mode)
+
+    def _check_buffer(self):
+        if (self.buffer_size is not None and
+            self._cache.tell() > self.buffer_size):
+            self.do_not_cache()
+
     def _check_header_not_sent(self):
         if (self._cache is None) and self._prepared:
             raise AlreadyPreparedError("Response not cached "